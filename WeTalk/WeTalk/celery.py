@@ -9,8 +9,12 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
 
 app.conf.beat_schedule = {
-    'close-inactive-connections-every-10-mins': {
-        'task': 'talk.tasks.close_inactive_connections',
-        'schedule': 600.0, 
+    'reconcile-active-connections-every-10-mins': {
+        'task': 'talk.tasks.reconcile_active_connections',
+        'schedule': 600.0,
+    },
+    'archive-old-messages-daily': {
+        'task': 'talk.tasks.archive_old_messages',
+        'schedule': crontab(hour=4, minute=0),
     },
 }
@@ -0,0 +1,239 @@
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# the recorder of the request or block being measured, for work it hands to
+# other threads: talk.executor records its calls on their own connections
+active_recorder = ContextVar("active_recorder", default=None)
+
+
+class QueryRecorder:
+    """
+    Collects the SQL run on every database connection while installed
+    through connection.execute_wrapper. A statement run again with the same
+    parameters is a duplicate, run again with other parameters it is
+    "similar", the usual shape of an N+1.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, repr(params), (time.perf_counter() - started) * 1000))
+
+    @contextmanager
+    def record(self):
+        token = active_recorder.set(self)
+        try:
+            with _wrap_all(self):
+                yield self
+        finally:
+            active_recorder.reset(token)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duplicates(self):
+        return sum(n - 1 for n in Counter((sql, params) for sql, params, _ in self.queries).values())
+
+    @property
+    def similar(self):
+        return sum(n - 1 for n in Counter(sql for sql, _, _ in self.queries).values())
+
+    @property
+    def sql_ms(self):
+        return sum(ms for _, _, ms in self.queries)
+
+    def repeated(self):
+        """The statements run more than once, most repeated first."""
+        return [(sql, n) for sql, n in Counter(sql for sql, _, _ in self.queries).most_common() if n > 1]
+
+
+@contextmanager
+def _wrap_all(recorder):
+    wrapped = []
+    try:
+        for alias in connections:
+            if recorder in connections[alias].execute_wrappers:
+                # a thread sharing the connection of the code that started recording
+                continue
+            wrapper = connections[alias].execute_wrapper(recorder)
+            wrapper.__enter__()
+            wrapped.append(wrapper)
+        yield
+    finally:
+        for wrapper in reversed(wrapped):
+            wrapper.__exit__(None, None, None)
+
+
+def get_budget(key):
+    """QUERY_BUDGETS[key] as a dict, a bare number is a query count."""
+    budget = getattr(settings, "QUERY_BUDGETS", {}).get(key)
+    if budget is None:
+        return {}
+    return dict(budget) if isinstance(budget, dict) else {"queries": budget}
+
+
+def over_budget(budget, recorder, ms):
+    """The budget limits `recorder` went past, as readable strings."""
+    failures = []
+    if budget.get("queries") is not None and recorder.count > budget["queries"]:
+        failures.append(f"{recorder.count} queries > {budget['queries']}")
+    if budget.get("duplicates") is not None and recorder.duplicates > budget["duplicates"]:
+        failures.append(f"{recorder.duplicates} duplicate queries > {budget['duplicates']}")
+    if budget.get("similar") is not None and recorder.similar > budget["similar"]:
+        failures.append(f"{recorder.similar} repeated statements > {budget['similar']}")
+    if budget.get("ms") is not None and ms > budget["ms"]:
+        failures.append(f"{ms:.1f}ms > {budget['ms']}ms")
+    return failures
+
+
+class BudgetStats:
+    """Per view action totals since the process started, for the summary report."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.actions = {}
+
+    def add(self, key, recorder, ms, failed=False):
+        with self.lock:
+            row = self.actions.setdefault(
+                key, {"calls": 0, "queries": 0, "max_queries": 0, "duplicates": 0, "similar": 0, "ms": 0.0,
+                      "max_ms": 0.0, "over_budget": 0},
+            )
+            row["calls"] += 1
+            row["queries"] += recorder.count
+            row["max_queries"] = max(row["max_queries"], recorder.count)
+            row["duplicates"] += recorder.duplicates
+            row["similar"] += recorder.similar
+            row["ms"] += ms
+            row["max_ms"] = max(row["max_ms"], ms)
+            row["over_budget"] += failed
+
+    def report(self):
+        with self.lock:
+            rows = sorted(self.actions.items(), key=lambda item: -item[1]["queries"] / item[1]["calls"])
+        lines = [f"{'action':<40} {'calls':>6} {'avg q':>6} {'max q':>6} {'dup':>5} {'similar':>7} {'avg ms':>8} {'max ms':>8} {'over':>5}"]
+        for key, row in rows:
+            lines.append(
+                f"{key:<40} {row['calls']:>6} {row['queries'] / row['calls']:>6.1f} {row['max_queries']:>6} "
+                f"{row['duplicates']:>5} {row['similar']:>7} {row['ms'] / row['calls']:>8.1f} {row['max_ms']:>8.1f} "
+                f"{row['over_budget']:>5}"
+            )
+        return "\n".join(lines)
+
+    def clear(self):
+        with self.lock:
+            self.actions.clear()
+
+
+stats = BudgetStats()
+
+
+def action_key(request):
+    """"<url name> <METHOD>", e.g. "message-list GET", for budgets and the report."""
+    match = getattr(request, "resolver_match", None)
+    return f"{match.view_name if match else request.path} {request.method}"
+
+
+class QueryBudgetMiddleware:
+    """
+    Counts queries, duplicate queries and wall time per request, adds them
+    as X-Query-* response headers, and logs a warning when a view action
+    goes over its QUERY_BUDGETS entry. Off unless QUERY_BUDGET_ENABLED.
+    Async-capable, so async views are not pushed back onto a thread.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, "QUERY_BUDGET_ENABLED", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with recorder.record():
+            response = self.get_response(request)
+        return self.finish(request, response, recorder, started)
+
+    async def __acall__(self, request):
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with recorder.record():
+            response = await self.get_response(request)
+        return self.finish(request, response, recorder, started)
+
+    def finish(self, request, response, recorder, started):
+        ms = (time.perf_counter() - started) * 1000
+
+        key = action_key(request)
+        failures = over_budget(get_budget(key), recorder, ms)
+        stats.add(key, recorder, ms, failed=bool(failures))
+        if failures:
+            logger.warning(
+                "%s over budget: %s; repeated: %s", key, ", ".join(failures),
+                "; ".join(f"{n}x {sql[:120]}" for sql, n in recorder.repeated()[:3]) or "none",
+            )
+
+        response["X-Query-Count"] = str(recorder.count)
+        response["X-Query-Duplicates"] = str(recorder.duplicates)
+        response["X-View-Time-Ms"] = f"{ms:.1f}"
+        return response
+
+
+class QueryBudgetTestMixin:
+    """
+    TestCase mixin. `with self.assertQueryBudget("message-list GET"):` fails
+    the test when the block goes over that action's QUERY_BUDGETS entry,
+    listing the repeated statements; limits can also be passed directly.
+    Every block is added to `stats`, whose report is logged after the class.
+    """
+
+    @contextmanager
+    def assertQueryBudget(self, key=None, queries=None, duplicates=None, similar=None, ms=None):
+        budget = get_budget(key) if key else {}
+        budget.update({
+            name: value for name, value in
+            (("queries", queries), ("duplicates", duplicates), ("similar", similar), ("ms", ms))
+            if value is not None
+        })
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with recorder.record():
+            yield recorder
+        elapsed = (time.perf_counter() - started) * 1000
+
+        failures = over_budget(budget, recorder, elapsed)
+        stats.add(key or self.id(), recorder, elapsed, failed=bool(failures))
+        if failures:
+            repeated = "\n".join(f"  {n}x {sql}" for sql, n in recorder.repeated())
+            self.fail(f"{key or 'block'} over budget: {', '.join(failures)}\n{repeated}")
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        logger.info("query budgets after %s:\n%s", cls.__name__, stats.report())
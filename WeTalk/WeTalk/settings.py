@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'WeTalk.querybudget.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -130,11 +131,18 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 
+# one Redis host; talk.layers.ShardedChannelLayer spreads groups and channels over several.
+# HybridChannelLayer delivers to members in the same process itself and uses Redis for the rest
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "talk.layers.HybridChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+            "remote": {
+                "BACKEND": "channels_redis.core.RedisChannelLayer",
+                "CONFIG": {
+                    "hosts": [("127.0.0.1", 6379)],
+                },
+            },
         },
     },
 }
@@ -175,4 +183,64 @@ CELERY_TASK_DEFAULT_QUEUE = "default"
 
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 EMAIL_HOST = "localhost"
-EMAIL_PORT = 1025
\ No newline at end of file
+EMAIL_PORT = 1025
+
+# --- WeTalk chat ---
+WETALK_HISTORY_PAGE_SIZE = 50              # messages per history frame / API page
+WETALK_RESUME_MAX_MESSAGES = 500           # missed messages sent on resume, further behind gets the latest page
+
+WETALK_DB_EXECUTOR_SIZE = 1                # threads (and connections) for sockets' sync database work, SQLite has one writer; 0 uses Channels'
+
+WETALK_WRITE_BEHIND = False                # broadcast first, insert messages in batches
+WETALK_WRITE_BEHIND_FLUSH_MS = 50          # max time a message waits in the buffer
+WETALK_WRITE_BEHIND_BATCH_SIZE = 200       # flush early once this many are pending
+
+WETALK_JWT_CACHE_SIZE = 10000              # decoded socket tokens kept per process
+WETALK_JWT_CACHE_TTL = 300                 # seconds, also capped by the token's exp
+WETALK_ROOM_CACHE_SIZE = 10000             # (user, peer) -> room entries kept per process for reconnects
+WETALK_ROOM_CACHE_TTL = 300                # seconds another process's rename or delete can go unseen
+
+WETALK_PRESENCE_SNAPSHOT_INTERVAL = 30     # seconds between ActiveConnection refreshes
+
+WETALK_HEARTBEAT_INTERVAL = 25             # seconds between server pings
+WETALK_HEARTBEAT_TIMEOUT = 60              # close sockets silent for this long
+WETALK_IDLE_TIMEOUT = 1800                 # close sockets that only pong for this long, 0 disables
+
+WETALK_READ_RECEIPT_WINDOW_MS = 250        # read acks per room are merged over this window
+
+WETALK_FAST_JSON = True                    # encode frames with orjson when it is installed
+
+WETALK_OUTBOUND_QUEUE_SIZE = 256           # frames buffered per socket for clients that read slowly
+WETALK_OUTBOUND_POLICY = "coalesce"        # coalesce, drop_oldest or disconnect when the queue is full
+
+WETALK_RATE_LIMIT_USER = (5, 20)           # socket messages per second and burst per user, None disables
+WETALK_RATE_LIMIT_ROOM = (20, 60)          # the same per room
+WETALK_RATE_LIMIT_STORE = "local"          # "local" per process, or "cache[:<alias>]" to share buckets
+
+WETALK_SEARCH_BACKEND = None               # dotted path, None picks SQLite FTS5 or a plain scan by database
+WETALK_SEARCH_WINDOW = 1000                # newest matches ranked per search
+WETALK_SEARCH_COMMON_WORD = 0.05           # words in more of the newest messages than this are checked on the text
+WETALK_SEARCH_SAMPLE = 10000               # newest messages that share is measured on
+
+WETALK_ARCHIVE_DIR = BASE_DIR / "archive"  # per-room segment files of archived messages
+WETALK_ARCHIVE_AFTER_DAYS = 180            # messages older than this leave talk_message
+WETALK_ARCHIVE_BLOCK_MESSAGES = 500        # messages per compressed block
+WETALK_ARCHIVE_SEGMENT_BYTES = 16 * 1024 * 1024  # a room starts a new segment file past this size
+WETALK_ARCHIVE_OPEN_SEGMENTS = 64          # segment files kept memory-mapped, each holds a file descriptor
+
+WETALK_CONTACT_IMPORT_MAX = 1000           # usernames accepted per contact import request
+
+METRICS_TOKEN = None                       # bearer token required by /metrics, None leaves it open
+
+# --- Query budgets ---
+QUERY_BUDGET_ENABLED = DEBUG               # count queries per request, see WeTalk.querybudget
+QUERY_BUDGETS = {                          # "<url name> <METHOD>": max queries, or a dict of queries/duplicates/similar/ms
+    # every count includes the user JWTAuthentication loads for the request
+    "contact-list GET": {"queries": 2, "similar": 0},
+    "contact-list POST": 6,                # the contact lookup, the INSERT and its savepoint, rolled back on a duplicate
+    "contact-import-contacts POST": 4,     # users, already added, bulk INSERT
+    "chatroom-list GET": {"queries": 2, "similar": 0},
+    "chatroom-inbox GET": {"queries": 2, "similar": 0},
+    "message-list GET": {"queries": 4, "similar": 0},  # a page that runs into the archive also checks the room and loads its senders
+    "message-search GET": 7,               # the common-word sampling runs one count per term
+}
@@ -17,8 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path,include
 
+from talk.metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('wetalk/', include('talk.urls')),
     path('users/', include('users.urls')),
+    path('metrics', metrics_view),
 ]
@@ -6,4 +6,4 @@ class TalkConfig(AppConfig):
     name = 'talk'
 
     def ready(self):
-        import talk.signals
\ No newline at end of file
+        import talk.signals
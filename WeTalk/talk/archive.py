@@ -0,0 +1,261 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import User, Message
+
+# one record per block: segment, offset, length, count, first (time_stamp, id), last (time_stamp, id)
+INDEX_RECORD = struct.Struct("<IQIIqqqq")
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+FIELDS = ("id", "sender_id", "time_stamp", "is_read", "text")
+
+
+def to_micros(time_stamp):
+    return (time_stamp - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def archive_age():
+    return timedelta(days=getattr(settings, "WETALK_ARCHIVE_AFTER_DAYS", 180))
+
+
+class SegmentMaps:
+    """
+    Memory maps of recently read segment files, shared by every room. Each
+    map keeps a file descriptor open, so there are at most
+    WETALK_ARCHIVE_OPEN_SEGMENTS of them and the least recently read one is
+    closed to make room. Reads copy their bytes out under the lock, so a map
+    is never closed under a reader.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.maps = OrderedDict()
+
+    @property
+    def maxsize(self):
+        return getattr(settings, "WETALK_ARCHIVE_OPEN_SEGMENTS", 64)
+
+    def read(self, path, offset, length):
+        size = path.stat().st_size
+        with self.lock:
+            cached = self.maps.pop(path, None)
+            if cached is not None and cached[0] != size:
+                # appended to since it was mapped
+                cached[1].close()
+                cached = None
+            if cached is None:
+                with open(path, "rb") as f:
+                    cached = (size, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            self.maps[path] = cached
+            while len(self.maps) > self.maxsize:
+                _, (_, evicted) = self.maps.popitem(last=False)
+                evicted.close()
+            return cached[1][offset:offset + length]
+
+    def clear(self):
+        with self.lock:
+            for _, segment_map in self.maps.values():
+                segment_map.close()
+            self.maps.clear()
+
+
+segment_maps = SegmentMaps()
+
+
+class RoomArchive:
+    """
+    Archived messages of one room: append-only segment files of zlib
+    compressed blocks, and an index holding one fixed-size record per block.
+    Blocks are written in (time_stamp, id) order, so a history page is a
+    bisect in the index and one or two block reads from a memory map.
+
+    A block is synced to its segment before the index points at it, a crash
+    in between leaves unreferenced bytes and nothing else.
+    """
+
+    def __init__(self, path, segment_bytes):
+        self.path = path
+        self.index_path = path / "index"
+        self.segment_bytes = segment_bytes
+        self._index = ([], -1)
+
+    def index(self):
+        try:
+            size = self.index_path.stat().st_size
+        except FileNotFoundError:
+            return []
+        if size != self._index[1]:
+            data = self.index_path.read_bytes()
+            # a torn record from a crash mid-append is not part of the index
+            data = data[:len(data) - len(data) % INDEX_RECORD.size]
+            self._index = (list(INDEX_RECORD.iter_unpack(data)), size)
+        return self._index[0]
+
+    def last_key(self):
+        index = self.index()
+        return (index[-1][6], index[-1][7]) if index else None
+
+    def segment_path(self, segment):
+        return self.path / f"{segment:06d}.seg"
+
+    def append(self, rows):
+        """Write (id, sender_id, time_stamp, is_read, text) rows, oldest first, as one block."""
+        payload = zlib.compress(json.dumps(
+            [[id, sender_id, to_micros(time_stamp), is_read, text] for id, sender_id, time_stamp, is_read, text in rows]
+        ).encode())
+        self.path.mkdir(parents=True, exist_ok=True)
+        index = self.index()
+
+        segment = index[-1][0] if index else 0
+        # the size counts any bytes of a block whose index record never made it
+        try:
+            offset = self.segment_path(segment).stat().st_size
+        except FileNotFoundError:
+            offset = 0
+        if offset and offset + len(payload) > self.segment_bytes:
+            segment, offset = segment + 1, 0
+
+        with open(self.segment_path(segment), "ab") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+        first, last = rows[0], rows[-1]
+        record = INDEX_RECORD.pack(
+            segment, offset, len(payload), len(rows),
+            to_micros(first[2]), first[0], to_micros(last[2]), last[0],
+        )
+        with open(self.index_path, "ab") as f:
+            f.truncate(len(index) * INDEX_RECORD.size)
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read_block(self, record):
+        segment, offset, length = record[:3]
+        data = segment_maps.read(self.segment_path(segment), offset, length)
+        return [
+            (id, sender_id, from_micros(micros), is_read, text)
+            for id, sender_id, micros, is_read, text in json.loads(zlib.decompress(data))
+        ]
+
+    def page(self, before=None, limit=50):
+        """Up to `limit` rows older than the (time_stamp, id) key `before`, newest first."""
+        index = self.index()
+        end = len(index)
+        if before is not None:
+            before = (to_micros(before[0]), before[1])
+            # blocks starting at or after the cursor hold nothing older than it
+            end = bisect_left(index, before, key=lambda record: (record[4], record[5]))
+
+        rows = []
+        for record in reversed(index[:end]):
+            block = self.read_block(record)
+            if before is not None:
+                block = [row for row in block if (to_micros(row[2]), row[0]) < before]
+            rows.extend(reversed(block))
+            if len(rows) >= limit:
+                break
+        return rows[:limit]
+
+
+class MessageArchive:
+    """RoomArchive per room under WETALK_ARCHIVE_DIR, for the `max_rooms` most recently read."""
+
+    # each holds its room's index in memory, a dropped one is read back from disk
+    max_rooms = 1000
+
+    def __init__(self):
+        self.rooms = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def root(self):
+        return Path(getattr(settings, "WETALK_ARCHIVE_DIR", settings.BASE_DIR / "archive"))
+
+    def room(self, room_id):
+        path = self.root / f"room_{room_id}"
+        with self.lock:
+            if path not in self.rooms:
+                self.rooms[path] = RoomArchive(path, getattr(settings, "WETALK_ARCHIVE_SEGMENT_BYTES", 16 * 1024 * 1024))
+                while len(self.rooms) > self.max_rooms:
+                    self.rooms.popitem(last=False)
+            self.rooms.move_to_end(path)
+            return self.rooms[path]
+
+
+archive = MessageArchive()
+
+
+def archived_values(room_id, before, limit):
+    """Archived rows shaped like fetch_history's values() rows, newest first."""
+    rows = archive.room(room_id).page(before, limit)
+    usernames = dict(User.objects.filter(id__in={row[1] for row in rows}).values_list("id", "username")) if rows else {}
+    return [
+        # the archive keeps no seqs, resume only reads the table
+        {"id": id, "seq": None, "sender__username": usernames.get(sender_id), "text": text, "time_stamp": time_stamp}
+        for id, sender_id, time_stamp, is_read, text in rows
+    ]
+
+
+def archived_messages(room_id, before, limit):
+    """Archived rows as unsaved Message instances with their senders, newest first."""
+    rows = archive.room(room_id).page(before, limit)
+    senders = User.objects.in_bulk({row[1] for row in rows}) if rows else {}
+    return [
+        Message(
+            id=id, chat_room_id=room_id, sender=senders.get(sender_id),
+            time_stamp=time_stamp, is_read=is_read, text=text,
+        )
+        for id, sender_id, time_stamp, is_read, text in rows
+    ]
+
+
+def archive_room(room_id, cutoff, block_size=None):
+    """Move one room's messages older than `cutoff` into its archive, returns how many."""
+    block_size = block_size or getattr(settings, "WETALK_ARCHIVE_BLOCK_MESSAGES", 500)
+    room = archive.room(room_id)
+    last = room.last_key()
+    moved = 0
+    while True:
+        rows = list(
+            Message.objects.filter(chat_room_id=room_id, time_stamp__lt=cutoff)
+            .order_by("time_stamp", "id")
+            .values_list(*FIELDS)[:block_size]
+        )
+        if not rows:
+            return moved
+        # rows archived by a run that stopped before deleting them are only deleted
+        fresh = [row for row in rows if last is None or (to_micros(row[2]), row[0]) > last]
+        if fresh:
+            room.append(fresh)
+            last = (to_micros(fresh[-1][2]), fresh[-1][0])
+            moved += len(fresh)
+        with transaction.atomic():
+            Message.objects.filter(id__in=[row[0] for row in rows]).delete()
+
+
+def archive_messages(age=None):
+    """
+    Move every message older than `age` (WETALK_ARCHIVE_AFTER_DAYS by default)
+    out of talk_message. Archived messages leave the search index with the rows.
+    Runs must not overlap, it is scheduled once a day.
+    """
+    cutoff = timezone.now() - (age if age is not None else archive_age())
+    room_ids = Message.objects.filter(time_stamp__lt=cutoff).values_list("chat_room_id", flat=True).distinct()
+    return sum(archive_room(room_id, cutoff) for room_id in list(room_ids))
@@ -0,0 +1,39 @@
+import asyncio
+
+
+class PeriodicFlusher:
+    """
+    Base for per-process state that is written back from a task on the running
+    event loop. Subclasses implement flush() and flush_interval, call
+    start_flusher() whenever they receive work and wake_flusher() to flush early.
+    """
+    flush_interval = 1.0
+
+    def __init__(self):
+        self._loop = None
+        self._wakeup = None
+        self._flusher = None
+
+    async def flush(self):
+        raise NotImplementedError
+
+    def start_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and not self._flusher.done():
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._flusher = loop.create_task(self._run())
+
+    def wake_flusher(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
@@ -1,15 +1,61 @@
+import asyncio
 import json
+import time
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
-from .models import ChatRoom, Message, ActiveConnection
-from django.db import models
-from django.utils import timezone
+from channels.consumer import get_handler_name
+from .metrics import MetricsConsumerMixin, database_sync_to_async
+from .models import Message
+from .encoding import MSGPACK_SUBPROTOCOL, dumps, encode_frames, negotiate_subprotocol, pack, unpack
+from .events import dispatch_message, room_group_name
+from .heartbeat import heartbeat
+from .history import fetch_history, fetch_since, get_page_size
+from .outbound import CLOSE_SLOW_CONSUMER, OutboundQueue
+from .presence import presence
+from .ratelimit import rate_limiter
+from .receipts import read_receipts
+from .rooms import cached_room, resolve_room
+from .writebehind import message_buffer, write_behind_enabled
+
+PING_EVENT = encode_frames({"type": "ping"})
+
+
+def parse_seq(value):
+    # a seq the client says it saw, None unless it is a whole number
+    if isinstance(value, bool) or not isinstance(value, (str, int)):
+        return None
+    try:
+        seq = int(value)
+    except ValueError:
+        return None
+    return seq if seq >= 0 else None
+
+
+def history_entries(rows):
+    return [
+        {
+            "id": row["id"],
+            "seq": row["seq"],
+            "sender": row["sender__username"],
+            "message": row["text"],
+            "timestamp": row["time_stamp"].isoformat(),
+        }
+        for row in rows
+    ]
+
+
+class ChatConsumer(MetricsConsumerMixin, AsyncWebsocketConsumer):
+    binary = False
+
+    async def dispatch(self, message):
+        # Channels closes old connections before every handler, a hop to the sync thread for each
+        # frame and group event. Only connect uses the async ORM, later database work runs on the
+        # database executor, which looks after its own connections.
+        handler = getattr(self, get_handler_name(message), None)
+        if handler is None or message["type"] == "websocket.connect":
+            return await super().dispatch(message)
+        await handler(message)
 
-User = get_user_model()
-
-
-class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
         if not self.user or self.user.is_anonymous:
@@ -17,123 +63,179 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         self.other_username = self.scope["url_route"]["kwargs"]["username"]
-        self.other_user = await self.get_user(self.other_username)
-        if not self.other_user:
+
+        # Get or create chatroom; warm reconnects find it in the room cache and skip the DB
+        self.chatroom = cached_room(self.user, self.other_username) or await resolve_room(self.user, self.other_username)
+        if not self.chatroom:
             await self.close()
             return
 
-       
-
-        # Get or create chatroom
-        self.chatroom = await self.get_or_create_room(self.user, self.other_user)
-        self.room_group_name = f"chat_{self.chatroom.id}"
+        self.room_group_name = room_group_name(self.chatroom.id)
 
         # Add to the group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.add_active_connection(self.user, self.room_group_name)
-
-        await self.accept()
+        presence.connect(self.user.id, self.room_group_name)
+        self.joined = True
+
+        # MessagePack when the client offers it, JSON text otherwise
+        subprotocol = negotiate_subprotocol(self.scope.get("subprotocols", []))
+        self.binary = subprotocol == MSGPACK_SUBPROTOCOL
+        await self.accept(subprotocol=subprotocol)
+        # everything sent from here on goes through a bounded queue
+        self.outbound = OutboundQueue(self.send, self.evict)
+        heartbeat.register(self)
+
+        # Send the latest page of past messages, older pages are requested with "load_more".
+        # A reconnecting client passes ?resume_from=<last seq it saw> and only gets what it missed.
+        resume_from = parse_seq(parse_qs(self.scope.get("query_string", b"").decode()).get("resume_from", [""])[0])
+        if resume_from is None:
+            await self.send_history()
+        else:
+            await self.send_missed(resume_from)
 
-        # Send past messages
-        past_messages = await self.get_past_messages(self.chatroom.id)
-        for msg in past_messages:
-            await self.send(text_data=json.dumps({
-                "sender": msg["sender__username"],
-                "message": msg["text"],
-                "timestamp": msg["time_stamp"].isoformat(),
-            }))
-        
-        
 
     async def disconnect(self, close_code):
-        if hasattr(self, "room_group_name"):
-            await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await self.leave_room()
 
-    async def receive(self, text_data):
+    async def leave_room(self):
+        # runs from disconnect and from the heartbeat reaper, whichever comes first
+        if not getattr(self, "joined", False):
+            return
+        self.joined = False
+        heartbeat.unregister(self)
+        self.outbound.close()
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        presence.disconnect(self.user.id, self.room_group_name)
+
+    def send_payload(self, payload):
+        if self.binary:
+            self.outbound.put({"bytes_data": pack(payload)})
+        else:
+            self.outbound.put({"text_data": dumps(payload)})
+
+    def send_frame(self, event, key=None):
+        # forward a frame that was already encoded in both formats
+        if self.binary:
+            self.outbound.put({"bytes_data": event["frame_msgpack"]}, key)
+        else:
+            self.outbound.put({"text_data": event["frame"]}, key)
+
+    async def ping(self):
+        self.send_frame(PING_EVENT, key="ping")
+
+    async def reap(self, code):
+        await self.leave_room()
+        await self.close(code=code)
+
+    def evict(self):
+        # the client stopped reading and its queue overflowed
+        self.eviction = asyncio.ensure_future(self.reap(CLOSE_SLOW_CONSUMER))
+
+    async def receive(self, text_data=None, bytes_data=None):
+        self.last_seen = time.monotonic()
         try:
-            data = json.loads(text_data)
+            data = unpack(bytes_data) if bytes_data is not None else json.loads(text_data)
+
+            if data.get("command") == "pong":
+                return
+
+            self.last_active = self.last_seen
+            if data.get("command") == "load_more":
+                await self.send_history(before=data.get("cursor"))
+                return
+
+            if data.get("command") == "sync":
+                # the client saw a seq skipped in the live frames
+                after = parse_seq(data.get("after"))
+                if after is None:
+                    raise ValueError("sync needs the last seq received as 'after'")
+                await self.send_missed(after)
+                return
+
+            if data.get("command") == "mark_read":
+                read_receipts.add(self.chatroom, self.user, int(data["up_to"]))
+                return
+
             message = data.get("message", "").strip()
             if not message:
                 return
 
-            # Save message
-            msg_obj = await self.save_message(self.user.id, self.chatroom.id, message)
-            await self.update_connection_activity(self.user, self.room_group_name)
-
+            throttled = await rate_limiter.check(self.user.id, self.chatroom.id)
+            if throttled:
+                self.send_payload(throttled)
+                return
 
-            # Broadcast message to room
-            await self.channel_layer.group_send(self.room_group_name, {
-                "type": "chat.message",
-                "sender": self.user.username,
-                "message": msg_obj.text,
-                "timestamp": msg_obj.time_stamp.isoformat(),
-            })
+            # Save message, or hand it to the write-behind buffer and broadcast straight away
+            if write_behind_enabled():
+                msg_obj = message_buffer.add(self.user, self.chatroom.id, message)
+            else:
+                msg_obj = await self.save_message(self.user, self.chatroom.id, message)
+            presence.touch(self.user.id, self.room_group_name)
 
-            # Broadcast notification
-            await self.channel_layer.group_send(self.room_group_name, {
-                "type": "chat.notification",
-                "sender": self.user.username,
-                "notification": f"New message from {self.user.username}",
-                "chat_room": self.chatroom.id,
-            })
+            # Broadcast message and notification to the room as one event
+            await dispatch_message(msg_obj)
 
         except Exception as e:
-            await self.send(text_data=json.dumps({"error": str(e)}))
+            self.send_payload({"error": str(e)})
+
+    def pending_rows(self):
+        # messages still waiting in the write-behind buffer are newer than anything stored
+        if not write_behind_enabled():
+            return []
+        return [
+            {"id": None, "seq": None, "sender__username": msg.sender.username, "text": msg.text, "time_stamp": msg.time_stamp}
+            for msg in message_buffer.pending_for_room(self.chatroom.id)
+        ]
+
+    async def send_history(self, before=None):
+        # buffered messages can't be paged back to, so the first page makes room for all of them
+        pending = self.pending_rows() if before is None else []
+        limit = max(1, get_page_size() - len(pending))
+        messages, cursor = await self.get_past_messages(self.chatroom.id, before, limit)
+        messages += pending
+        self.send_payload({
+            "type": "history",
+            "messages": history_entries(messages),
+            "cursor": cursor,
+            "has_more": cursor is not None,
+        })
+
+    async def send_missed(self, after_seq):
+        """
+        The messages stored after seq `after_seq`, or the latest history page
+        when the client is too far behind for that to be worth it.
+        """
+        messages = await self.get_messages_since(self.chatroom.id, after_seq)
+        if messages is None:
+            await self.send_history()
+            return
+        self.send_payload({
+            "type": "missed",
+            "after_seq": after_seq,
+            "messages": history_entries(messages + self.pending_rows()),
+        })
 
+    # group events arrive with their frame already encoded by talk.events
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            "sender": event["sender"],
-            "message": event["message"],
-            "timestamp": event["timestamp"],
-        }))
-
-    async def chat_notification(self, event):
-        await self.send(text_data=json.dumps({
-            "type": "notification",
-            "sender": event["sender"],
-            "notification": event["notification"],
-            "chat_room": event["chat_room"],
-        }))
+        self.send_frame(event)
 
-    @database_sync_to_async
-    def get_user(self, username):
-        try:
-            return User.objects.get(username=username)
-        except User.DoesNotExist:
-            return None
-
-    @database_sync_to_async
-    def save_message(self, user_id, room_id, content):
-        user = User.objects.get(id=user_id)
-        room = ChatRoom.objects.get(id=room_id)
-        return Message.objects.create(sender=user, chat_room=room, text=content)
+    async def chat_seen(self, event):
+        # the reader already knows what it read
+        if event["reader"] == self.user.username:
+            return
+        # only the latest receipt per reader matters if the client falls behind
+        self.send_frame(event, key=("seen", event["reader"]))
 
+    # one transaction with the inbox update, which the async ORM can't do, so on the database executor
     @database_sync_to_async
-    def get_or_create_room(self, user1, user2):
-        # Enforce consistent order to avoid duplicate rooms
-        if user1.id > user2.id:
-            user1, user2 = user2, user1
-        room, created = ChatRoom.objects.get_or_create(user1=user1, user2=user2)
-        return room
+    def save_message(self, user, room_id, content):
+        return Message.objects.persist([Message(sender=user, chat_room_id=room_id, text=content)])[0]
 
+    # may read archive segment files as well
     @database_sync_to_async
-    def get_past_messages(self, room_id):
-        return list(
-            Message.objects.filter(chat_room_id=room_id)
-            .select_related("sender")
-            .values("sender__username", "text", "time_stamp")
-            .order_by("time_stamp")
-        )
+    def get_past_messages(self, room_id, before=None, limit=None):
+        return fetch_history(room_id, before=before, limit=limit)
 
     @database_sync_to_async
-    def add_active_connection(user, room_name):
-        obj, created = ActiveConnection.objects.update_or_create(
-            user=user,
-            room_name=room_name,
-            defaults={"last_active": timezone.now()},
-        )
-        return obj
-    
-    @database_sync_to_async
-    def update_connection_activity(user, room_name):
-        ActiveConnection.objects.filter(user=user, room_name=room_name).update(last_active=timezone.now())
\ No newline at end of file
+    def get_messages_since(self, room_id, after_seq):
+        return fetch_since(room_id, after_seq)
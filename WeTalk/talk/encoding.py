@@ -0,0 +1,51 @@
+import json
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# binary frames for clients that ask for them in Sec-WebSocket-Protocol
+MSGPACK_SUBPROTOCOL = "wetalk.msgpack"
+
+
+def json_backend():
+    if orjson is not None and getattr(settings, "WETALK_FAST_JSON", True):
+        return "orjson"
+    return "json"
+
+
+def dumps(payload):
+    """Text for one WebSocket frame, through orjson when it's installed and enabled."""
+    if json_backend() == "orjson":
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload)
+
+
+def negotiate_subprotocol(offered):
+    if msgpack is not None and MSGPACK_SUBPROTOCOL in offered:
+        return MSGPACK_SUBPROTOCOL
+    return None
+
+
+def pack(payload):
+    return msgpack.packb(payload)
+
+
+def unpack(data):
+    return msgpack.unpackb(data)
+
+
+def encode_frames(payload):
+    """Every wire form of a broadcast frame, each encoded once for the whole audience."""
+    frames = {"frame": dumps(payload)}
+    if msgpack is not None:
+        frames["frame_msgpack"] = pack(payload)
+    return frames
@@ -0,0 +1,52 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from .encoding import encode_frames
+from .metrics import group_send
+
+
+def room_group_name(room_id):
+    return f"chat_{room_id}"
+
+
+def message_event(message):
+    # one event carries both the message and its notification, so each
+    # recipient gets a single frame per message
+    sender = message.sender.username
+    frame = {
+        "type": "message",
+        "id": message.id,
+        # None while a write-behind message waits to be stored
+        "seq": message.seq,
+        "chat_room": message.chat_room_id,
+        "sender": sender,
+        "message": message.text,
+        "timestamp": message.time_stamp.isoformat(),
+        "notification": f"New message from {sender}",
+    }
+    # encoded once here instead of once per recipient in the consumers
+    return {"type": "chat.message", **encode_frames(frame)}
+
+
+async def dispatch_message(message):
+    """Fan a persisted (or write-behind buffered) message out to its room."""
+    channel_layer = get_channel_layer()
+    await group_send(channel_layer, room_group_name(message.chat_room_id), message_event(message))
+
+
+def dispatch_message_sync(message):
+    async_to_sync(dispatch_message)(message)
+
+
+async def dispatch_seen(room_id, reader, up_to):
+    """Tell the room that `reader` has read everything up to message `up_to`."""
+    channel_layer = get_channel_layer()
+    await group_send(channel_layer, room_group_name(room_id), {
+        "type": "chat.seen",
+        "reader": reader,
+        **encode_frames({"type": "seen", "chat_room": room_id, "reader": reader, "up_to": up_to}),
+    })
+
+
+def dispatch_seen_sync(room_id, reader, up_to):
+    async_to_sync(dispatch_seen)(room_id, reader, up_to)
@@ -0,0 +1,84 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import database_sync_to_async as channels_database_sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+from WeTalk.querybudget import active_recorder
+
+
+class DatabaseExecutor:
+    """
+    The thread pool that database work from the event loop runs on,
+    WETALK_DB_EXECUTOR_SIZE threads and so at most that many connections,
+    kept apart from the pool asgiref and the async ORM use. The default of
+    one thread suits SQLite's single writer, a server database can take
+    more. A thread keeps its connections between calls instead of closing
+    them around each one as Channels does, and only drops the ones a
+    database error broke.
+
+    With a size of 0 calls go through channels.db.database_sync_to_async,
+    which the tests need: their data is only visible to the test's own
+    connection.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.size = 0
+
+    def get_pool(self):
+        size = getattr(settings, "WETALK_DB_EXECUTOR_SIZE", 1)
+        if size != self.size:
+            with self.lock:
+                if size != self.size:
+                    old = self.pool
+                    self.pool = ThreadPoolExecutor(size, thread_name_prefix="wetalk-db") if size else None
+                    self.size = size
+                    if old is not None:
+                        old.shutdown(wait=False)
+        return self.pool
+
+    def stats(self):
+        pool = self.pool
+        if pool is None:
+            return {"size": 0, "threads": 0, "queued": 0}
+        return {"size": self.size, "threads": len(pool._threads), "queued": pool._work_queue.qsize()}
+
+
+db_executor = DatabaseExecutor()
+
+
+def run_pooled(func, args, kwargs):
+    recorder = active_recorder.get()
+    try:
+        if recorder is None:
+            return func(*args, **kwargs)
+        # a query budget is counting the request or block that submitted this call
+        with recorder.record():
+            return func(*args, **kwargs)
+    except DatabaseError:
+        for connection in connections.all(initialized_only=True):
+            if connection.connection is not None and not connection.is_usable():
+                connection.close()
+        raise
+
+
+def database_sync_to_async(func):
+    """Run the sync `func` on db_executor, awaitable from the event loop."""
+    fallback = channels_database_sync_to_async(lambda *args, **kwargs: run_pooled(func, args, kwargs))
+
+    @functools.wraps(func)
+    async def call(*args, **kwargs):
+        pool = db_executor.get_pool()
+        if pool is None:
+            return await fallback(*args, **kwargs)
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            pool, functools.partial(context.run, run_pooled, func, args, kwargs),
+        )
+    return call
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import time
+import weakref
+
+from django.conf import settings
+
+from .background import PeriodicFlusher
+
+logger = logging.getLogger(__name__)
+
+# close codes in the 4000-4999 range are free for applications
+CLOSE_HEARTBEAT_TIMEOUT = 4408
+CLOSE_IDLE = 4409
+
+
+class HeartbeatMonitor(PeriodicFlusher):
+    """
+    A single loop per process that pings every registered socket each
+    WETALK_HEARTBEAT_INTERVAL seconds. Sockets that have sent nothing for
+    WETALK_HEARTBEAT_TIMEOUT seconds, or nothing but pongs for
+    WETALK_IDLE_TIMEOUT seconds, are reaped: they leave their groups and
+    are closed.
+
+    Consumers expose `last_seen` and `last_active` (monotonic seconds) and
+    implement `ping()` and `reap(code)`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.consumers = weakref.WeakSet()
+        self.reaped = 0
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, "WETALK_HEARTBEAT_INTERVAL", 25)
+
+    @property
+    def timeout(self):
+        return getattr(settings, "WETALK_HEARTBEAT_TIMEOUT", 60)
+
+    @property
+    def idle_timeout(self):
+        return getattr(settings, "WETALK_IDLE_TIMEOUT", 1800)
+
+    def register(self, consumer):
+        consumer.last_seen = consumer.last_active = time.monotonic()
+        self.consumers.add(consumer)
+        self.start_flusher()
+
+    def unregister(self, consumer):
+        self.consumers.discard(consumer)
+
+    async def flush(self):
+        now = time.monotonic()
+        calls = []
+        for consumer in list(self.consumers):
+            if now - consumer.last_seen > self.timeout:
+                calls.append(self._reap(consumer, CLOSE_HEARTBEAT_TIMEOUT))
+            elif self.idle_timeout and now - consumer.last_active > self.idle_timeout:
+                calls.append(self._reap(consumer, CLOSE_IDLE))
+            else:
+                calls.append(consumer.ping())
+
+        # one stalled socket must not hold up the sweep for everyone else
+        for result in await asyncio.gather(*calls, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.warning("Heartbeat to a socket failed: %r", result)
+
+    async def _reap(self, consumer, code):
+        self.unregister(consumer)
+        self.reaped += 1
+        await consumer.reap(code)
+
+
+heartbeat = HeartbeatMonitor()
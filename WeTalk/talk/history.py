@@ -0,0 +1,126 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+from .archive import archived_values
+from .metrics import database_sync_to_async
+from .models import ChatRoom, Message
+
+
+def get_page_size():
+    return getattr(settings, "WETALK_HISTORY_PAGE_SIZE", 50)
+
+
+def encode_cursor(time_stamp, message_id):
+    raw = f"{time_stamp.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        time_stamp, message_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(time_stamp), int(message_id)
+    except (AttributeError, ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError("Invalid cursor.")
+
+
+def row_key(row):
+    if isinstance(row, dict):
+        return row["time_stamp"], row["id"]
+    return row.time_stamp, row.id
+
+
+def keyset_page(queryset, before=None, limit=None, archived=None):
+    """
+    Return one page of messages, newest first, plus the cursor for the next
+    (older) page or None when the start of the history has been reached.
+
+    Pages are cut by the (time_stamp, id) keyset instead of an offset, so the
+    cost of a page does not depend on how far back it is. `queryset` may be a
+    model or a values() queryset as long as it yields time_stamp and id.
+
+    `archived(key, limit)` continues the history once the queryset runs out:
+    it returns up to `limit` rows older than the (time_stamp, id) key (None
+    for the newest), shaped like the queryset's rows, newest first.
+    """
+    limit = limit or get_page_size()
+    queryset, key = seek(queryset, before)
+    rows = list(queryset[:limit + 1])
+    if len(rows) <= limit and archived is not None:
+        rows += archived(row_key(rows[-1]) if rows else key, limit + 1 - len(rows))
+    return cut_page(rows, limit)
+
+
+async def akeyset_page(queryset, before=None, limit=None, archived=None):
+    """keyset_page from the event loop, on the database executor's threads. `archived` is a coroutine function here."""
+    limit = limit or get_page_size()
+    queryset, key = seek(queryset, before)
+    rows = await database_sync_to_async(list)(queryset[:limit + 1])
+    if len(rows) <= limit and archived is not None:
+        rows += await archived(row_key(rows[-1]) if rows else key, limit + 1 - len(rows))
+    return cut_page(rows, limit)
+
+
+def seek(queryset, before):
+    """`queryset` from the cursor `before` on, newest first, and the cursor's key."""
+    key = None
+    if before:
+        key = time_stamp, message_id = decode_cursor(before)
+        # the redundant time_stamp__lte bound lets the index seek straight to the cursor,
+        # the OR on its own makes SQLite walk the index from the newest row down
+        queryset = queryset.filter(
+            Q(time_stamp__lte=time_stamp),
+            Q(time_stamp__lt=time_stamp) | Q(id__lt=message_id),
+        )
+    return queryset.order_by("-time_stamp", "-id"), key
+
+
+def cut_page(rows, limit):
+    # one extra row tells us whether an older page exists
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not has_more:
+        return rows, None
+    return rows, encode_cursor(*row_key(rows[-1]))
+
+
+def fetch_history(room_id, before=None, limit=None):
+    """Like keyset_page, for one room, oldest first so it can be replayed in order."""
+    queryset = Message.objects.filter(chat_room_id=room_id).values(
+        "id", "seq", "sender__username", "text", "time_stamp"
+    )
+    rows, next_cursor = keyset_page(
+        queryset, before=before, limit=limit,
+        archived=lambda key, count: archived_values(room_id, key, count),
+    )
+    rows.reverse()
+    return rows, next_cursor
+
+
+def get_resume_limit():
+    return getattr(settings, "WETALK_RESUME_MAX_MESSAGES", 500)
+
+
+def fetch_since(room_id, after_seq, limit=None):
+    """
+    The room's messages after seq `after_seq`, oldest first, or None when
+    more than `limit` were missed, or some of them are no longer in the
+    table, and the latest page serves better.
+    """
+    limit = limit or get_resume_limit()
+    rows = list(
+        Message.objects.filter(chat_room_id=room_id, seq__gt=after_seq)
+        .order_by("seq")
+        .values("id", "seq", "sender__username", "text", "time_stamp")[:limit + 1]
+    )
+    if len(rows) > limit:
+        return None
+    # archived messages keep no seq, a gap in front means some went to the archive
+    if rows:
+        return rows if rows[0]["seq"] == after_seq + 1 else None
+    last_seq = ChatRoom.objects.filter(id=room_id).values_list("last_seq", flat=True).first() or 0
+    return rows if after_seq >= last_seq else None
@@ -0,0 +1,383 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import secrets
+from bisect import bisect
+from collections import defaultdict
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    """
+    Consistent hashing over named nodes, `vnodes` points per node. Adding a
+    node moves about 1/N of the keys onto it and leaves every other key
+    where it was.
+    """
+
+    def __init__(self, nodes, vnodes=160):
+        points = sorted(
+            (self.hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes)
+        )
+        self.points = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def node(self, key):
+        return self.nodes[bisect(self.points, self.hash(key)) % len(self.points)]
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    """
+    Spreads channels and groups over several child layers, usually one
+    RedisChannelLayer per Redis host, with a HashRing:
+
+        "BACKEND": "talk.layers.ShardedChannelLayer",
+        "CONFIG": {"shards": [
+            {"NAME": "redis-a", "BACKEND": "channels_redis.core.RedisChannelLayer",
+             "CONFIG": {"hosts": [("10.0.0.1", 6379)]}},
+            ...
+        ]},
+
+    A channel lives on its own shard and a group on its own; group_send
+    runs on the group's shard, so members get group messages there. Group
+    joins are made from the member's process, which therefore knows which
+    shards each of its channels has to listen on and receives from all of
+    them. Shards are placed on the ring by NAME (their CONFIG when
+    unnamed), so adding one keeps the others' keys in place.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, shards, vnodes=160, **kwargs):
+        super().__init__(**kwargs)
+        self.shards = {}
+        for shard in shards:
+            name = shard.get("NAME") or json.dumps(shard.get("CONFIG", {}), sort_keys=True, default=str)
+            if name in self.shards:
+                raise ValueError(f"Two channel layer shards are named {name!r}.")
+            self.shards[name] = import_string(shard["BACKEND"])(**shard.get("CONFIG", {}))
+        self.ring = HashRing(list(self.shards), vnodes)
+        # every child must accept the process-specific channel names any of them hands out
+        prefixes = {getattr(layer, "client_prefix", None) for layer in self.shards.values()}
+        if len(prefixes) > 1:
+            prefix = next(iter(self.shards.values())).client_prefix
+            for layer in self.shards.values():
+                layer.client_prefix = prefix
+        # for this process's channels: the groups they joined, and one task per shard
+        # they listen on, each moving what arrives there into the channel's inbox
+        self.groups = defaultdict(set)
+        self.pumps = defaultdict(dict)
+        self.inboxes = {}
+        self.joined = {}
+
+    def shard(self, name):
+        return self.ring.node(name)
+
+    def layer(self, name):
+        return self.shards[self.shard(name)]
+
+    def listening_on(self, channel):
+        return {self.shard(channel), *(self.shard(group) for group in self.groups.get(channel, ()))}
+
+    def listen(self, channel):
+        inbox = self.inboxes.get(channel)
+        if inbox is None:
+            inbox = self.inboxes[channel] = asyncio.Queue()
+        pumps = self.pumps[channel]
+        for name in self.listening_on(channel) - pumps.keys():
+            pumps[name] = asyncio.ensure_future(self.pump(name, channel, inbox))
+        return inbox
+
+    async def pump(self, name, channel, inbox):
+        try:
+            while True:
+                inbox.put_nowait((True, await self.shards[name].receive(channel)))
+        except Exception as e:
+            inbox.put_nowait((False, e))
+            # the next receive() starts a new one
+            if self.pumps.get(channel, {}).get(name) is asyncio.current_task():
+                del self.pumps[channel][name]
+
+    def stop(self, channel, keep=()):
+        pumps = self.pumps.get(channel, {})
+        for name in set(pumps) - set(keep):
+            pumps.pop(name).cancel()
+        if not pumps:
+            self.pumps.pop(channel, None)
+            if channel in self.inboxes and self.inboxes[channel].empty():
+                del self.inboxes[channel]
+
+    async def send(self, channel, message):
+        await self.layer(channel).send(channel, message)
+
+    async def new_channel(self, prefix="specific"):
+        return await next(iter(self.shards.values())).new_channel(prefix)
+
+    async def receive(self, channel):
+        if len(self.shards) == 1:
+            return await self.layer(channel).receive(channel)
+        inbox = self.inboxes.get(channel)
+        if channel not in self.groups and inbox is not None and not self.pumps.get(channel):
+            # left over from before the channel left its last group
+            ok, value = inbox.get_nowait()
+            if inbox.empty():
+                del self.inboxes[channel]
+            if not ok:
+                raise value
+            return value
+        if channel not in self.groups:
+            # in no group, so only its own shard, until a join wakes us up; nothing is
+            # left running for channels that never join one, like refused sockets
+            joined = self.joined[channel] = asyncio.get_running_loop().create_future()
+            receive = asyncio.ensure_future(self.layer(channel).receive(channel))
+            try:
+                await asyncio.wait([receive, joined], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if self.joined.get(channel) is joined:
+                    del self.joined[channel]
+                if not receive.done():
+                    receive.cancel()
+            if receive.done():
+                return receive.result()
+
+        ok, value = await self.listen(channel).get()
+        if not ok:
+            raise value
+        return value
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        await self.layer(group).group_add(group, channel)
+        self.groups[channel].add(group)
+        if channel in self.pumps:
+            self.listen(channel)
+        elif channel in self.joined and not self.joined[channel].done():
+            self.joined[channel].set_result(None)
+
+    async def group_discard(self, group, channel):
+        await self.layer(group).group_discard(group, channel)
+        groups = self.groups.get(channel)
+        if groups is None:
+            return
+        groups.discard(group)
+        if groups:
+            self.stop(channel, keep=self.listening_on(channel))
+        else:
+            # left its last group, usually on disconnect
+            del self.groups[channel]
+            self.stop(channel)
+
+    async def group_send(self, group, message):
+        await self.layer(group).group_send(group, message)
+
+    async def flush(self):
+        for channel in list(self.pumps):
+            self.stop(channel)
+        self.groups.clear()
+        self.inboxes.clear()
+        await asyncio.gather(*(layer.flush() for layer in self.shards.values()))
+
+    async def close_pools(self):
+        await asyncio.gather(*(
+            layer.close_pools() for layer in self.shards.values() if hasattr(layer, "close_pools")
+        ))
+
+
+# keys a HybridChannelLayer adds to the group messages it sends through the remote layer
+ORIGIN_KEY = "__hybrid_origin__"
+GROUP_KEY = "__hybrid_group__"
+# put in an inbox when its channel leaves its last group
+LEFT = object()
+
+
+class HybridChannelLayer(BaseChannelLayer):
+    """
+    Delivers group messages to members in this process directly and uses
+    the remote layer only to reach other processes:
+
+        "BACKEND": "talk.layers.HybridChannelLayer",
+        "CONFIG": {"remote": {"BACKEND": "channels_redis.core.RedisChannelLayer", "CONFIG": {...}}},
+
+    Remote groups hold one channel per process (its "node") instead of one
+    per member. group_send hands the message to local members, then sends
+    it once to every node in the group, which passes it on to its own
+    members and drops the copy that came back to the sender. A 1:1 room
+    with both sockets on one worker costs one remote push instead of two,
+    and neither member waits for it.
+
+    Joins still go to the remote layer before group_add returns, so a
+    group_send from any process after that reaches the new member. Direct
+    sends to a channel in a local group skip the remote layer; those from
+    other processes are received from it as usual. Messages still queued
+    for a channel when it leaves its last group are dropped.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, remote, node_capacity=10000, **kwargs):
+        super().__init__(**kwargs)
+        self.remote = import_string(remote["BACKEND"])(**remote.get("CONFIG", {}))
+        # a node channel carries the group traffic of a whole process
+        capacities = self.remote.channel_capacity
+        if isinstance(capacities, dict):
+            # the in-memory layer keeps the setting as given
+            capacities = self.remote.compile_capacities(capacities)
+        self.remote.channel_capacity = [(re.compile(r"hybrid\."), node_capacity), *capacities]
+        self.origin = secrets.token_hex(8)
+        self.reset()
+
+    def reset(self):
+        self.loop = None
+        self.node = None
+        self.node_pump = None
+        # group -> local channels in it, local channel -> its groups
+        self.members = defaultdict(set)
+        self.groups = defaultdict(set)
+        # channels in a group read their inbox, filled locally and by a pump from the remote layer
+        self.inboxes = {}
+        self.pumps = {}
+        self.joined = {}
+
+    def on_loop(self):
+        """Whether the local state belongs to the running event loop."""
+        try:
+            return self.loop is asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+
+    def adopt_loop(self):
+        if not self.on_loop():
+            # state from another event loop (tests, async_to_sync) is of no use here
+            for task in [self.node_pump, *self.pumps.values()]:
+                if task is not None:
+                    task.cancel()
+            self.reset()
+            self.loop = asyncio.get_running_loop()
+
+    async def start_node(self):
+        self.adopt_loop()
+        if self.node is None:
+            self.node = await self.remote.new_channel("hybrid")
+            self.node_pump = asyncio.ensure_future(self.pump_node())
+
+    async def pump_node(self):
+        while True:
+            try:
+                message = await self.remote.receive(self.node)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Receiving group messages for this process failed, retrying")
+                await asyncio.sleep(1)
+                continue
+            if message.pop(ORIGIN_KEY, None) == self.origin:
+                continue
+            for channel in self.members.get(message.pop(GROUP_KEY, None), ()):
+                self.deliver(channel, message)
+
+    async def pump(self, channel, inbox):
+        # direct sends from other processes
+        while True:
+            await inbox.put(await self.remote.receive(channel))
+
+    def deliver(self, channel, message):
+        inbox = self.inboxes.get(channel)
+        # a full channel drops group messages, as the other layers do
+        if inbox is None or inbox.qsize() >= self.get_capacity(channel):
+            return False
+        inbox.put_nowait(dict(message))
+        return True
+
+    async def send(self, channel, message):
+        if channel in self.inboxes and self.on_loop():
+            if not self.deliver(channel, message):
+                raise ChannelFull()
+            return
+        await self.remote.send(channel, message)
+
+    async def new_channel(self, prefix="specific"):
+        return await self.remote.new_channel(prefix)
+
+    async def receive(self, channel):
+        self.adopt_loop()
+        while True:
+            inbox = self.inboxes.get(channel)
+            if inbox is not None:
+                message = await inbox.get()
+                if message is not LEFT:
+                    return message
+                continue
+
+            # in no group: only the remote layer, until a join moves the channel to its inbox
+            joined = self.joined[channel] = asyncio.get_running_loop().create_future()
+            receive = asyncio.ensure_future(self.remote.receive(channel))
+            try:
+                await asyncio.wait([receive, joined], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                if self.joined.get(channel) is joined:
+                    del self.joined[channel]
+                if not receive.done():
+                    receive.cancel()
+            if receive.done():
+                return receive.result()
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        await self.start_node()
+        # refreshes the node's membership, which expires like any other
+        await self.remote.group_add(group, self.node)
+        self.members[group].add(channel)
+        self.groups[channel].add(group)
+        if channel not in self.inboxes:
+            inbox = self.inboxes[channel] = asyncio.Queue()
+            self.pumps[channel] = asyncio.ensure_future(self.pump(channel, inbox))
+            joined = self.joined.get(channel)
+            if joined is not None and not joined.done():
+                joined.set_result(None)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        if not self.on_loop():
+            return
+        members = self.members.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.members[group]
+                await self.remote.group_discard(group, self.node)
+        groups = self.groups.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.groups[channel]
+                self.pumps.pop(channel).cancel()
+                self.inboxes.pop(channel).put_nowait(LEFT)
+
+    async def group_send(self, group, message):
+        self.require_valid_group_name(group)
+        if self.on_loop():
+            for channel in self.members.get(group, ()):
+                self.deliver(channel, message)
+        await self.remote.group_send(group, {**message, ORIGIN_KEY: self.origin, GROUP_KEY: group})
+
+    async def flush(self):
+        if self.on_loop():
+            for task in [self.node_pump, *self.pumps.values()]:
+                if task is not None:
+                    task.cancel()
+        self.reset()
+        await self.remote.flush()
+
+    async def close_pools(self):
+        if hasattr(self.remote, "close_pools"):
+            await self.remote.close_pools()
@@ -0,0 +1,17 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from talk.archive import archive, archive_age, archive_messages
+
+
+class Command(BaseCommand):
+    help = "Move messages older than WETALK_ARCHIVE_AFTER_DAYS out of talk_message into per-room segment files."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=float, help="archive messages older than this many days instead")
+
+    def handle(self, *args, **options):
+        age = timedelta(days=options["days"]) if options["days"] is not None else archive_age()
+        moved = archive_messages(age)
+        self.stdout.write(f"Archived {moved} messages older than {age.days} days to {archive.root}")
@@ -0,0 +1,69 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from talk import encoding
+
+
+def frames(text_length):
+    now = timezone.now()
+    message = {
+        "type": "message", "id": 123456, "chat_room": 42, "sender": "alice",
+        "message": "x" * text_length, "timestamp": now.isoformat(),
+        "notification": "New message from alice",
+    }
+    history = {
+        "type": "history",
+        "messages": [
+            {"id": 123456 - i, "sender": "alice", "message": "x" * text_length, "timestamp": now.isoformat()}
+            for i in range(50)
+        ],
+        "cursor": "MjAyNi0wMS0wMVQwMDowMDowMCswMDowMHwxMjM0MDY=",
+        "has_more": True,
+    }
+    seen = {"type": "seen", "chat_room": 42, "reader": "bob", "up_to": 123456}
+    return {"message": message, "history(50)": history, "seen": seen}
+
+
+def codecs():
+    found = {"json": (lambda p: json.dumps(p).encode(), json.loads)}
+    if encoding.orjson is not None:
+        found["orjson"] = (encoding.orjson.dumps, encoding.orjson.loads)
+    if encoding.msgpack is not None:
+        found["msgpack"] = (encoding.msgpack.packb, encoding.msgpack.unpackb)
+    return found
+
+
+def per_call_us(func, arg, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        func(arg)
+    return (time.perf_counter() - started) / count * 1e6
+
+
+class Command(BaseCommand):
+    help = "Bytes on the wire and encode/decode time per frame for the JSON and MessagePack subprotocols."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20000)
+        parser.add_argument("--text-length", type=int, default=40)
+
+    def handle(self, *args, **options):
+        available = codecs()
+        if "msgpack" not in available:
+            raise CommandError("msgpack is not installed, there is nothing to compare JSON against.")
+
+        for name, payload in frames(options["text_length"]).items():
+            self.stdout.write(f"{name}:")
+            baseline = None
+            for codec, (encode, decode) in available.items():
+                data = encode(payload)
+                baseline = baseline or len(data)
+                count = options["iterations"] // (10 if name.startswith("history") else 1)
+                self.stdout.write(
+                    f"  {codec:<8} {len(data):>6} bytes ({len(data) / baseline:.0%} of json)  "
+                    f"encode {per_call_us(encode, payload, count):6.2f} us  "
+                    f"decode {per_call_us(decode, data, count):6.2f} us"
+                )
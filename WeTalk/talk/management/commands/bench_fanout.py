@@ -0,0 +1,88 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from talk.consumers import ChatConsumer
+from talk.encoding import json_backend
+from talk.events import message_event
+from talk.outbound import OutboundQueue
+from talk.models import User, Message
+
+
+async def discard(**kwargs):
+    pass
+
+
+async def legacy_chat_message(consumer, event):
+    # the handler as it was before frames were pre-encoded: one dumps per recipient
+    await consumer.send(text_data=json.dumps({
+        "type": "message",
+        "id": event["id"],
+        "chat_room": event["chat_room"],
+        "sender": event["sender"],
+        "message": event["message"],
+        "timestamp": event["timestamp"],
+        "notification": event["notification"],
+    }))
+
+
+class Command(BaseCommand):
+    help = "Compare per-recipient CPU for a room broadcast with per-recipient and encode-once frames."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--audiences", default="2,50,500")
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument("--text-length", type=int, default=200)
+
+    def handle(self, *args, **options):
+        message = Message(
+            id=1, chat_room_id=1, sender=User(username="alice"),
+            text="x" * options["text_length"], time_stamp=timezone.now(),
+        )
+        self.stdout.write(f"JSON backend: {json_backend()}, {options['messages']} messages per run")
+
+        for audience in (int(n) for n in options["audiences"].split(",")):
+            consumers = []
+            for _ in range(audience):
+                consumer = ChatConsumer()
+                consumer.send = discard
+                consumer.outbound = OutboundQueue(discard, lambda: None, limit=1, policy="drop_oldest")
+                consumer.user = SimpleNamespace(username="bob")
+                consumers.append(consumer)
+
+            before = asyncio.run(self.per_recipient(message, consumers, options["messages"]))
+            after = asyncio.run(self.encode_once(message, consumers, options["messages"]))
+            deliveries = audience * options["messages"]
+            self.stdout.write(
+                f"{audience:>4} subscribers: per-recipient encode {before / deliveries * 1e6:.2f} us/recipient, "
+                f"encode once {after / deliveries * 1e6:.2f} us/recipient ({before / after:.1f}x)"
+            )
+
+    async def per_recipient(self, message, consumers, count):
+        sender = message.sender.username
+        started = time.process_time()
+        for _ in range(count):
+            event = {
+                "type": "chat.message",
+                "id": message.id,
+                "chat_room": message.chat_room_id,
+                "sender": sender,
+                "message": message.text,
+                "timestamp": message.time_stamp.isoformat(),
+                "notification": f"New message from {sender}",
+            }
+            for consumer in consumers:
+                await legacy_chat_message(consumer, event)
+        return time.process_time() - started
+
+    async def encode_once(self, message, consumers, count):
+        started = time.process_time()
+        for _ in range(count):
+            event = message_event(message)
+            for consumer in consumers:
+                await consumer.chat_message(event)
+        return time.process_time() - started
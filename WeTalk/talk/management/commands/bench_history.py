@@ -0,0 +1,103 @@
+import tempfile
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from talk.history import encode_cursor
+from talk.models import User, ChatRoom, Message
+from talk.views import MessageViewSet
+
+from ._bench import use_database, timed, summarize
+
+
+class Command(BaseCommand):
+    help = "Seed a scratch database with messages and time history pages deep into a room."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=10_000_000)
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--page-size", type=int, default=50)
+        parser.add_argument("--pages", default="1,100,1000,10000")
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--database", help="SQLite file to seed (reused if it already holds data)")
+
+    def handle(self, *args, **options):
+        path = options["database"] or Path(tempfile.gettempdir()) / "wetalk_bench_history.sqlite3"
+        use_database(path)
+
+        if not Message.objects.exists():
+            self.seed(options["messages"], options["rooms"])
+
+        room = ChatRoom.objects.order_by("id").first()
+        user = room.user1
+        room_size = Message.objects.filter(chat_room=room).count()
+        page_size = options["page_size"]
+        self.stdout.write(f"{path}: {room_size} messages in room {room.id}, page size {page_size}")
+
+        view = MessageViewSet.as_view({"get": "list"})
+        factory = APIRequestFactory()
+
+        for page in (int(p) for p in options["pages"].split(",")):
+            offset = (page - 1) * page_size
+            if offset >= room_size:
+                self.stdout.write(f"page {page}: room only has {room_size} messages, skipped")
+                continue
+
+            params = {"chat_room": room.id, "page_size": page_size}
+            if offset:
+                # the row just above the page is what the previous page's cursor points at
+                anchor = (
+                    Message.objects.filter(chat_room=room)
+                    .order_by("-time_stamp", "-id")
+                    .values("time_stamp", "id")[offset - 1]
+                )
+                params["cursor"] = encode_cursor(anchor["time_stamp"], anchor["id"])
+
+            def keyset():
+                request = factory.get("/wetalk/messages/", params, HTTP_HOST="localhost")
+                force_authenticate(request, user=user)
+                response = view(request)
+                assert response.status_code == 200 and len(response.data["results"]) == page_size
+
+            def offset_scan():
+                list(Message.objects.filter(chat_room=room).order_by("-time_stamp", "-id")[offset:offset + page_size])
+
+            self.stdout.write(
+                f"page {page:>6}: keyset API {summarize(timed(keyset, options['repeat']))}"
+                f"  offset query {summarize(timed(offset_scan, options['repeat']))}"
+            )
+
+        with connection.cursor() as cursor:
+            sql, sql_params = (
+                Message.objects.filter(chat_room=room).order_by("-time_stamp", "-id")[:page_size].query.sql_with_params()
+            )
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", sql_params)
+            self.stdout.write("plan: " + "; ".join(row[-1] for row in cursor.fetchall()))
+
+    def seed(self, total, rooms):
+        self.stdout.write(f"seeding {total} messages across {rooms} rooms...")
+        started = time.perf_counter()
+        # bulk_create skips the welcome-email signal
+        users = User.objects.bulk_create(
+            User(username=f"bench{i}", email=f"bench{i}@example.com") for i in range(rooms + 1)
+        )
+        room_ids = [ChatRoom.objects.create(user1=users[0], user2=users[i + 1]).id for i in range(rooms)]
+
+        start = timezone.now() - timedelta(seconds=total)
+        batch = 50_000
+        insert = "INSERT INTO talk_message (chat_room_id, sender_id, text, time_stamp, is_read) VALUES (%s, %s, %s, %s, %s)"
+        with transaction.atomic(), connection.cursor() as cursor:
+            for first in range(0, total, batch):
+                rows = []
+                for n in range(first, min(first + batch, total)):
+                    room_id = room_ids[n % rooms]
+                    sender_id = users[0].id if n % 2 else users[n % rooms + 1].id
+                    time_stamp = connection.ops.adapt_datetimefield_value(start + timedelta(seconds=n))
+                    rows.append((room_id, sender_id, f"message {n}", time_stamp, False))
+                cursor.executemany(insert, rows)
+        self.stdout.write(f"seeded in {time.perf_counter() - started:.1f}s")
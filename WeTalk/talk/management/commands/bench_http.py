@@ -0,0 +1,130 @@
+import asyncio
+import tempfile
+import time
+import types
+from pathlib import Path
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management.base import BaseCommand
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+from django.urls import include, path
+from rest_framework_simplejwt.tokens import AccessToken
+
+from talk.models import User, ChatRoom, Message
+from talk.urls import router
+
+from ._bench import use_database, percentile
+
+# the viewsets alone, as served before the async reads
+sync_urls = types.ModuleType("bench_http_sync_urls")
+sync_urls.urlpatterns = [path("wetalk/", include(router.urls))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Concurrent GETs of message history and the inbox through Django's ASGI handler, "
+        "served by the sync viewsets and by the async reads: requests/s, latency and database connections opened."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", default="1,10,50,200")
+        parser.add_argument("--requests", type=int, default=1000, help="per endpoint and concurrency")
+        parser.add_argument("--rooms", type=int, default=50)
+        parser.add_argument("--messages", type=int, default=100, help="per room")
+
+    def handle(self, *args, **options):
+        use_database(Path(tempfile.mkdtemp()) / "wetalk_bench_http.sqlite3")
+        room = self.seed(options["rooms"], options["messages"])
+        token = str(AccessToken.for_user(room.user1)).encode()
+        endpoints = {
+            "history": ("/wetalk/messages/", f"chat_room={room.id}"),
+            "inbox": ("/wetalk/chatrooms/inbox/", ""),
+        }
+
+        # the query budget middleware times every statement, keep that out of the numbers
+        with override_settings(QUERY_BUDGET_ENABLED=False):
+            for name, (url, query) in endpoints.items():
+                for concurrency in (int(n) for n in options["concurrency"].split(",")):
+                    for served, urlconf in (("sync", sync_urls), ("async", None)):
+                        with override_settings(**({"ROOT_URLCONF": urlconf} if urlconf else {})):
+                            result = asyncio.run(self.run(url, query, token, concurrency, options["requests"]))
+                        self.stdout.write(
+                            f"{name:<8} {served:<5} x{concurrency:<4} {result['rps']:>7,.0f} req/s  "
+                            f"p50 {result['p50_ms']:>7.1f} ms  p99 {result['p99_ms']:>7.1f} ms  "
+                            f"connections opened {result['connections']}"
+                        )
+
+    def seed(self, rooms, per_room):
+        # bulk_create skips the welcome-email signal
+        users = User.objects.bulk_create(
+            User(username=f"user{i}", email=f"user{i}@example.com") for i in range(rooms + 1)
+        )
+        owner = users[0]
+        chat_rooms = [ChatRoom.objects.create(user1=owner, user2=peer) for peer in users[1:]]
+        for chat_room in chat_rooms:
+            Message.objects.persist([
+                Message(chat_room=chat_room, sender=chat_room.user2, text=f"message {i}") for i in range(per_room)
+            ])
+        return chat_rooms[0]
+
+    async def run(self, url, query, token, concurrency, count):
+        app = ASGIHandler()
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": url, "raw_path": url.encode(), "query_string": query.encode(),
+            "root_path": "", "client": ("127.0.0.1", 0), "server": ("localhost", 80),
+            "headers": [(b"host", b"localhost"), (b"authorization", b"Bearer " + token)],
+        }
+        latencies = []
+        remaining = count
+        # Django's handler starts a thread per request either way, what differs is
+        # whether each request's thread opens its own connection for the view
+        connections = []
+
+        def opened(sender, connection, **kwargs):
+            connections.append(connection)
+
+        async def request():
+            body_sent = False
+            disconnected = asyncio.Event()
+            statuses = []
+
+            async def receive():
+                nonlocal body_sent
+                if not body_sent:
+                    body_sent = True
+                    return {"type": "http.request", "body": b"", "more_body": False}
+                await disconnected.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                if message["type"] == "http.response.start":
+                    statuses.append(message["status"])
+
+            started = time.perf_counter()
+            await app(dict(scope), receive, send)
+            latencies.append((time.perf_counter() - started) * 1000)
+            disconnected.set()
+            if statuses != [200]:
+                raise RuntimeError(f"GET {url} answered {statuses}")
+
+        async def client():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                await request()
+
+        connection_created.connect(opened)
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(client() for _ in range(concurrency)))
+        finally:
+            connection_created.disconnect(opened)
+        elapsed = time.perf_counter() - started
+        return {
+            "rps": count / elapsed,
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+            "connections": len(connections),
+        }
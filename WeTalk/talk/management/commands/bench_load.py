@@ -0,0 +1,353 @@
+import asyncio
+import gc
+import json
+import resource
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from talk.models import User
+from talk.rooms import room_cache
+from users.middleware import token_cache
+
+from ._bench import use_database, percentile
+
+
+
+class RemoteStandIn(InMemoryChannelLayer):
+    """
+    The in-memory layer in the place of Redis: counts the round trips made
+    to it and the messages pushed and popped, and can take `latency_us`
+    per round trip.
+    """
+
+    def __init__(self, latency_us=0, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency_us / 1e6
+        self.ops = Counter()
+        self.cleaned = 0
+
+    def _clean_expired(self):
+        # the in-memory layer scans every channel and group on each call, Redis expires keys itself
+        if time.monotonic() - self.cleaned > 1:
+            self.cleaned = time.monotonic()
+            super()._clean_expired()
+
+    async def trip(self, op):
+        self.ops[op] += 1
+        self.ops["round_trips"] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send(self, channel, message):
+        await self.trip("send")
+        self.ops["pushed"] += 1
+        await super().send(channel, message)
+
+    async def group_send(self, group, message):
+        # one round trip for the lot, like the Lua script channels_redis runs
+        await self.trip("group_send")
+        for channel in list(self.groups.get(group, ())):
+            self.ops["pushed"] += 1
+            try:
+                await super().send(channel, message)
+            except ChannelFull:
+                pass
+
+    async def receive(self, channel):
+        message = await super().receive(channel)
+        await self.trip("receive")
+        self.ops["popped"] += 1
+        return message
+
+    async def group_add(self, group, channel):
+        await self.trip("group_add")
+        await super().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await self.trip("group_discard")
+        await super().group_discard(group, channel)
+
+
+def channel_layers(layer, latency_us):
+    remote = {"BACKEND": f"{__name__}.RemoteStandIn", "CONFIG": {"latency_us": latency_us}}
+    if layer == "hybrid":
+        return {"default": {"BACKEND": "talk.layers.HybridChannelLayer", "CONFIG": {"remote": remote}}}
+    return {"default": remote}
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # peak rather than current, still fine for a growing process
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def latency_summary(samples):
+    if not samples:
+        return None
+    return {
+        "count": len(samples),
+        "p50_ms": round(percentile(samples, 50), 3),
+        "p95_ms": round(percentile(samples, 95), 3),
+        "p99_ms": round(percentile(samples, 99), 3),
+        "max_ms": round(max(samples), 3),
+    }
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Client:
+    """One simulated user: a socket to its peer's room and the frames it has seen."""
+
+    def __init__(self, application, user, peer, token):
+        self.user = user
+        self.application = application
+        self.path = f"/ws/chat/{peer.username}/"
+        self.headers = [(b"cookie", f"access={token}".encode())]
+        self.reopen()
+        self.latencies = []
+        self.received = 0
+        self.errors = 0
+        self.last_seq = None
+        self.history_bytes = 0
+
+    def reopen(self, resume=False):
+        path = self.path
+        if resume and self.last_seq is not None:
+            path += f"?resume_from={self.last_seq}"
+        self.communicator = WebsocketCommunicator(self.application, path, headers=self.headers)
+
+    def saw(self, messages):
+        seqs = [message["seq"] for message in messages if message.get("seq") is not None]
+        if seqs:
+            self.last_seq = max(seqs + [self.last_seq or 0])
+
+    async def connect(self):
+        started = time.perf_counter()
+        connected, _ = await self.communicator.connect(timeout=30)
+        accepted = time.perf_counter()
+        if not connected:
+            raise RuntimeError(f"{self.user.username} was refused")
+        history = await self.communicator.receive_from(timeout=30)  # history, or missed on a resume
+        self.history_bytes = len(history)
+        self.saw(json.loads(history)["messages"])
+        return (accepted - started) * 1000, (time.perf_counter() - started) * 1000
+
+    async def send(self, count, interval):
+        for _ in range(count):
+            # the send time rides in the text, the peer turns it into a latency
+            await self.communicator.send_to(text_data=json.dumps({"message": f"{time.perf_counter_ns()}"}))
+            await asyncio.sleep(interval)
+
+    async def listen(self, expected, timeout):
+        while self.received < expected:
+            try:
+                frame = json.loads(await self.communicator.receive_from(timeout=timeout))
+            except asyncio.TimeoutError:
+                return
+            if frame.get("type") == "message":
+                self.saw([frame])
+                if frame["sender"] != self.user.username:
+                    self.latencies.append((time.perf_counter_ns() - int(frame["message"])) / 1e6)
+                    self.received += 1
+            elif "error" in frame:
+                self.errors += 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive simulated users through ChatConsumer over WeTalk.asgi with an in-memory stand-in for Redis, "
+        "alone or behind HybridChannelLayer, and report cold connect and warm reconnect latency, message "
+        "latency, throughput, channel layer round trips and memory per connection as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=2000, help="simulated users, paired into rooms")
+        parser.add_argument("--messages", type=int, default=10, help="messages each user sends")
+        parser.add_argument("--interval", type=float, default=0.05, help="seconds between one user's messages")
+        parser.add_argument("--connect-concurrency", type=int, default=200)
+        parser.add_argument("--write-behind", action="store_true", help="run with WETALK_WRITE_BEHIND on")
+        parser.add_argument(
+            "--resume", action="store_true", help="reconnect with resume_from=<last seq seen> instead of a full history",
+        )
+        parser.add_argument(
+            "--layer", choices=("remote", "hybrid"), default="remote",
+            help="the Redis stand-in on its own, or behind HybridChannelLayer",
+        )
+        parser.add_argument(
+            "--remote-latency-us", type=int, default=0, help="time each round trip to the Redis stand-in takes",
+        )
+        parser.add_argument("--database", help="SQLite file to run against, a fresh scratch file by default")
+        parser.add_argument("--output", default="bench_load.json", help="where to write the JSON results")
+        parser.add_argument("--compare", help="an earlier results file to diff against")
+
+    def handle(self, *args, **options):
+        users = options["users"] - options["users"] % 2
+        path = options["database"] or Path(tempfile.mkdtemp()) / "wetalk_bench_load.sqlite3"
+        use_database(path)
+
+        with override_settings(
+            CHANNEL_LAYERS=channel_layers(options["layer"], options["remote_latency_us"]),
+            WETALK_WRITE_BEHIND=options["write_behind"],
+            # the benchmark measures the node, not the flood limits
+            WETALK_RATE_LIMIT_USER=None,
+            WETALK_RATE_LIMIT_ROOM=None,
+        ):
+            from WeTalk.asgi import application
+
+            accounts = self.accounts(users)
+            results = asyncio.run(self.run(application, accounts, options))
+
+        results.update({
+            "commit": current_commit(),
+            "finished_at": timezone.now().isoformat(),
+            "config": {
+                "users": users,
+                "messages_per_user": options["messages"],
+                "interval_s": options["interval"],
+                "write_behind": options["write_behind"],
+                "resume": options["resume"],
+                "layer": options["layer"],
+                "remote_latency_us": options["remote_latency_us"],
+            },
+        })
+        Path(options["output"]).write_text(json.dumps(results, indent=2) + "\n")
+        self.stdout.write(json.dumps(results, indent=2))
+        self.stdout.write(f"written to {options['output']}")
+
+        if options["compare"]:
+            self.compare(json.loads(Path(options["compare"]).read_text()), results)
+
+    def accounts(self, count):
+        # bulk_create skips the welcome-email signal
+        existing = User.objects.filter(username__startswith="load").count()
+        User.objects.bulk_create(
+            User(username=f"load{i}", email=f"load{i}@example.com") for i in range(existing, count)
+        )
+        users = list(User.objects.filter(username__startswith="load").order_by("id")[:count])
+        return [(user, str(AccessToken.for_user(user))) for user in users]
+
+    async def run(self, application, accounts, options):
+        clients = [
+            Client(application, user, accounts[i ^ 1][0], token)
+            for i, (user, token) in enumerate(accounts)
+        ]
+
+        # cold: no socket has resolved its token or room yet
+        room_cache.clear()
+        token_cache.clear()
+        gc.collect()
+        rss_before = rss_bytes()
+        accepted, ready, connect_seconds = await self.connect_all(clients, options)
+        gc.collect()
+        rss_after = rss_bytes()
+
+        layer = get_channel_layer()
+        remote = getattr(layer, "remote", layer)
+        remote.ops.clear()
+        expected = options["messages"]
+        started = time.perf_counter()
+        listeners = [asyncio.ensure_future(client.listen(expected, timeout=10)) for client in clients]
+        await asyncio.gather(*(client.send(expected, options["interval"]) for client in clients))
+        await asyncio.gather(*listeners)
+        message_seconds = time.perf_counter() - started
+        ops = dict(remote.ops)
+
+        # a listener that timed out has had its application cancelled by the communicator
+        await asyncio.gather(*(client.communicator.disconnect() for client in clients), return_exceptions=True)
+
+        # everyone comes back, as mobile clients do, now with warm caches
+        for client in clients:
+            client.reopen(resume=options["resume"])
+        reaccepted, reready, reconnect_seconds = await self.connect_all(clients, options)
+        await asyncio.gather(*(client.communicator.disconnect() for client in clients))
+
+        delivered = sum(client.received for client in clients)
+        latencies = [latency for client in clients for latency in client.latencies]
+        return {
+            "connections": len(clients),
+            "connect": {
+                "accept": latency_summary(accepted),
+                "history_received": latency_summary(ready),
+                "connections_per_sec": round(len(clients) / connect_seconds, 1),
+            },
+            "reconnect": {
+                "accept": latency_summary(reaccepted),
+                "history_received": latency_summary(reready),
+                "connections_per_sec": round(len(clients) / reconnect_seconds, 1),
+                "history_bytes_per_client": round(sum(client.history_bytes for client in clients) / len(clients)),
+            },
+            "messages": {
+                "sent": len(clients) * expected,
+                "delivered": delivered,
+                "errors": sum(client.errors for client in clients),
+                "latency": latency_summary(latencies),
+                "delivered_per_sec": round(delivered / message_seconds, 1),
+            },
+            "remote_layer": {
+                **ops,
+                "round_trips_per_message": round(ops.get("round_trips", 0) / max(len(clients) * expected, 1), 2),
+                "pushed_per_message": round(ops.get("pushed", 0) / max(len(clients) * expected, 1), 2),
+            },
+            "memory": {
+                "rss_before_mb": round(rss_before / 2 ** 20, 1),
+                "rss_connected_mb": round(rss_after / 2 ** 20, 1),
+                "per_connection_kb": round((rss_after - rss_before) / len(clients) / 1024, 1),
+            },
+        }
+
+    async def connect_all(self, clients, options):
+        accepted, ready = [], []
+        started = time.perf_counter()
+        for first in range(0, len(clients), options["connect_concurrency"]):
+            batch = clients[first:first + options["connect_concurrency"]]
+            for accept_ms, ready_ms in await asyncio.gather(*(client.connect() for client in batch)):
+                accepted.append(accept_ms)
+                ready.append(ready_ms)
+        return accepted, ready, time.perf_counter() - started
+
+    def compare(self, before, after):
+        self.stdout.write(f"compared with {before.get('commit')}:")
+        for section, key in (
+            ("connect", "accept"), ("connect", "history_received"), ("messages", "latency"),
+            ("reconnect", "accept"), ("reconnect", "history_received"),
+        ):
+            if section not in before:
+                continue
+            old, new = before[section][key], after[section][key]
+            if old and new:
+                for stat in ("p50_ms", "p95_ms", "p99_ms"):
+                    self.stdout.write(f"  {section}.{key}.{stat}: {old[stat]} -> {new[stat]} ({self.change(old[stat], new[stat])})")
+        for section, key in (
+            ("connect", "connections_per_sec"), ("reconnect", "connections_per_sec"),
+            ("reconnect", "history_bytes_per_client"),
+            ("messages", "delivered_per_sec"), ("memory", "per_connection_kb"),
+            ("remote_layer", "round_trips_per_message"), ("remote_layer", "pushed_per_message"),
+        ):
+            if key not in before.get(section, {}):
+                continue
+            old, new = before[section][key], after[section][key]
+            self.stdout.write(f"  {section}.{key}: {old} -> {new} ({self.change(old, new)})")
+
+    def change(self, old, new):
+        return f"{(new - old) / old:+.1%}" if old else "n/a"
@@ -0,0 +1,108 @@
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from talk import metrics
+from talk.executor import database_sync_to_async as executor_database_sync_to_async
+from talk.models import User
+from talk.routing import websocket_urlpatterns
+
+from ._bench import use_database
+
+IN_MEMORY_CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+def as_user(app, user):
+    async def wrapper(scope, receive, send):
+        return await app(dict(scope, user=user), receive, send)
+    return wrapper
+
+
+def noop():
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Time a message's trip through ChatConsumer and the metrics work done on that trip, "
+        "and report the instrumentation overhead as a share of the hot path."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument("--repeat", type=int, default=5, help="runs per measurement, the median is kept")
+
+    def handle(self, *args, **options):
+        use_database(Path(tempfile.mkdtemp()) / "wetalk_bench_metrics.sqlite3")
+        # bulk_create skips the welcome-email signal
+        alice, bob = User.objects.bulk_create(
+            User(username=name, email=f"{name}@example.com") for name in ("alice", "bob")
+        )
+        count, repeat = options["messages"], options["repeat"]
+
+        with override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, WETALK_RATE_LIMIT_USER=None, WETALK_RATE_LIMIT_ROOM=None):
+            for write_behind in (True, False):
+                with override_settings(WETALK_WRITE_BEHIND=write_behind):
+                    per_message = statistics.median(
+                        asyncio.run(self.round_trips(alice, bob, count)) for _ in range(repeat)
+                    )
+                counters = statistics.median(self.counter_cost(count) for _ in range(repeat))
+                db = 0.0 if write_behind else statistics.median(
+                    asyncio.run(self.db_wrapper_cost(count)) for _ in range(repeat)
+                )
+                overhead = counters + db
+                self.stdout.write(
+                    f"write-behind {'on ' if write_behind else 'off'}: {per_message * 1e6:.1f} us per message, "
+                    f"metrics {overhead * 1e6:.2f} us (counters {counters * 1e6:.2f}, db wrapper {db * 1e6:.2f}), "
+                    f"{overhead / per_message:.2%} of the hot path"
+                )
+
+    async def round_trips(self, alice, bob, count):
+        """Seconds per message sent by one member and received by both."""
+        app = URLRouter(websocket_urlpatterns)
+        sender = WebsocketCommunicator(as_user(app, alice), "/ws/chat/bob/")
+        peer = WebsocketCommunicator(as_user(app, bob), "/ws/chat/alice/")
+        for communicator in (sender, peer):
+            await communicator.connect()
+            await communicator.receive_from()
+
+        started = time.perf_counter()
+        for i in range(count):
+            await sender.send_json_to({"message": f"bench {i}"})
+            await sender.receive_from()
+            await peer.receive_from()
+        elapsed = time.perf_counter() - started
+
+        for communicator in (sender, peer):
+            await communicator.disconnect()
+        return elapsed / count
+
+    def counter_cost(self, count):
+        """Seconds of metrics work per message outside the database wrapper."""
+        started = time.perf_counter()
+        for _ in range(count):
+            metrics.messages_received.inc()
+            began = time.perf_counter()
+            metrics.group_send_seconds.observe(time.perf_counter() - began)
+            # one frame to each member of the room
+            metrics.messages_sent.inc()
+            metrics.messages_sent.inc()
+        return (time.perf_counter() - started) / count
+
+    async def db_wrapper_cost(self, count):
+        """Extra seconds per call of the timed database_sync_to_async over the untimed one."""
+        timed, plain = metrics.database_sync_to_async(noop), executor_database_sync_to_async(noop)
+        samples = {timed: [], plain: []}
+        for _ in range(count):
+            for func in (timed, plain):
+                started = time.perf_counter()
+                await func()
+                samples[func].append(time.perf_counter() - started)
+        return max(0.0, statistics.median(samples[timed]) - statistics.median(samples[plain]))
@@ -0,0 +1,105 @@
+import importlib
+import random
+import tempfile
+import time
+from datetime import timedelta
+from itertools import accumulate
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from talk.models import User, ChatRoom, Message
+from talk.views import MessageViewSet
+
+from ._bench import use_database, timed, summarize
+
+# the insert trigger from the FTS migration is dropped while seeding, the index is built in one go after
+fts_migration = importlib.import_module("talk.migrations.0008_message_search_fts")
+
+VOCABULARY = 20_000
+WORDS_PER_MESSAGE = 8
+
+
+class Command(BaseCommand):
+    help = "Seed a scratch database with messages and time full-text searches through the API."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=10_000_000)
+        parser.add_argument("--rooms", type=int, default=1000)
+        parser.add_argument("--user-rooms", type=int, default=20, help="rooms the searching user is in")
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--database", help="SQLite file to seed (reused if it already holds data)")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("bench_search times the SQLite FTS5 backend.")
+        path = options["database"] or Path(tempfile.gettempdir()) / "wetalk_bench_search.sqlite3"
+        use_database(path)
+
+        if not Message.objects.exists():
+            self.seed(options["messages"], options["rooms"], options["user_rooms"])
+
+        user = User.objects.get(username="bench0")
+        rooms = ChatRoom.objects.for_user(user).count()
+        self.stdout.write(f"{path}: {Message.objects.count()} messages, searching as a user in {rooms} rooms")
+
+        view = MessageViewSet.as_view({"get": "search"})
+        factory = APIRequestFactory()
+        # word ranks run from very common to rare under the Zipf weights used for seeding
+        for query in ("w1", "w10", "w100", "w1000", "w10000", "w3 w40", "w5 w500"):
+            response = {}
+
+            def search():
+                request = factory.get("/wetalk/messages/search/", {"q": query}, HTTP_HOST="localhost")
+                force_authenticate(request, user=user)
+                response["data"] = view(request).data
+
+            timings = summarize(timed(search, options["repeat"]))
+            cursor = response["data"]["cursor"]
+
+            def next_page():
+                request = factory.get("/wetalk/messages/search/", {"q": query, "cursor": cursor}, HTTP_HOST="localhost")
+                force_authenticate(request, user=user)
+                view(request)
+
+            page_two = summarize(timed(next_page, options["repeat"])) if cursor else "-"
+            self.stdout.write(
+                f"{query!r:>10}: {len(response['data']['results'])} results, first page {timings}, next page {page_two}"
+            )
+
+    def seed(self, total, rooms, user_rooms):
+        self.stdout.write(f"seeding {total} messages across {rooms} rooms...")
+        started = time.perf_counter()
+        rng = random.Random(1)
+        # bulk_create skips the welcome-email signal
+        users = User.objects.bulk_create(
+            User(username=f"bench{i}", email=f"bench{i}@example.com") for i in range(rooms + 1)
+        )
+        room_ids = [
+            ChatRoom.objects.create(user1=users[0] if i < user_rooms else users[i], user2=users[i + 1]).id
+            for i in range(rooms)
+        ]
+
+        words = [f"w{rank}" for rank in range(1, VOCABULARY + 1)]
+        weights = list(accumulate(1 / rank for rank in range(1, VOCABULARY + 1)))
+        start = timezone.now() - timedelta(seconds=total)
+        batch = 50_000
+        insert = "INSERT INTO talk_message (chat_room_id, sender_id, text, time_stamp, is_read) VALUES (%s, %s, %s, %s, %s)"
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER talk_message_fts_insert")
+            for first in range(0, total, batch):
+                rows = []
+                for n in range(first, min(first + batch, total)):
+                    room = n % rooms
+                    text = " ".join(rng.choices(words, cum_weights=weights, k=WORDS_PER_MESSAGE))
+                    time_stamp = connection.ops.adapt_datetimefield_value(start + timedelta(seconds=n))
+                    rows.append((room_ids[room], users[room + 1].id, text, time_stamp, True))
+                cursor.executemany(insert, rows)
+            self.stdout.write(f"inserted in {time.perf_counter() - started:.1f}s, building the index...")
+            cursor.execute(fts_migration.BACKFILL)
+            cursor.execute(fts_migration.INSERT_TRIGGER)
+            cursor.execute("INSERT INTO talk_message_fts(talk_message_fts) VALUES ('optimize')")
+        self.stdout.write(f"seeded in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,127 @@
+import asyncio
+import binascii
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from talk.layers import HashRing, ShardedChannelLayer
+
+
+class SerialShard(InMemoryChannelLayer):
+    """
+    Stand-in for one Redis host: like Redis it serves one group_send at a
+    time, each takes `op_us` microseconds and the rest queue behind it.
+    """
+
+    def __init__(self, op_us=0, **kwargs):
+        super().__init__(**kwargs)
+        self.op_seconds = op_us / 1e6
+        self.free_at = 0
+        self.cleaned = 0
+
+    def _clean_expired(self):
+        # the in-memory layer scans every channel and group on each call, Redis expires keys itself
+        if time.monotonic() - self.cleaned > 1:
+            self.cleaned = time.monotonic()
+            super()._clean_expired()
+
+    async def group_send(self, group, message):
+        # a virtual clock, so sleeps that overshoot do not add up
+        now = time.monotonic()
+        self.free_at = max(now, self.free_at) + self.op_seconds
+        await asyncio.sleep(self.free_at - now)
+        await super().group_send(group, message)
+
+
+def shard_configs(count, redis_urls, op_us):
+    if redis_urls:
+        return [
+            {"NAME": url, "BACKEND": "channels_redis.core.RedisChannelLayer", "CONFIG": {"hosts": [url]}}
+            for url in redis_urls[:count]
+        ]
+    return [
+        {"NAME": f"shard{i}", "BACKEND": f"{__name__}.SerialShard", "CONFIG": {"op_us": op_us, "capacity": 1000}}
+        for i in range(count)
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        "Group-send throughput of ShardedChannelLayer on chat_<room id> groups with 1, 2 and 4 shards, "
+        "and how many rooms move when shards are added."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shards", default="1,2,4")
+        parser.add_argument("--rooms", type=int, default=200, help="two member channels per room")
+        parser.add_argument("--messages", type=int, default=10000)
+        parser.add_argument("--workers", type=int, default=50, help="concurrent senders")
+        parser.add_argument(
+            "--redis", default="",
+            help="comma-separated redis:// URLs, one per shard; in-memory stand-ins when empty",
+        )
+        parser.add_argument(
+            "--op-us", type=int, default=500,
+            help="time per group_send on a stand-in shard, keep it above this process's own cost per message",
+        )
+
+    def handle(self, *args, **options):
+        counts = [int(n) for n in options["shards"].split(",")]
+        redis_urls = [url for url in options["redis"].split(",") if url]
+        if redis_urls and len(redis_urls) < max(counts):
+            counts = [n for n in counts if n <= len(redis_urls)]
+        self.stdout.write(
+            f"{'Redis' if redis_urls else 'stand-in'} shards, {options['rooms']} rooms, "
+            f"{options['messages']} messages, {options['workers']} senders"
+        )
+
+        for count in counts:
+            layer = ShardedChannelLayer(shard_configs(count, redis_urls, options["op_us"]))
+            elapsed, spread = asyncio.run(self.run(layer, options))
+            self.stdout.write(
+                f"{count} shard(s): {options['messages'] / elapsed:,.0f} group_send/s, "
+                f"{2 * options['messages'] / elapsed:,.0f} deliveries/s, rooms per shard {spread}"
+            )
+
+        rooms = [f"chat_{i}" for i in range(options["rooms"])]
+        for before in counts:
+            after = before + 1
+            old, new = HashRing([f"shard{i}" for i in range(before)]), HashRing([f"shard{i}" for i in range(after)])
+            ring = sum(old.node(room) != new.node(room) for room in rooms) / len(rooms)
+            # what channels_redis does on its own: crc32 modulo the host count
+            modulo = sum(
+                binascii.crc32(room.encode()) % before != binascii.crc32(room.encode()) % after for room in rooms
+            ) / len(rooms)
+            self.stdout.write(
+                f"adding a shard to {before}: the ring moves {ring:.1%} of rooms, modulo hashing {modulo:.1%}"
+            )
+
+    async def run(self, layer, options):
+        rooms = [f"chat_{i}" for i in range(options["rooms"])]
+        members = {}
+        for room in rooms:
+            members[room] = [await layer.new_channel(), await layer.new_channel()]
+            for channel in members[room]:
+                await layer.group_add(room, channel)
+        spread = sorted(sum(layer.shard(room) == name for room in rooms) for name in layer.shards)
+
+        workers = options["workers"]
+        per_worker = options["messages"] // workers
+
+        async def sender(worker):
+            # each sender owns its rooms, so a receive always finds its own message
+            owned = rooms[worker::workers]
+            for n in range(per_worker):
+                room = owned[n % len(owned)]
+                await layer.group_send(room, {"type": "chat.message", "n": n})
+                for channel in members[room]:
+                    await layer.receive(channel)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(sender(worker) for worker in range(workers)))
+        elapsed = time.perf_counter() - started
+
+        await layer.flush()
+        await layer.close_pools()
+        return elapsed, spread
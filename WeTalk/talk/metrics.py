@@ -0,0 +1,216 @@
+import functools
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+from .executor import database_sync_to_async as executor_database_sync_to_async, db_executor
+from .heartbeat import heartbeat
+from .outbound import counters as outbound_counters, outbound_stats
+
+# Metrics are per process, Prometheus scrapes each worker on its own. They
+# are updated from event loop threads with plain ints and no lock: keeping
+# the hot path cheap is worth an increment lost to a rare race.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = []
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def samples(self):
+        for values, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.labels, values), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Callback(Metric):
+    """A value read from `callback()` at scrape time, for state other modules already keep."""
+
+    def __init__(self, name, help, callback, kind="gauge"):
+        super().__init__(name, help)
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, "", self.callback()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield f"{self.name}_bucket", f'{{le="{bound}"}}', total
+        yield f"{self.name}_sum", "", self.sum
+        yield f"{self.name}_count", "", total
+
+
+def render():
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+connects = Counter("wetalk_ws_connects_total", "WebSocket connection attempts.")
+accepted = Counter("wetalk_ws_accepted_total", "WebSocket connections accepted.")
+disconnects = Counter("wetalk_ws_disconnects_total", "WebSocket disconnects by close code.", labels=("code",))
+active_connections = Gauge("wetalk_ws_active_connections", "Open WebSocket connections in this process.")
+messages_received = Counter("wetalk_ws_messages_received_total", "Frames received from clients.")
+messages_sent = Counter("wetalk_ws_messages_sent_total", "Frames sent to clients.")
+group_send_seconds = Histogram("wetalk_channel_layer_group_send_seconds", "Time spent in channel_layer.group_send.")
+db_wait_seconds = Histogram(
+    "wetalk_database_sync_to_async_wait_seconds", "Time database_sync_to_async calls wait for a database thread.",
+)
+db_run_seconds = Histogram("wetalk_database_sync_to_async_run_seconds", "Time database_sync_to_async calls run.")
+Callback("wetalk_db_executor_threads", "Threads started in the database executor.", lambda: db_executor.stats()["threads"])
+Callback("wetalk_db_executor_queued", "Calls waiting for a database executor thread.", lambda: db_executor.stats()["queued"])
+Callback("wetalk_outbound_queued_frames", "Frames waiting in outbound queues.", lambda: outbound_stats()["queued"])
+Callback("wetalk_outbound_max_depth", "Deepest outbound queue.", lambda: outbound_stats()["max_depth"])
+for name in ("coalesced", "dropped", "evicted"):
+    Callback(
+        f"wetalk_outbound_{name}_total", f"Outbound frames or sockets {name} on overflow.",
+        functools.partial(outbound_counters.get, name), kind="counter",
+    )
+Callback("wetalk_heartbeat_reaped_total", "Sockets closed by the heartbeat.", lambda: heartbeat.reaped, kind="counter")
+
+
+def write_behind_stats():
+    # imported here, talk.writebehind times its flushes with this module
+    from .writebehind import message_buffer
+    return message_buffer.snapshot()
+
+
+Callback("wetalk_write_behind_pending", "Messages broadcast but not written yet.", lambda: write_behind_stats()["pending"])
+Callback(
+    "wetalk_write_behind_oldest_pending_seconds", "Age of the oldest unwritten message.",
+    lambda: write_behind_stats()["oldest_pending_ms"] / 1000,
+)
+Callback(
+    "wetalk_write_behind_last_flush_lag_seconds", "Oldest message's wait in the last flush.",
+    lambda: write_behind_stats()["last_flush_lag_ms"] / 1000,
+)
+for name, help in (
+    ("failed_flushes", "Write-behind flushes that failed."),
+    ("dropped", "Buffered messages dropped as unwritable."),
+    ("written", "Buffered messages written."),
+):
+    Callback(f"wetalk_write_behind_{name}_total", help, lambda name=name: write_behind_stats()[name], kind="counter")
+
+
+class MetricsConsumerMixin:
+    """Counts a consumer's connections and frames. Goes before the Channels consumer class."""
+
+    async def websocket_connect(self, message):
+        connects.inc()
+        await super().websocket_connect(message)
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        accepted.inc()
+        active_connections.inc()
+        self.metrics_open = True
+
+    async def websocket_receive(self, message):
+        messages_received.inc()
+        await super().websocket_receive(message)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data is not None or bytes_data is not None:
+            messages_sent.inc()
+        await super().send(text_data, bytes_data, close)
+
+    async def websocket_disconnect(self, message):
+        if getattr(self, "metrics_open", False):
+            self.metrics_open = False
+            active_connections.dec()
+        disconnects.inc(str(message.get("code", "")))
+        await super().websocket_disconnect(message)
+
+
+async def group_send(channel_layer, group, message):
+    """channel_layer.group_send, timed."""
+    started = time.perf_counter()
+    try:
+        await channel_layer.group_send(group, message)
+    finally:
+        group_send_seconds.observe(time.perf_counter() - started)
+
+
+def database_sync_to_async(func):
+    """
+    talk.executor.database_sync_to_async that also records how long each
+    call queued for a thread and how long it ran there.
+    """
+    def run(started, *args, **kwargs):
+        started.append(time.perf_counter())
+        return func(*args, **kwargs)
+
+    threaded = executor_database_sync_to_async(run)
+
+    @functools.wraps(func)
+    async def call(*args, **kwargs):
+        submitted = time.perf_counter()
+        started = []
+        try:
+            return await threaded(started, *args, **kwargs)
+        finally:
+            if started:
+                db_wait_seconds.observe(started[0] - submitted)
+                db_run_seconds.observe(time.perf_counter() - started[0])
+    return call
+
+
+def metrics_view(request):
+    """Prometheus text format. Needs `Authorization: Bearer <METRICS_TOKEN>` when that is set."""
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
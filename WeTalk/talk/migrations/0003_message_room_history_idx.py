@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('talk', '0002_activeconnection'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={},
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='chat_room',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='talk.chatroom'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat_room', 'time_stamp', 'id'], name='message_room_history_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:38
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('talk', '0003_message_room_history_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='time_stamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
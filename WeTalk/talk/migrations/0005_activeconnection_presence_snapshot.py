@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def drop_duplicate_connections(apps, schema_editor):
+    # update_or_create without a unique index could leave several rows per user and room
+    ActiveConnection = apps.get_model("talk", "ActiveConnection")
+    seen = set()
+    duplicates = []
+    for row in ActiveConnection.objects.order_by("-last_active", "-id").values("id", "user_id", "room_name"):
+        key = (row["user_id"], row["room_name"])
+        if key in seen:
+            duplicates.append(row["id"])
+        seen.add(key)
+    ActiveConnection.objects.filter(id__in=duplicates).delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('talk', '0004_message_time_stamp_default'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_connections, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='activeconnection',
+            name='refreshed_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddConstraint(
+            model_name='activeconnection',
+            constraint=models.UniqueConstraint(fields=('user', 'room_name'), name='unique_active_connection'),
+        ),
+    ]
@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:42
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Substr
+
+
+def backfill_inbox_summary(apps, schema_editor):
+    ChatRoom = apps.get_model("talk", "ChatRoom")
+    Message = apps.get_model("talk", "Message")
+
+    latest = Message.objects.filter(chat_room=OuterRef("pk")).order_by("-time_stamp", "-id")
+
+    def unread(side):
+        return Coalesce(
+            Subquery(
+                Message.objects.filter(chat_room=OuterRef("pk"), is_read=False)
+                .exclude(sender=OuterRef(side))
+                .values("chat_room")
+                .annotate(count=Count("id"))
+                .values("count")
+            ),
+            0,
+        )
+
+    ChatRoom.objects.update(
+        last_message_at=Subquery(latest.values("time_stamp")[:1]),
+        last_message_text=Coalesce(Subquery(latest.annotate(preview=Substr("text", 1, 255)).values("preview")[:1]), models.Value("")),
+        last_message_sender=Subquery(latest.values("sender")[:1]),
+        user1_unread=unread("user1"),
+        user2_unread=unread("user2"),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('talk', '0005_activeconnection_presence_snapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_text',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='user1_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='user2_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_inbox_summary, migrations.RunPython.noop),
+    ]
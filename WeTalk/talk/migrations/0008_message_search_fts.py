@@ -0,0 +1,70 @@
+from django.db import migrations
+
+# A contentless FTS5 index over talk_message: only postings are stored, text is
+# read back from talk_message. Each message is also indexed under its room id
+# and under both participants ("u<id>"), so a search is scoped to the caller's
+# rooms by one more term in the MATCH instead of a join.
+MEMBERS = "'u' || user1_id || ' u' || user2_id"
+
+CREATE_TABLE = """
+    CREATE VIRTUAL TABLE talk_message_fts USING fts5(text, chat_room_id, members, content='')
+"""
+
+INSERT_TRIGGER = f"""
+    CREATE TRIGGER talk_message_fts_insert AFTER INSERT ON talk_message BEGIN
+        INSERT INTO talk_message_fts(rowid, text, chat_room_id, members)
+        SELECT new.id, new.text, new.chat_room_id, {MEMBERS} FROM talk_chatroom WHERE id = new.chat_room_id;
+    END
+"""
+
+# contentless tables forget a row by being handed the exact values it was indexed with
+DELETE_TRIGGER = f"""
+    CREATE TRIGGER talk_message_fts_delete AFTER DELETE ON talk_message BEGIN
+        INSERT INTO talk_message_fts(talk_message_fts, rowid, text, chat_room_id, members)
+        SELECT 'delete', old.id, old.text, old.chat_room_id, {MEMBERS} FROM talk_chatroom WHERE id = old.chat_room_id;
+    END
+"""
+
+UPDATE_TRIGGER = f"""
+    CREATE TRIGGER talk_message_fts_update AFTER UPDATE OF text ON talk_message BEGIN
+        INSERT INTO talk_message_fts(talk_message_fts, rowid, text, chat_room_id, members)
+        SELECT 'delete', old.id, old.text, old.chat_room_id, {MEMBERS} FROM talk_chatroom WHERE id = old.chat_room_id;
+        INSERT INTO talk_message_fts(rowid, text, chat_room_id, members)
+        SELECT new.id, new.text, new.chat_room_id, {MEMBERS} FROM talk_chatroom WHERE id = new.chat_room_id;
+    END
+"""
+
+BACKFILL = f"""
+    INSERT INTO talk_message_fts(rowid, text, chat_room_id, members)
+    SELECT talk_message.id, talk_message.text, talk_message.chat_room_id, {MEMBERS}
+    FROM talk_message JOIN talk_chatroom ON talk_chatroom.id = talk_message.chat_room_id
+"""
+
+CREATE = [CREATE_TABLE, INSERT_TRIGGER, DELETE_TRIGGER, UPDATE_TRIGGER, BACKFILL]
+
+DROP = [
+    "DROP TRIGGER IF EXISTS talk_message_fts_update",
+    "DROP TRIGGER IF EXISTS talk_message_fts_delete",
+    "DROP TRIGGER IF EXISTS talk_message_fts_insert",
+    "DROP TABLE IF EXISTS talk_message_fts",
+]
+
+
+def run_on_sqlite(statements):
+    # other databases use a different search backend, see talk.search
+    def run(apps, schema_editor):
+        if schema_editor.connection.vendor == "sqlite":
+            for statement in statements:
+                schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('talk', '0007_message_unread_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_sqlite(CREATE), run_on_sqlite(DROP)),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:10
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+# SQLite rebuilds both tables below, which breaks or drops the search triggers
+# on talk_message; they are put back afterwards, the index itself is kept
+search_fts = import_module("talk.migrations.0008_message_search_fts")
+TRIGGERS = [search_fts.INSERT_TRIGGER, search_fts.DELETE_TRIGGER, search_fts.UPDATE_TRIGGER]
+DROP_TRIGGERS = [statement for statement in search_fts.DROP if "TRIGGER" in statement]
+
+
+def backfill_seq(apps, schema_editor):
+    # number what is already stored in history order, room by room
+    ChatRoom = apps.get_model("talk", "ChatRoom")
+    Message = apps.get_model("talk", "Message")
+
+    for room_id in ChatRoom.objects.values_list("id", flat=True).iterator():
+        ids = Message.objects.filter(chat_room_id=room_id).order_by("time_stamp", "id").values_list("id", flat=True)
+        numbered = [Message(id=message_id, seq=seq) for seq, message_id in enumerate(ids.iterator(), start=1)]
+        Message.objects.bulk_update(numbered, ["seq"], batch_size=500)
+        ChatRoom.objects.filter(id=room_id).update(last_seq=len(numbered))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('talk', '0008_message_search_fts'),
+    ]
+
+    operations = [
+        migrations.RunPython(search_fts.run_on_sqlite(DROP_TRIGGERS), search_fts.run_on_sqlite(TRIGGERS)),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('chat_room', 'seq'), name='unique_message_room_seq'),
+        ),
+        migrations.RunPython(backfill_seq, migrations.RunPython.noop),
+        migrations.RunPython(search_fts.run_on_sqlite(TRIGGERS), search_fts.run_on_sqlite(DROP_TRIGGERS)),
+    ]
@@ -1,7 +1,12 @@
-from django.db import models
+from collections import Counter
+
+from django.db import models, transaction
+from django.db.models import Case, F, Q, Value, When
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
 
+PREVIEW_LENGTH = 255
+
 
 # Create your models here.
 
@@ -10,11 +15,34 @@ class User(AbstractUser):
     pass
 
 
+class ContactQuerySet(models.QuerySet):
+
+    def add_usernames(self, user, usernames):
+        """
+        Add every existing user in `usernames` to `user`'s contacts in three
+        queries, however many there are: one IN lookup for the users, one
+        for those already added, one bulk INSERT for the rest.
+        """
+        wanted = list(dict.fromkeys(name for name in usernames if name != user.username))
+        found = dict(User.objects.filter(username__in=wanted).values_list("username", "id"))
+        existing = set(self.filter(user=user, contact_id__in=found.values()).values_list("contact_id", flat=True))
+        added = [name for name in wanted if name in found and found[name] not in existing]
+        # a concurrent add of the same contact is skipped rather than failing the import
+        self.bulk_create([self.model(user=user, contact_id=found[name]) for name in added], ignore_conflicts=True)
+        return {
+            "added": added,
+            "already_added": [name for name in wanted if name in found and found[name] in existing],
+            "not_found": [name for name in wanted if name not in found],
+        }
+
+
 class Contact(models.Model):
     user = models.ForeignKey(User, related_name='contacts', on_delete=models.CASCADE)
     contact = models.ForeignKey(User, related_name='added_as_contact', on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = ContactQuerySet.as_manager()
+
     class Meta:
         unique_together = ('user', 'contact')
     
@@ -23,11 +51,74 @@ class Contact(models.Model):
 
         
         
+class ChatRoomQuerySet(models.QuerySet):
+
+    def for_user(self, user):
+        return self.filter(Q(user1=user) | Q(user2=user))
+
+    def record_messages(self, messages):
+        """
+        Number not yet inserted messages and roll them into their rooms' inbox
+        summary: one UPDATE per room takes the next seqs, moves the
+        last-message columns forward (never back) and bumps the unread counter
+        of whoever didn't send them, then one SELECT reads the seqs taken.
+        The UPDATE holds the room's row until commit, so concurrent writers
+        number one after the other.
+        """
+        by_room = {}
+        for message in messages:
+            by_room.setdefault(message.chat_room_id, []).append(message)
+
+        for room_id, room_messages in by_room.items():
+            # the later of equal time stamps, as the history order breaks ties by id
+            last = max(reversed(room_messages), key=lambda m: m.time_stamp)
+            is_newer = Q(last_message_at__isnull=True) | Q(last_message_at__lte=last.time_stamp)
+            sent_by = Counter(m.sender_id for m in room_messages)
+
+            def if_newer(name, value):
+                field = self.model._meta.get_field(name)
+                return Case(When(is_newer, then=Value(value)), default=F(name), output_field=field)
+
+            self.filter(id=room_id).update(
+                last_seq=F("last_seq") + len(room_messages),
+                last_message_at=if_newer("last_message_at", last.time_stamp),
+                last_message_text=if_newer("last_message_text", last.text[:PREVIEW_LENGTH]),
+                last_message_sender=if_newer("last_message_sender", last.sender_id),
+                user1_unread=F("user1_unread") + unread_delta("user1", sent_by),
+                user2_unread=F("user2_unread") + unread_delta("user2", sent_by),
+            )
+
+        for room_id, last_seq in self.filter(id__in=by_room).values_list("id", "last_seq"):
+            room_messages = by_room[room_id]
+            for seq, message in enumerate(room_messages, start=last_seq - len(room_messages) + 1):
+                message.seq = seq
+
+
+def unread_delta(side, sent_by):
+    # messages count as unread for a side unless that side sent them
+    return sum(
+        (Case(When(**{f"{side}_id": sender_id}, then=Value(0)), default=Value(count)) for sender_id, count in sent_by.items()),
+        Value(0),
+    )
+
+
 class ChatRoom(models.Model):
     user1 = models.ForeignKey(User, related_name='chatrooms_user1', on_delete=models.CASCADE)
     user2 = models.ForeignKey(User, related_name='chatrooms_user2', on_delete=models.CASCADE)
-    
-    
+
+    # inbox summary, maintained by ChatRoomQuerySet.record_messages on every insert
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_text = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    last_message_sender = models.ForeignKey(
+        User, related_name='+', null=True, blank=True, on_delete=models.SET_NULL
+    )
+    user1_unread = models.PositiveIntegerField(default=0)
+    user2_unread = models.PositiveIntegerField(default=0)
+    # seq of the room's newest message, see Message.seq
+    last_seq = models.PositiveBigIntegerField(default=0)
+
+    objects = ChatRoomQuerySet.as_manager()
+
     class Meta:
         constraints = [
             models.UniqueConstraint(
@@ -44,24 +135,69 @@ class ChatRoom(models.Model):
     
     def __str__(self):
         return f"Chat between {self.user1.username} and {self.user2.username}"
+
+    def peer_of(self, user):
+        return self.user2 if self.user1_id == user.id else self.user1
+
+    def unread_for(self, user):
+        return self.user1_unread if self.user1_id == user.id else self.user2_unread
         
     
-        
+
+class MessageQuerySet(models.QuerySet):
+
+    def persist(self, messages):
+        """
+        The one way messages are written: number them, update the inbox
+        summary of their rooms and insert them in the same transaction.
+        """
+        with transaction.atomic():
+            ChatRoom.objects.record_messages(messages)
+            return self.bulk_create(messages)
+
+
 class Message(models.Model):
-    chat_room = models.ForeignKey(ChatRoom, related_name='messages', on_delete=models.CASCADE)
+    # the history index below starts with chat_room, so the FK doesn't need its own
+    chat_room = models.ForeignKey(ChatRoom, related_name='messages', on_delete=models.CASCADE, db_index=False)
     sender = models.ForeignKey(User, related_name='sent_messages', on_delete=models.CASCADE)
     text = models.TextField()
-    time_stamp = models.DateTimeField(auto_now_add=True)
+    # not auto_now_add, buffered messages keep the time they were broadcast with
+    time_stamp = models.DateTimeField(default=timezone.now, editable=False)
     is_read = models.BooleanField(default=False)
-    
+    # 1, 2, 3... per room in the order messages were stored, set by persist; clients
+    # resume from the last one they saw and spot a gap when one is skipped
+    seq = models.PositiveBigIntegerField(null=True, blank=True, editable=False)
+
+    objects = MessageQuerySet.as_manager()
+
     class Meta:
-        ordering = ['time_stamp']
-        
+        indexes = [
+            models.Index(fields=['chat_room', 'time_stamp', 'id'], name='message_room_history_idx'),
+            # only unread rows are indexed, so counting and marking them stays cheap in long rooms
+            models.Index(
+                fields=['chat_room', 'sender'], condition=Q(is_read=False), name='message_unread_idx'
+            ),
+        ]
+        constraints = [
+            # also the index resume reads through
+            models.UniqueConstraint(fields=['chat_room', 'seq'], name='unique_message_room_seq'),
+        ]
+
     def __str__(self):
         return f"{self.sender.username}: {self.text[:20]}"
     
 
+# Coarse snapshot of talk.presence, refreshed periodically by each process
 class ActiveConnection(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     room_name = models.CharField(max_length=255)
-    last_active = models.DateTimeField(default=timezone.now)
\ No newline at end of file
+    last_active = models.DateTimeField(default=timezone.now)
+    refreshed_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "room_name"],
+                name="unique_active_connection"
+            )
+        ]
\ No newline at end of file
@@ -0,0 +1,126 @@
+import asyncio
+import collections
+import logging
+import weakref
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+# close code for sockets evicted under the "disconnect" policy
+CLOSE_SLOW_CONSUMER = 4410
+
+POLICIES = ("coalesce", "drop_oldest", "disconnect")
+
+# process-wide counters, see outbound_stats()
+counters = {"coalesced": 0, "dropped": 0, "evicted": 0}
+queues = weakref.WeakSet()
+
+
+def queue_limit():
+    return getattr(settings, "WETALK_OUTBOUND_QUEUE_SIZE", 256)
+
+
+def overflow_policy():
+    policy = getattr(settings, "WETALK_OUTBOUND_POLICY", "coalesce")
+    if policy not in POLICIES:
+        raise ImproperlyConfigured(f"WETALK_OUTBOUND_POLICY must be one of {', '.join(POLICIES)}.")
+    return policy
+
+
+class OutboundQueue:
+    """
+    Bounded send queue for one socket. Handlers `put` frames and return at
+    once; a drain task started on demand awaits the real `send`, so a client
+    that stops reading only backs up its own queue instead of the consumer's
+    channel-layer inbox.
+
+    When the queue holds `limit` frames the policy decides what happens:
+
+    - coalesce: frames put with a key (pings, seen receipts) replace the
+      queued frame with the same key, and the oldest frame is dropped when
+      the queue is still full;
+    - drop_oldest: the oldest frame is dropped;
+    - disconnect: the queue is discarded and `on_evict` is called.
+
+    Dropped messages are still in the history, clients catch up with
+    "load_more".
+    """
+
+    def __init__(self, send, on_evict, limit=None, policy=None):
+        self.send = send
+        self.on_evict = on_evict
+        self.limit = limit or queue_limit()
+        self.policy = policy or overflow_policy()
+        # entries are [key, frame] so coalescing can swap the frame in place
+        self.frames = collections.deque()
+        self.keyed = {}
+        self.task = None
+        self.closed = False
+        queues.add(self)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, frame, key=None):
+        if self.closed:
+            return
+        if key is not None and self.policy == "coalesce":
+            entry = self.keyed.get(key)
+            if entry is not None:
+                entry[1] = frame
+                counters["coalesced"] += 1
+                return
+
+        if len(self.frames) >= self.limit:
+            if self.policy == "disconnect":
+                self.evict()
+                return
+            self._forget(self.frames.popleft())
+            counters["dropped"] += 1
+
+        entry = [key, frame]
+        self.frames.append(entry)
+        if key is not None and self.policy == "coalesce":
+            self.keyed[key] = entry
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._drain())
+
+    def evict(self):
+        counters["evicted"] += 1
+        self.close()
+        self.on_evict()
+
+    def close(self):
+        self.closed = True
+        self.frames.clear()
+        self.keyed.clear()
+        if self.task is not None:
+            self.task.cancel()
+
+    def _forget(self, entry):
+        if entry[0] is not None and self.keyed.get(entry[0]) is entry:
+            del self.keyed[entry[0]]
+
+    async def _drain(self):
+        while self.frames:
+            entry = self.frames.popleft()
+            self._forget(entry)
+            try:
+                await self.send(**entry[1])
+            except Exception as e:
+                logger.warning("Dropping outbound queue after a failed send: %r", e)
+                self.task = None
+                self.close()
+                return
+
+
+def outbound_stats():
+    depths = [len(queue) for queue in list(queues) if not queue.closed]
+    return {
+        "connections": len(depths),
+        "queued": sum(depths),
+        "max_depth": max(depths, default=0),
+        **counters,
+    }
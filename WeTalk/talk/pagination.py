@@ -0,0 +1,76 @@
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from .history import akeyset_page, get_page_size, keyset_page
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Newest-first message pages keyed on (time_stamp, id).
+
+    DRF's CursorPagination only keys on the first ordering field and falls back
+    to an offset for ties, this one seeks straight to the composite index.
+    """
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    max_page_size = 200
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return get_page_size()
+        return max(1, min(page_size, self.max_page_size))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        before = request.query_params.get(self.cursor_query_param)
+
+        try:
+            page, self.next_cursor = keyset_page(
+                queryset, before=before, limit=self.get_page_size(request),
+                archived=getattr(view, "archived_page", None),
+            )
+        except ValueError:
+            raise NotFound("Invalid cursor.")
+        return page
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """paginate_queryset for the async views, with the view's `aarchived_page`."""
+        self.request = request
+        before = request.query_params.get(self.cursor_query_param)
+
+        try:
+            page, self.next_cursor = await akeyset_page(
+                queryset, before=before, limit=self.get_page_size(request),
+                archived=getattr(view, "aarchived_page", None),
+            )
+        except ValueError:
+            raise NotFound("Invalid cursor.")
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next": self.get_next_link(),
+            "cursor": self.next_cursor,
+            "results": data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "cursor": {"type": "string", "nullable": True},
+                "results": schema,
+            },
+        }
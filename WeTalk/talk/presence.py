@@ -0,0 +1,133 @@
+import atexit
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .background import PeriodicFlusher
+from .metrics import database_sync_to_async
+from .models import ActiveConnection
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot_interval():
+    return getattr(settings, "WETALK_PRESENCE_SNAPSHOT_INTERVAL", 30)
+
+
+class PresenceTracker(PeriodicFlusher):
+    """
+    Who is connected to which room in this process, and when they were last
+    active. Activity only updates memory; ActiveConnection is refreshed from it
+    every WETALK_PRESENCE_SNAPSHOT_INTERVAL seconds so other processes and
+    reports can see a coarse picture.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # (user_id, room_name) -> [open sockets, last_active]
+        self.connections = {}
+        self.gone = set()
+
+    @property
+    def flush_interval(self):
+        return snapshot_interval()
+
+    def connect(self, user_id, room_name):
+        key = (user_id, room_name)
+        entry = self.connections.setdefault(key, [0, None])
+        entry[0] += 1
+        entry[1] = timezone.now()
+        self.gone.discard(key)
+        self.start_flusher()
+
+    def touch(self, user_id, room_name):
+        entry = self.connections.get((user_id, room_name))
+        if entry is not None:
+            entry[1] = timezone.now()
+
+    def disconnect(self, user_id, room_name):
+        key = (user_id, room_name)
+        entry = self.connections.get(key)
+        if entry is None:
+            return
+        entry[0] -= 1
+        if entry[0] <= 0:
+            del self.connections[key]
+            self.gone.add(key)
+
+    def is_online(self, user_id, room_name=None):
+        if room_name is not None:
+            return (user_id, room_name) in self.connections
+        return any(key[0] == user_id for key in self.connections)
+
+    def online_users(self, room_name):
+        return {user_id for user_id, room in self.connections if room == room_name}
+
+    def last_active(self, user_id, room_name):
+        entry = self.connections.get((user_id, room_name))
+        return entry[1] if entry else None
+
+    async def flush(self):
+        live = {key: entry[1] for key, entry in self.connections.items()}
+        gone, self.gone = self.gone, set()
+        try:
+            await database_sync_to_async(self._write)(live, gone)
+        except Exception:
+            self.gone |= gone - set(self.connections)
+            logger.exception("Presence snapshot failed")
+
+    def flush_sync(self):
+        # the process is going away, so everything it tracked is offline now
+        gone = self.gone | set(self.connections)
+        self.connections, self.gone = {}, set()
+        try:
+            self._write({}, gone)
+        except Exception:
+            logger.exception("Could not clear presence rows on shutdown")
+
+    def _write(self, live, gone):
+        now = timezone.now()
+        if live:
+            ActiveConnection.objects.bulk_create(
+                [
+                    ActiveConnection(user_id=user_id, room_name=room_name, last_active=last_active, refreshed_at=now)
+                    for (user_id, room_name), last_active in live.items()
+                ],
+                update_conflicts=True,
+                unique_fields=["user", "room_name"],
+                update_fields=["last_active", "refreshed_at"],
+                batch_size=500,
+            )
+        gone = list(gone)
+        for start in range(0, len(gone), 100):
+            condition = Q()
+            for user_id, room_name in gone[start:start + 100]:
+                condition |= Q(user_id=user_id, room_name=room_name)
+            ActiveConnection.objects.filter(condition).delete()
+
+
+presence = PresenceTracker()
+atexit.register(presence.flush_sync)
+
+
+def stale_cutoff():
+    # a row its process hasn't refreshed for a few snapshots belongs to a dead process
+    return timezone.now() - timedelta(seconds=snapshot_interval() * 3)
+
+
+def is_online(user_id, room_name=None):
+    """Check this process first, then the snapshots written by the others."""
+    if presence.is_online(user_id, room_name):
+        return True
+    rows = ActiveConnection.objects.filter(user_id=user_id, refreshed_at__gte=stale_cutoff())
+    if room_name is not None:
+        rows = rows.filter(room_name=room_name)
+    return rows.exists()
+
+
+def online_users(room_name):
+    remote = ActiveConnection.objects.filter(room_name=room_name, refreshed_at__gte=stale_cutoff())
+    return presence.online_users(room_name) | set(remote.values_list("user_id", flat=True))
@@ -0,0 +1,128 @@
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+
+class LocalBucketStore:
+    """
+    Token buckets in a dict, for one process. A bucket that has refilled
+    is the same as no bucket, so full ones are pruned once the dict grows
+    past `maxsize`.
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.buckets = {}
+
+    async def take(self, buckets):
+        """
+        Take one token from every (key, rate, burst) bucket, or from none of
+        them. Returns None, or the key of the first empty bucket and the
+        seconds until it has a token.
+        """
+        now = time.monotonic()
+        refilled = []
+        for key, rate, burst in buckets:
+            tokens, stamp, _ = self.buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            if tokens < 1:
+                return key, (1 - tokens) / rate
+            refilled.append(tokens - 1)
+        for (key, rate, burst), tokens in zip(buckets, refilled):
+            self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        if len(self.buckets) > self.maxsize:
+            self.prune(now)
+        return None
+
+    def prune(self, now):
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+
+    def clear(self):
+        self.buckets.clear()
+
+
+class CacheBucketStore:
+    """
+    The same buckets in a Django cache, so every process serving a user
+    shares one budget. Read-modify-write is not atomic; a burst racing
+    across processes can overshoot by a token or two, which is fine for
+    flood control.
+    """
+
+    def __init__(self, alias="default"):
+        self.cache = caches[alias]
+
+    async def take(self, buckets):
+        now = time.time()
+        cache_keys = {key: f"wetalk:ratelimit:{key}" for key, _, _ in buckets}
+        stored = await self.cache.aget_many(cache_keys.values())
+        refilled = {}
+        for key, rate, burst in buckets:
+            tokens, stamp = stored.get(cache_keys[key], (burst, now))
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            if tokens < 1:
+                return key, (1 - tokens) / rate
+            refilled[cache_keys[key]] = (tokens - 1, now)
+        timeout = max(math.ceil(burst / rate) for _, rate, burst in buckets) + 1
+        await self.cache.aset_many(refilled, timeout=timeout)
+        return None
+
+    def clear(self):
+        pass
+
+
+def get_store():
+    store = getattr(settings, "WETALK_RATE_LIMIT_STORE", "local")
+    if store == "local":
+        return LocalBucketStore()
+    if store.startswith("cache"):
+        # "cache" or "cache:<alias>"
+        return CacheBucketStore(store.partition(":")[2] or "default")
+    raise ImproperlyConfigured("WETALK_RATE_LIMIT_STORE must be 'local', 'cache' or 'cache:<alias>'.")
+
+
+class RateLimiter:
+    """
+    Per-user and per-room token buckets for messages sent over sockets.
+    Limits are (messages per second, burst) pairs read from
+    WETALK_RATE_LIMIT_USER and WETALK_RATE_LIMIT_ROOM; None turns one off.
+    """
+
+    def __init__(self, store=None):
+        self._store = store
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = get_store()
+        return self._store
+
+    async def check(self, user_id, room_id):
+        """None when the message may go through, otherwise the throttle error frame."""
+        # both buckets are checked before either loses a token
+        scopes = {}
+        for scope, key, limit in (
+            ("user", f"user:{user_id}", getattr(settings, "WETALK_RATE_LIMIT_USER", (5, 20))),
+            ("room", f"room:{room_id}", getattr(settings, "WETALK_RATE_LIMIT_ROOM", (20, 60))),
+        ):
+            if limit:
+                scopes[key] = (scope, limit)
+        if not scopes:
+            return None
+        throttled = await self.store.take([(key, *limit) for key, (_, limit) in scopes.items()])
+        if throttled is None:
+            return None
+        key, retry_after = throttled
+        return {
+            "type": "error",
+            "code": "throttled",
+            "scope": scopes[key][0],
+            "retry_after": round(retry_after, 3),
+            "error": f"Too many messages, retry in {retry_after:.1f}s.",
+        }
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,63 @@
+import logging
+
+from django.conf import settings
+from django.db import transaction
+
+from .background import PeriodicFlusher
+from .events import dispatch_seen
+from .metrics import database_sync_to_async
+from .models import ChatRoom, Message
+
+logger = logging.getLogger(__name__)
+
+
+def mark_read_up_to(room, reader, up_to):
+    """
+    Mark everything the reader received in `room` up to message id `up_to` as
+    read with one range UPDATE, and reset the reader's unread counter from
+    what is left. Returns the number of messages that changed.
+    """
+    received = Message.objects.filter(chat_room_id=room.id, is_read=False).exclude(sender_id=reader.id)
+    with transaction.atomic():
+        marked = received.filter(id__lte=up_to).update(is_read=True)
+        if marked:
+            side = "user1_unread" if room.user1_id == reader.id else "user2_unread"
+            ChatRoom.objects.filter(id=room.id).update(**{side: received.count()})
+    return marked
+
+
+class ReadReceiptCoalescer(PeriodicFlusher):
+    """
+    Collects read acks from sockets for WETALK_READ_RECEIPT_WINDOW_MS and keeps
+    only the highest id per reader and room, so a client acking every message
+    it renders still costs one UPDATE and one "seen" event per window.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # (room_id, reader_id) -> (room, reader, up_to)
+        self.pending = {}
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, "WETALK_READ_RECEIPT_WINDOW_MS", 250) / 1000
+
+    def add(self, room, reader, up_to):
+        key = (room.id, reader.id)
+        if key in self.pending:
+            up_to = max(up_to, self.pending[key][2])
+        self.pending[key] = (room, reader, up_to)
+        self.start_flusher()
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        for room, reader, up_to in batch.values():
+            try:
+                marked = await database_sync_to_async(mark_read_up_to)(room, reader, up_to)
+                if marked:
+                    await dispatch_seen(room.id, reader.username, up_to)
+            except Exception:
+                logger.exception("Could not mark room %s read for user %s", room.id, reader.id)
+
+
+read_receipts = ReadReceiptCoalescer()
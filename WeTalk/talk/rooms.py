@@ -0,0 +1,37 @@
+from django.conf import settings
+
+from users.cache import TTLCache
+
+from .models import ChatRoom, User
+
+# (user id, peer username) -> (peer id, room id), so reconnecting sockets find their room without the DB.
+# Saves and deletes in this process drop entries at once, other processes' copies age out after the TTL.
+room_cache = TTLCache(
+    maxsize=getattr(settings, "WETALK_ROOM_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "WETALK_ROOM_CACHE_TTL", 300),
+)
+
+
+def cached_room(user, peer_username):
+    """The room from room_cache, carrying only its id and user ids, or None on a miss."""
+    entry = room_cache.get((user.id, peer_username))
+    if entry is None:
+        return None
+    peer_id, room_id = entry
+    return ChatRoom(id=room_id, user1_id=min(user.id, peer_id), user2_id=max(user.id, peer_id))
+
+
+async def resolve_room(user, peer_username):
+    """
+    The ChatRoom between `user` and `peer_username` from the database,
+    created on first use, or None when there is no such user. Fills
+    room_cache for the next connect.
+    """
+    peer = await User.objects.filter(username=peer_username).afirst()
+    if peer is None:
+        return None
+    # Enforce consistent order to avoid duplicate rooms
+    user1, user2 = sorted((user, peer), key=lambda u: u.id)
+    room, _ = await ChatRoom.objects.aget_or_create(user1=user1, user2=user2)
+    room_cache.set((user.id, peer_username), (peer.id, room.id))
+    return room
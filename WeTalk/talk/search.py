@@ -0,0 +1,215 @@
+import base64
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+from .models import ChatRoom, Message
+
+# words are matched whole, anything else in the query is ignored
+TOKEN_RE = re.compile(r"\w+")
+SNIPPET_MARKERS = ("[", "]")
+SNIPPET_WORDS = 12
+
+
+def encode_cursor(score, id, top=0):
+    return base64.urlsafe_b64encode(f"{score!r}|{id}|{top}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        score, id, top = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return float(score), int(id), int(top)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor.")
+
+
+def query_terms(query):
+    return [term.casefold() for term in TOKEN_RE.findall(query)]
+
+
+def bm25(texts, terms, k1=1.2, b=0.75):
+    """
+    BM25 scores for texts that all contain every term. IDF is then the same
+    for every text, so only term frequency and length are weighed.
+    """
+    docs = [TOKEN_RE.findall(text.casefold()) for text in texts]
+    average = sum(map(len, docs)) / len(docs) or 1
+    scores = []
+    for tokens in docs:
+        norm = k1 * (1 - b + b * len(tokens) / average)
+        scores.append(sum(tf * (k1 + 1) / (tf + norm) for tf in (tokens.count(term) for term in terms)))
+    return scores
+
+
+def make_snippet(text, terms, size=SNIPPET_WORDS):
+    """A few words around the first match, matched words wrapped in SNIPPET_MARKERS."""
+    words = text.split()
+    hits = {
+        i for i, word in enumerate(words)
+        if any(token.casefold() in terms for token in TOKEN_RE.findall(word))
+    }
+    start = max(0, min(hits, default=0) - size // 3)
+    end = min(len(words), start + size)
+    opening, closing = SNIPPET_MARKERS
+    snippet = " ".join(f"{opening}{words[i]}{closing}" if i in hits else words[i] for i in range(start, end))
+    return ("…" if start else "") + snippet + ("…" if end < len(words) else "")
+
+
+class SearchBackend:
+    """
+    Searches the messages of every room `user` is in, or of one of them.
+    `search` returns a page of result dicts (id, chat_room, sender,
+    timestamp, snippet, window) best match first, and the cursor for the
+    next page or None. Results are ranked within their window, see
+    SQLiteFTSBackend; backends without windows leave it None.
+    """
+
+    def search(self, user, query, room_id=None, cursor=None, limit=20):
+        raise NotImplementedError
+
+    def results(self, ids, texts, terms, window=None):
+        rows = Message.objects.filter(id__in=ids).values("id", "chat_room_id", "sender__username", "time_stamp")
+        rows = {row["id"]: row for row in rows}
+        return [
+            {
+                "id": id,
+                "chat_room": rows[id]["chat_room_id"],
+                "sender": rows[id]["sender__username"],
+                "timestamp": rows[id]["time_stamp"].isoformat(),
+                "snippet": make_snippet(texts[id], terms),
+                "window": window,
+            }
+            for id in ids
+        ]
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """
+    Matches from the talk_message_fts index (migration 0008), BM25-ranked.
+
+    Matches are ranked WETALK_SEARCH_WINDOW at a time, newest window first:
+    the index walks one window newest first and stops, so a word that is in
+    half of all messages costs about the same as a rare one. FTS5's own
+    bm25() is not used because it reads every posting of every term to count
+    documents. The newest id of the window travels in the cursor so later
+    pages rank the same window, and once it is used up the cursor moves on
+    to the matches below it. Each result's "window" is that newest id, so a
+    client can tell where one ranking ends and the next begins.
+
+    An AND of a rare and a very common word would still walk the common
+    word's postings, so words found in more than WETALK_SEARCH_COMMON_WORD of
+    the newest messages are left out of the MATCH and checked on the
+    candidates' text instead. A window none of whose candidates pass that
+    check is skipped rather than ending the search.
+    """
+
+    candidates_sql = """
+        SELECT talk_message.id, talk_message.text FROM (
+            SELECT rowid FROM talk_message_fts
+            WHERE talk_message_fts MATCH %s AND rowid <= %s
+            ORDER BY rowid DESC
+            LIMIT %s
+        ) hit
+        JOIN talk_message ON talk_message.id = hit.rowid
+    """
+
+    sample_sql = "SELECT count(*) FROM talk_message_fts WHERE talk_message_fts MATCH %s AND rowid > %s"
+
+    def split_common(self, db, terms):
+        """(terms for the MATCH, terms to check on the text)"""
+        if len(terms) == 1:
+            return terms, []
+        sample = getattr(settings, "WETALK_SEARCH_SAMPLE", 10000)
+        db.execute("SELECT max(id) FROM talk_message")
+        newest = db.fetchone()[0] or 0
+        share = {}
+        for term in terms:
+            db.execute(self.sample_sql, [f'text:"{term}"', newest - sample])
+            share[term] = db.fetchone()[0] / max(1, min(sample, newest))
+        common = getattr(settings, "WETALK_SEARCH_COMMON_WORD", 0.05)
+        rarest = min(terms, key=share.get)
+        matched = [term for term in terms if term == rarest or share[term] <= common]
+        return matched, [term for term in terms if term not in matched]
+
+    def search(self, user, query, room_id=None, cursor=None, limit=20):
+        terms = query_terms(query)
+        if not terms:
+            return [], None
+        # an id of 0 starts the window below `top` from its best match
+        score_after, id_after, top = decode_cursor(cursor) if cursor else (0.0, 0, 2 ** 63 - 1)
+        window = getattr(settings, "WETALK_SEARCH_WINDOW", 1000)
+
+        with connection.cursor() as db:
+            matched, filtered = self.split_common(db, terms)
+            words = " ".join(f'"{term}"' for term in matched)
+            match = f'text:({words}) AND members:"u{user.id}"'
+            if room_id is not None:
+                match += f' AND chat_room_id:"{room_id}"'
+
+            while True:
+                db.execute(self.candidates_sql, [match, top, window])
+                candidates = sorted(db.fetchall(), reverse=True)
+                if not candidates:
+                    return [], None
+                window_top = candidates[0][0]
+                # a full window may have older matches below it
+                below = candidates[-1][0] - 1 if len(candidates) == window else None
+
+                if filtered:
+                    candidates = [
+                        (id, text) for id, text in candidates
+                        if set(filtered) <= set(TOKEN_RE.findall(text.casefold()))
+                    ]
+                ranked, texts = [], {}
+                if candidates:
+                    texts = dict(candidates)
+                    scores = bm25(list(texts.values()), terms)
+                    # best score first, newest first among equal scores
+                    ranked = sorted(zip((-score for score in scores), (-id for id in texts)))
+                    if id_after:
+                        ranked = [key for key in ranked if key > (-score_after, -id_after)]
+                if ranked or below is None:
+                    break
+                # nothing (left) in this window, go on to the next one
+                top, id_after = below, 0
+
+        next_cursor = None
+        if len(ranked) > limit:
+            score, id = ranked[limit - 1]
+            next_cursor = encode_cursor(-score, -id, window_top)
+        elif below is not None:
+            next_cursor = encode_cursor(0.0, 0, below)
+        return self.results([-id for _, id in ranked[:limit]], texts, terms, window=window_top), next_cursor
+
+
+class ScanSearchBackend(SearchBackend):
+    """
+    Newest-first substring matches without an index, for databases that
+    have no FTS migration. Fine for development, a full scan in production.
+    """
+
+    def search(self, user, query, room_id=None, cursor=None, limit=20):
+        terms = query_terms(query)
+        if not terms:
+            return [], None
+        queryset = Message.objects.filter(chat_room__in=ChatRoom.objects.for_user(user))
+        if room_id is not None:
+            queryset = queryset.filter(chat_room_id=room_id)
+        for term in terms:
+            queryset = queryset.filter(text__icontains=term)
+        if cursor:
+            queryset = queryset.filter(id__lt=decode_cursor(cursor)[1])
+        rows = list(queryset.order_by("-id").values_list("id", "text")[:limit + 1])
+
+        next_cursor = encode_cursor(0.0, rows[limit - 1][0]) if len(rows) > limit else None
+        rows = rows[:limit]
+        return self.results([id for id, _ in rows], dict(rows), terms), next_cursor
+
+
+def get_search_backend():
+    path = getattr(settings, "WETALK_SEARCH_BACKEND", None)
+    if path is None:
+        path = "talk.search.SQLiteFTSBackend" if connection.vendor == "sqlite" else "talk.search.ScanSearchBackend"
+    return import_string(path)()
@@ -1,3 +1,5 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 from talk.models import User, Contact, ChatRoom, Message
 from rest_framework.validators import UniqueValidator
@@ -31,35 +33,38 @@ class ContactSerializer(serializers.ModelSerializer):
         fields = ('id', 'contact', 'contact_username', 'created_at')
         
     def validate_contact_username(self, value):
-        try:
-            contact_username = User.objects.get(username=value)
-        except User.DoesNotExist:
-            raise serializers.ValidationError("User with this username does not exist.")
-        
-        if self.context['request'].user == contact_username:
+        if self.context['request'].user.username == value:
             raise serializers.ValidationError("You cannot add yourself as a contact.")
-        
-        return value
+
+        # the only lookup: create() gets the user itself
+        contact_user = User.objects.filter(username=value).first()
+        if contact_user is None:
+            raise serializers.ValidationError("User with this username does not exist.")
+        return contact_user
     
     
     def create(self, validated_data):
         request_user = self.context['request'].user
-        contact_username = validated_data.pop('contact_username')
+        contact_user = validated_data.pop('contact_username')
 
-        if Contact.objects.filter(user=request_user, contact__username=contact_username).exists():
+        # the unique constraint catches duplicates, no separate exists() query
+        try:
+            with transaction.atomic():
+                contact = Contact.objects.create(
+                    user=request_user,
+                    contact=contact_user,
+                )
+        except IntegrityError:
             raise serializers.ValidationError("This contact is already added.")
 
-        try:
-            contact_user = User.objects.get(username=contact_username)
-        except User.DoesNotExist:
-             raise serializers.ValidationError("The specified user does not exist.")
+        return contact
 
-        contact = Contact.objects.create(
-            user=request_user,
-            contact=contact_user,  
-        )
 
-        return contact
+class ContactImportSerializer(serializers.Serializer):
+    usernames = serializers.ListField(
+        child=serializers.CharField(max_length=150), allow_empty=False,
+        max_length=getattr(settings, "WETALK_CONTACT_IMPORT_MAX", 1000),
+    )
     
     
 class ChatRoomSerializer(serializers.ModelSerializer):
@@ -106,8 +111,8 @@ class MessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Message
-        fields = ["id", "chat_room", "sender", "text", "time_stamp", "is_read"]
-        read_only_fields = ["time_stamp", "is_read"]
+        fields = ["id", "seq", "chat_room", "sender", "text", "time_stamp", "is_read"]
+        read_only_fields = ["seq", "time_stamp", "is_read"]
 
     def validate(self, data):
         request_user = self.context["request"].user
@@ -120,4 +125,41 @@ class MessageSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         validated_data["sender"] = self.context["request"].user
-        return super().create(validated_data)
\ No newline at end of file
+        return Message.objects.persist([Message(**validated_data)])[0]
+
+
+class InboxSerializer(serializers.ModelSerializer):
+    peer = serializers.SerializerMethodField()
+    last_message = serializers.SerializerMethodField()
+    unread_count = serializers.SerializerMethodField()
+
+    class Meta:
+        model = ChatRoom
+        fields = ('id', 'peer', 'last_message', 'unread_count')
+
+    def get_peer(self, obj):
+        peer = obj.peer_of(self.context["request"].user)
+        return {"id": peer.id, "username": peer.username}
+
+    def get_last_message(self, obj):
+        if obj.last_message_at is None:
+            return None
+        sender = obj.last_message_sender
+        return {
+            "sender": sender.username if sender else None,
+            "text": obj.last_message_text,
+            "timestamp": obj.last_message_at,
+        }
+
+    def get_unread_count(self, obj):
+        return obj.unread_for(self.context["request"].user)
+
+
+class MarkReadSerializer(serializers.Serializer):
+    chat_room = serializers.PrimaryKeyRelatedField(queryset=ChatRoom.objects.all())
+    up_to = serializers.IntegerField(min_value=1)
+
+    def validate_chat_room(self, value):
+        if self.context["request"].user.id not in (value.user1_id, value.user2_id):
+            raise serializers.ValidationError("You are not a participant in this chatroom.")
+        return value
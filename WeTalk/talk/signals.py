@@ -1,21 +1,23 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from .models import Message
 
-@receiver(post_save, sender=Message)
-def message_created_signal(sender, instance, created, **kwargs):
-    if created:
-        channel_layer = get_channel_layer()
-        room_group = f'chat_{instance.chat_room.id}'
-        
-        
-        async_to_sync(channel_layer.group_send)(
-            room_group, {
-                "type": "chat.notification",
-                "notification": f"New message from {instance.sender.username}",
-                "sender": instance.sender.username,
-                "chat_room": instance.chat_room.id,
-            }
-        )
\ No newline at end of file
+from .models import ChatRoom, User
+from .rooms import room_cache
+
+
+@receiver(post_save, sender=User)
+def user_saved_drop_cached_rooms(sender, instance, update_fields=None, **kwargs):
+    # a rename frees the old username, logins only touch last_login
+    if update_fields and set(update_fields) <= {"last_login"}:
+        return
+    room_cache.discard_where(lambda entry: entry[0] == instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted_drop_cached_rooms(sender, instance, **kwargs):
+    room_cache.discard_where(lambda entry: entry[0] == instance.pk)
+
+
+@receiver(post_delete, sender=ChatRoom)
+def room_deleted_drop_cached_rooms(sender, instance, **kwargs):
+    room_cache.discard_where(lambda entry: entry[1] == instance.pk)
@@ -1,14 +1,20 @@
 from celery import shared_task
-from django.utils import timezone
-from datetime import timedelta
+from .archive import archive_messages
 from .models import ActiveConnection
+from .presence import stale_cutoff
 
+
+# Live sockets are pinged and reaped in-process by talk.heartbeat and every
+# process refreshes its own ActiveConnection rows, so this only cleans up rows
+# left behind by processes that died without running their exit hooks.
+@shared_task
+def reconcile_active_connections():
+    leftovers = ActiveConnection.objects.filter(refreshed_at__lt=stale_cutoff())
+    count, _ = leftovers.delete()
+    return f"Removed {count} stale connection rows"
+
+
+# Keeps talk_message bounded, see talk.archive.
 @shared_task
-def close_inactive_connections():
-    cutoff = timezone.now() - timedelta(minutes=10)
-    inactive_connections = ActiveConnection.objects.filter(last_active__lt=cutoff)
-    count = inactive_connections.count()
-
-    # Delete inactive connections
-    inactive_connections.delete()
-    return f"Closed {count} inactive connections"
+def archive_old_messages():
+    return f"Archived {archive_messages()} messages"
@@ -1,3 +1,1286 @@
-from django.test import TestCase
+import asyncio
+import json
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import OperationalError, connection
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from WeTalk.querybudget import QueryBudgetMiddleware, QueryBudgetTestMixin
+from .archive import FIELDS as ARCHIVE_FIELDS, archive, archive_messages, segment_maps
+from .encoding import MSGPACK_SUBPROTOCOL, dumps, pack, unpack
+from .events import message_event
+from .executor import database_sync_to_async, db_executor
+from . import metrics
+from .layers import HashRing, HybridChannelLayer, ShardedChannelLayer
+from .heartbeat import CLOSE_HEARTBEAT_TIMEOUT, CLOSE_IDLE, HeartbeatMonitor
+from .history import decode_cursor, fetch_history, fetch_since
+from .models import User, Contact, ChatRoom, Message, ActiveConnection
+from .outbound import OutboundQueue, outbound_stats
+from .presence import PresenceTracker, presence
+from .ratelimit import CacheBucketStore, LocalBucketStore, RateLimiter, get_store, rate_limiter
+from .receipts import ReadReceiptCoalescer, mark_read_up_to
+from .rooms import cached_room, resolve_room, room_cache
+from .tasks import reconcile_active_connections
+from .views import ChatRoomViewSet
+from .routing import websocket_urlpatterns
+from .search import ScanSearchBackend, SQLiteFTSBackend
+from .writebehind import MessageBuffer, message_buffer
+
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+}
+
+
+def in_memory_shards(count):
+    return [{"NAME": f"shard{i}", "BACKEND": "channels.layers.InMemoryChannelLayer"} for i in range(count)]
+
+
+def as_user(app, user):
+    # stands in for JWTAuthMiddleware so the tests don't need to mint cookies
+    async def wrapper(scope, receive, send):
+        return await app(dict(scope, user=user), receive, send)
+    return wrapper
+
+
+def make_messages(room, sender, count):
+    return [Message.objects.create(chat_room=room, sender=sender, text=f"msg {i}") for i in range(count)]
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS,
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    # executor threads have their own connections, which can't see the test's transaction
+    WETALK_DB_EXECUTOR_SIZE=0,
+)
+class ChatTestCase(TestCase):
+
+    def setUp(self):
+        # welcome emails go through Celery, which has no broker under test
+        patcher = mock.patch("users.signals.send_welcome_email")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # ids come back after each test's rollback, cached rooms must not outlive it
+        self.addCleanup(room_cache.clear)
+
+        self.alice = User.objects.create_user(username="alice", email="alice@example.com", password="pass12345")
+        self.bob = User.objects.create_user(username="bob", email="bob@example.com", password="pass12345")
+        self.room = ChatRoom.objects.create(user1=self.alice, user2=self.bob)
+
+
+@override_settings(WETALK_HISTORY_PAGE_SIZE=3)
+class HistoryTests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.messages = make_messages(self.room, self.alice, 7)
+
+    # ---------------------- Keyset pages ----------------------
+    def test_first_page_is_latest_messages_oldest_first(self):
+        rows, cursor = fetch_history(self.room.id)
+        self.assertEqual([r["id"] for r in rows], [m.id for m in self.messages[-3:]])
+        self.assertIsNotNone(cursor)
+
+    def test_pages_walk_back_to_the_start(self):
+        rows, cursor = fetch_history(self.room.id)
+        seen = [r["id"] for r in rows]
+        while cursor:
+            rows, cursor = fetch_history(self.room.id, before=cursor)
+            seen = [r["id"] for r in rows] + seen
+        self.assertEqual(seen, [m.id for m in self.messages])
+
+    def test_pages_split_messages_with_equal_timestamps(self):
+        Message.objects.filter(chat_room=self.room).update(time_stamp=self.messages[0].time_stamp)
+        rows, cursor = fetch_history(self.room.id)
+        older, _ = fetch_history(self.room.id, before=cursor)
+        self.assertEqual(decode_cursor(cursor)[1], rows[0]["id"])
+        self.assertTrue(all(r["id"] < rows[0]["id"] for r in older))
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            fetch_history(self.room.id, before="not-a-cursor")
+
+    # ---------------------- Consumer replay ----------------------
+    async def test_connect_sends_one_batched_history_frame(self):
+        app = as_user(URLRouter(websocket_urlpatterns), self.bob)
+        communicator = WebsocketCommunicator(app, "/ws/chat/alice/")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "history")
+        self.assertEqual(len(frame["messages"]), 3)
+        self.assertTrue(frame["has_more"])
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.send_json_to({"command": "load_more", "cursor": frame["cursor"]})
+        older = await communicator.receive_json_from()
+        self.assertEqual([m["message"] for m in older["messages"]], ["msg 1", "msg 2", "msg 3"])
+        await communicator.disconnect()
+
+
+@override_settings(WETALK_HISTORY_PAGE_SIZE=3)
+class MessageHistoryAPITests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.messages = make_messages(self.room, self.bob, 5)
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_list_requires_chat_room(self):
+        for params in ({}, {"chat_room": "\u00b2"}, {"chat_room": "-1"}):
+            response = self.client.get("/wetalk/messages/", params)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_follows_cursor_newest_first(self):
+        first = self.client.get("/wetalk/messages/", {"chat_room": self.room.id}).json()
+        self.assertEqual([m["id"] for m in first["results"]], [m.id for m in self.messages[:1:-1]])
+
+        second = self.client.get("/wetalk/messages/", {"chat_room": self.room.id, "cursor": first["cursor"]}).json()
+        self.assertEqual([m["id"] for m in second["results"]], [m.id for m in self.messages[1::-1]])
+        self.assertIsNone(second["next"])
+
+    def test_invalid_cursor_is_not_found(self):
+        response = self.client.get("/wetalk/messages/", {"chat_room": self.room.id, "cursor": "bogus"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_hides_rooms_of_other_users(self):
+        carol = User.objects.create_user(username="carol", email="carol@example.com", password="pass12345")
+        self.client.force_authenticate(carol)
+        response = self.client.get("/wetalk/messages/", {"chat_room": self.room.id})
+        self.assertEqual(response.json()["results"], [])
+
+    def test_reads_are_async_views(self):
+        for url in ("/wetalk/messages/", "/wetalk/chatrooms/", "/wetalk/chatrooms/inbox/"):
+            self.assertTrue(iscoroutinefunction(resolve(url).func), url)
+
+    def test_reads_authenticate_with_jwt(self):
+        client = APIClient()
+        self.assertEqual(client.get("/wetalk/chatrooms/").status_code, status.HTTP_401_UNAUTHORIZED)
+        client.credentials(HTTP_AUTHORIZATION="Bearer bogus")
+        self.assertEqual(client.get("/wetalk/chatrooms/").status_code, status.HTTP_401_UNAUTHORIZED)
+
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.alice)}")
+        self.assertEqual([room["id"] for room in client.get("/wetalk/chatrooms/").json()], [self.room.id])
+        self.assertEqual(len(client.get("/wetalk/messages/", {"chat_room": self.room.id}).json()["results"]), 3)
+
+    def test_reads_keep_the_viewset_policies(self):
+        response = self.client.get("/wetalk/chatrooms/", {"format": "api"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/html; charset=utf-8")
+
+        throttle = mock.Mock(allow_request=mock.Mock(return_value=False), wait=mock.Mock(return_value=None))
+        with mock.patch.object(ChatRoomViewSet, "get_throttles", return_value=[throttle]):
+            self.assertEqual(self.client.get("/wetalk/chatrooms/").status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_writes_still_go_to_the_viewset(self):
+        with mock.patch("talk.views.dispatch_message_sync"):
+            response = self.client.post("/wetalk/messages/", {"chat_room": self.room.id, "text": "hello"})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.client.delete("/wetalk/chatrooms/inbox/").status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@override_settings(WETALK_WRITE_BEHIND=True, WETALK_WRITE_BEHIND_FLUSH_MS=10_000, WETALK_WRITE_BEHIND_BATCH_SIZE=3)
+class WriteBehindTests(ChatTestCase):
+
+    async def test_flushes_once_batch_size_is_reached(self):
+        buffer = MessageBuffer()
+        for i in range(3):
+            buffer.add(self.alice, self.room.id, f"msg {i}")
+        self.assertEqual(await Message.objects.acount(), 0)
+
+        await asyncio.sleep(0.05)
+        self.assertEqual(await Message.objects.acount(), 3)
+        self.assertEqual(buffer.snapshot()["pending"], 0)
+        self.assertEqual(buffer.stats["flushes"], 1)
+
+    async def test_pending_messages_keep_broadcast_timestamp(self):
+        buffer = MessageBuffer()
+        message = buffer.add(self.alice, self.room.id, "hello")
+        self.assertEqual(buffer.pending_for_room(self.room.id), [message])
+
+        await buffer.flush()
+        stored = await Message.objects.aget()
+        self.assertEqual(stored.time_stamp, message.time_stamp)
+
+    def test_flush_sync_writes_leftovers(self):
+        buffer = MessageBuffer()
+        buffer.pending.append((Message(sender=self.alice, chat_room=self.room, text="bye"), 0))
+        buffer.flush_sync()
+        self.assertEqual(Message.objects.get().text, "bye")
+
+    async def test_consumer_broadcasts_before_insert(self):
+        self.addCleanup(message_buffer.pending.clear)
+        app = as_user(URLRouter(websocket_urlpatterns), self.alice)
+        communicator = WebsocketCommunicator(app, "/ws/chat/bob/")
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "hi bob"})
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["message"], "hi bob")
+        self.assertEqual(await Message.objects.acount(), 0)
+        await communicator.disconnect()
+
+    @override_settings(WETALK_WRITE_BEHIND=True, WETALK_HISTORY_PAGE_SIZE=3)
+    async def test_history_pages_past_buffered_messages(self):
+        await database_sync_to_async(make_messages)(self.room, self.bob, 4)
+        self.addCleanup(message_buffer.pending.clear)
+        for text in ("new 0", "new 1"):
+            message_buffer.pending.append((Message(sender=self.alice, chat_room_id=self.room.id, text=text), 0))
+
+        communicator = WebsocketCommunicator(as_user(URLRouter(websocket_urlpatterns), self.alice), "/ws/chat/bob/")
+        await communicator.connect()
+        frame = await communicator.receive_json_from()
+        pages = [[m["message"] for m in frame["messages"]]]
+        while frame["has_more"]:
+            await communicator.send_json_to({"command": "load_more", "cursor": frame["cursor"]})
+            frame = await communicator.receive_json_from()
+            pages.insert(0, [m["message"] for m in frame["messages"]])
+        await communicator.disconnect()
+
+        self.assertEqual(pages[-1], ["msg 3", "new 0", "new 1"])
+        self.assertEqual(sum(pages, []), [f"msg {i}" for i in range(4)] + ["new 0", "new 1"])
+
+
+@override_settings(WETALK_DB_EXECUTOR_SIZE=0)
+class WriteBehindFailureTests(TransactionTestCase):
+    # foreign keys are only checked at commit, which a TestCase never reaches
+
+    def setUp(self):
+        # bulk_create skips the welcome-email signal
+        self.alice, self.bob, self.carol = User.objects.bulk_create(
+            User(username=name, email=f"{name}@example.com") for name in ("alice", "bob", "carol")
+        )
+        self.gone = ChatRoom.objects.create(user1=self.alice, user2=self.bob)
+        self.room = ChatRoom.objects.create(user1=self.alice, user2=self.carol)
+
+    def test_a_deleted_room_does_not_block_the_batch(self):
+        buffer = MessageBuffer()
+        buffer.pending.append((Message(sender=self.alice, chat_room_id=self.gone.id, text="lost"), 0))
+        self.gone.delete()
+        buffer.pending.append((Message(sender=self.alice, chat_room_id=self.room.id, text="kept"), 0))
+
+        with self.assertLogs("talk.writebehind", "ERROR"):
+            async_to_sync(buffer.flush)()
+        self.assertEqual(list(Message.objects.values_list("text", "seq")), [("kept", 1)])
+        self.assertEqual((buffer.pending, buffer.stats["dropped"], buffer.stats["failed_flushes"]), ([], 1, 1))
+
+    def test_operational_errors_keep_the_batch(self):
+        buffer = MessageBuffer()
+        buffer.pending.append((Message(sender=self.alice, chat_room_id=self.room.id, text="later"), 0))
+        with mock.patch.object(Message.objects, "persist", side_effect=OperationalError("database is locked")):
+            with self.assertLogs("talk.writebehind", "ERROR"):
+                async_to_sync(buffer.flush)()
+        self.assertEqual(len(buffer.pending), 1)
+
+        async_to_sync(buffer.flush)()
+        self.assertEqual(Message.objects.get().text, "later")
+
+
+class MessageFanOutTests(ChatTestCase):
+
+    async def test_one_frame_per_message_per_recipient(self):
+        app = URLRouter(websocket_urlpatterns)
+        alice = WebsocketCommunicator(as_user(app, self.alice), "/ws/chat/bob/")
+        bob = WebsocketCommunicator(as_user(app, self.bob), "/ws/chat/alice/")
+        for communicator in (alice, bob):
+            await communicator.connect()
+            await communicator.receive_json_from()
+
+        await alice.send_json_to({"message": "hi bob"})
+        for communicator in (alice, bob):
+            frame = await communicator.receive_json_from()
+            self.assertEqual(frame["type"], "message")
+            self.assertEqual(frame["message"], "hi bob")
+            self.assertEqual(frame["notification"], "New message from alice")
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+    @override_settings(WETALK_FAST_JSON=False)
+    def test_event_carries_frame_encoded_once(self):
+        message = Message.objects.persist([Message(chat_room=self.room, sender=self.alice, text="hi")])[0]
+        event = message_event(message)
+        self.assertEqual(set(event), {"type", "frame", "frame_msgpack"})
+        self.assertEqual(json.loads(event["frame"])["id"], message.id)
+        self.assertEqual(unpack(event["frame_msgpack"]), json.loads(event["frame"]))
+        self.assertEqual(dumps({"a": 1}), json.dumps({"a": 1}))
+
+    async def test_msgpack_subprotocol(self):
+        app = URLRouter(websocket_urlpatterns)
+        alice = WebsocketCommunicator(as_user(app, self.alice), "/ws/chat/bob/", subprotocols=[MSGPACK_SUBPROTOCOL])
+        bob = WebsocketCommunicator(as_user(app, self.bob), "/ws/chat/alice/")
+        connected, subprotocol = await alice.connect()
+        self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+        await bob.connect()
+        self.assertEqual(unpack(await alice.receive_from())["type"], "history")
+        await bob.receive_json_from()
+
+        await alice.send_to(bytes_data=pack({"message": "packed"}))
+        self.assertEqual(unpack(await alice.receive_from())["message"], "packed")
+        # the JSON client in the same room still gets text
+        self.assertEqual((await bob.receive_json_from())["message"], "packed")
+        for communicator in (alice, bob):
+            await communicator.disconnect()
+
+    def test_rest_messages_use_the_same_dispatch(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        with mock.patch("talk.views.dispatch_message_sync") as dispatch:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.post("/wetalk/messages/", {"chat_room": self.room.id, "text": "hello"})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        dispatch.assert_called_once_with(Message.objects.get())
+
+
+class PresenceTests(ChatTestCase):
+
+    def test_tracks_sockets_per_user_and_room(self):
+        tracker = PresenceTracker()
+        tracker.connections[(self.alice.id, "chat_1")] = [1, None]
+        tracker.touch(self.alice.id, "chat_1")
+        self.assertTrue(tracker.is_online(self.alice.id))
+        self.assertEqual(tracker.online_users("chat_1"), {self.alice.id})
+
+        tracker.disconnect(self.alice.id, "chat_1")
+        self.assertFalse(tracker.is_online(self.alice.id, "chat_1"))
+        self.assertEqual(tracker.gone, {(self.alice.id, "chat_1")})
+
+    async def test_snapshot_upserts_live_and_deletes_gone(self):
+        tracker = PresenceTracker()
+        tracker.connect(self.alice.id, "chat_1")
+        tracker.connect(self.alice.id, "chat_1")
+        tracker.connect(self.bob.id, "chat_1")
+        await tracker.flush()
+        await tracker.flush()
+        self.assertEqual(await ActiveConnection.objects.acount(), 2)
+
+        tracker.disconnect(self.alice.id, "chat_1")
+        tracker.disconnect(self.bob.id, "chat_1")
+        await tracker.flush()
+        self.assertEqual([c.user_id async for c in ActiveConnection.objects.all()], [self.alice.id])
+
+    async def test_messages_do_not_write_presence(self):
+        self.addCleanup(presence.connections.clear)
+        self.addCleanup(presence.gone.clear)
+        app = as_user(URLRouter(websocket_urlpatterns), self.alice)
+        communicator = WebsocketCommunicator(app, "/ws/chat/bob/")
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "hi bob"})
+        await communicator.receive_json_from()
+        self.assertTrue(presence.is_online(self.alice.id, f"chat_{self.room.id}"))
+        self.assertEqual(await ActiveConnection.objects.acount(), 0)
+
+        await communicator.disconnect()
+        self.assertFalse(presence.is_online(self.alice.id))
+
+
+class FakeSocket:
+
+    def __init__(self):
+        self.pings = 0
+        self.reaped_with = None
+
+    async def ping(self):
+        self.pings += 1
+
+    async def reap(self, code):
+        self.reaped_with = code
+
+
+@override_settings(WETALK_HEARTBEAT_TIMEOUT=60, WETALK_IDLE_TIMEOUT=600)
+class HeartbeatTests(ChatTestCase):
+
+    async def test_sweep_pings_live_and_reaps_dead_or_idle(self):
+        monitor = HeartbeatMonitor()
+        live, dead, idle = FakeSocket(), FakeSocket(), FakeSocket()
+        for socket in (live, dead, idle):
+            monitor.register(socket)
+        dead.last_seen -= 61
+        idle.last_active -= 601
+
+        await monitor.flush()
+        self.assertEqual((live.pings, live.reaped_with), (1, None))
+        self.assertEqual(dead.reaped_with, CLOSE_HEARTBEAT_TIMEOUT)
+        self.assertEqual(idle.reaped_with, CLOSE_IDLE)
+        self.assertEqual(set(monitor.consumers), {live})
+
+    @override_settings(WETALK_HEARTBEAT_INTERVAL=0.05, WETALK_HEARTBEAT_TIMEOUT=0.12)
+    async def test_silent_socket_is_closed_and_leaves_its_group(self):
+        self.addCleanup(presence.gone.clear)
+        app = as_user(URLRouter(websocket_urlpatterns), self.alice)
+        communicator = WebsocketCommunicator(app, "/ws/chat/bob/")
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        self.assertEqual(await communicator.receive_json_from(), {"type": "ping"})
+        await communicator.send_json_to({"command": "pong"})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "ping"})
+
+        while (output := await communicator.receive_output(timeout=1))["type"] != "websocket.close":
+            pass
+        self.assertEqual(output["code"], CLOSE_HEARTBEAT_TIMEOUT)
+        self.assertFalse(presence.is_online(self.alice.id))
+        await communicator.wait()
+
+    def test_reconcile_only_removes_unrefreshed_rows(self):
+        ActiveConnection.objects.create(user=self.alice, room_name="chat_1")
+        ActiveConnection.objects.create(
+            user=self.bob, room_name="chat_1", refreshed_at=timezone.now() - timedelta(hours=1)
+        )
+        reconcile_active_connections()
+        self.assertEqual(list(ActiveConnection.objects.values_list("user_id", flat=True)), [self.alice.id])
+
+
+class StalledClient:
+    """An ASGI send that blocks until the test lets frames through."""
+
+    def __init__(self):
+        self.sent = []
+        self.open = asyncio.Event()
+
+    async def send(self, text_data=None, bytes_data=None):
+        await self.open.wait()
+        self.sent.append(text_data)
+
+
+class OutboundQueueTests(TestCase):
+
+    def make_queue(self, policy, limit=3):
+        client = StalledClient()
+        evicted = []
+        queue = OutboundQueue(client.send, lambda: evicted.append(True), limit=limit, policy=policy)
+        return queue, client, evicted
+
+    async def test_coalesce_keeps_latest_keyed_frame_and_bounds_depth(self):
+        queue, client, _ = self.make_queue("coalesce")
+        queue.put({"text_data": "m1"})
+        await asyncio.sleep(0)  # m1 is now stuck in send
+        for up_to in range(10):
+            queue.put({"text_data": f"seen {up_to}"}, key=("seen", "bob"))
+        for n in range(2, 6):
+            queue.put({"text_data": f"m{n}"})
+        self.assertEqual(len(queue), 3)
+
+        client.open.set()
+        while len(queue):
+            await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertEqual(client.sent, ["m1", "m3", "m4", "m5"])
+        queue.close()
+
+    async def test_drop_oldest(self):
+        queue, client, _ = self.make_queue("drop_oldest", limit=2)
+        before = outbound_stats()["dropped"]
+        for n in range(5):
+            queue.put({"text_data": f"m{n}"}, key="ping")
+        self.assertEqual([entry[1]["text_data"] for entry in queue.frames], ["m3", "m4"])
+        self.assertEqual(outbound_stats()["dropped"] - before, 3)
+        queue.close()
+
+    async def test_disconnect_evicts_slow_client(self):
+        queue, client, evicted = self.make_queue("disconnect", limit=2)
+        for n in range(3):
+            queue.put({"text_data": f"m{n}"})
+        self.assertEqual(evicted, [True])
+        self.assertTrue(queue.closed)
+        self.assertEqual(len(queue), 0)
+        queue.put({"text_data": "late"})
+        self.assertEqual(len(queue), 0)
+
+
+class RateLimitTests(ChatTestCase):
+
+    async def test_bucket_refills_at_rate(self):
+        store = LocalBucketStore()
+        with mock.patch("talk.ratelimit.time.monotonic", return_value=100.0) as clock:
+            self.assertEqual([await store.take([("k", 2, 3)]) for _ in range(3)], [None, None, None])
+            key, retry_after = await store.take([("k", 2, 3)])
+            self.assertEqual(key, "k")
+            self.assertAlmostEqual(retry_after, 0.5)
+            clock.return_value = 100.5
+            self.assertIsNone(await store.take([("k", 2, 3)]))
+            self.assertIsNotNone(await store.take([("k", 2, 3)]))
+
+    async def test_full_buckets_are_pruned(self):
+        store = LocalBucketStore(maxsize=2)
+        with mock.patch("talk.ratelimit.time.monotonic", return_value=100.0) as clock:
+            await store.take([("a", 1, 5)])
+            clock.return_value = 102.0
+            await store.take([("b", 1, 5)])
+            await store.take([("c", 1, 5)])
+        self.assertEqual(set(store.buckets), {"b", "c"})
+
+    @override_settings(WETALK_RATE_LIMIT_USER=(1, 2), WETALK_RATE_LIMIT_ROOM=None)
+    async def test_user_limit_returns_throttle_frame(self):
+        limiter = RateLimiter(LocalBucketStore())
+        self.assertIsNone(await limiter.check(self.alice.id, self.room.id))
+        self.assertIsNone(await limiter.check(self.alice.id, self.room.id))
+        throttled = await limiter.check(self.alice.id, self.room.id)
+        self.assertEqual((throttled["code"], throttled["scope"]), ("throttled", "user"))
+        self.assertGreater(throttled["retry_after"], 0)
+        self.assertIsNone(await limiter.check(self.bob.id, self.room.id))
+
+    async def assert_full_room_leaves_user_budget_alone(self, limiter):
+        with override_settings(WETALK_RATE_LIMIT_USER=(1, 2), WETALK_RATE_LIMIT_ROOM=(1, 1)):
+            self.assertIsNone(await limiter.check(self.alice.id, self.room.id))
+            self.assertEqual((await limiter.check(self.bob.id, self.room.id))["scope"], "room")
+            self.assertIsNone(await limiter.check(self.bob.id, self.room.id + 1))
+            self.assertIsNone(await limiter.check(self.bob.id, self.room.id + 2))
+
+    async def test_full_room_leaves_user_budget_alone(self):
+        await self.assert_full_room_leaves_user_budget_alone(RateLimiter(LocalBucketStore()))
+
+    @override_settings(WETALK_RATE_LIMIT_STORE="cache:ratelimit", CACHES={
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "ratelimit": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "ratelimit"},
+    })
+    async def test_shared_store(self):
+        limiter = RateLimiter(get_store())
+        self.assertIsInstance(limiter.store, CacheBucketStore)
+        with override_settings(WETALK_RATE_LIMIT_USER=None, WETALK_RATE_LIMIT_ROOM=(1, 1)):
+            self.assertIsNone(await limiter.check(self.alice.id, self.room.id))
+            self.assertEqual((await limiter.check(self.bob.id, self.room.id))["scope"], "room")
+        await limiter.store.cache.aclear()
+        await self.assert_full_room_leaves_user_budget_alone(limiter)
+
+    @override_settings(WETALK_RATE_LIMIT_USER=(1, 1))
+    async def test_socket_gets_throttle_error_and_nothing_is_saved(self):
+        rate_limiter.store.clear()
+        self.addCleanup(rate_limiter.store.clear)
+        communicator = WebsocketCommunicator(as_user(URLRouter(websocket_urlpatterns), self.alice), "/ws/chat/bob/")
+        await communicator.connect()
+        await communicator.receive_json_from()
+
+        await communicator.send_json_to({"message": "one"})
+        self.assertEqual((await communicator.receive_json_from())["message"], "one")
+        await communicator.send_json_to({"message": "two"})
+        self.assertEqual((await communicator.receive_json_from())["code"], "throttled")
+        self.assertEqual(await Message.objects.acount(), 1)
+        await communicator.disconnect()
+
+
+class SearchTests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        carol = User.objects.create_user(username="carol", email="carol@example.com", password="pass12345")
+        self.other_room = ChatRoom.objects.create(user1=self.bob, user2=carol)
+        self.hits = Message.objects.persist([
+            Message(chat_room=self.room, sender=self.bob, text="lunch at noon?"),
+            Message(chat_room=self.room, sender=self.alice, text="lunch lunch lunch, yes please"),
+            Message(chat_room=self.room, sender=self.bob, text="see you at lunch then"),
+            Message(chat_room=self.room, sender=self.bob, text="something else"),
+            Message(chat_room=self.other_room, sender=carol, text="lunch with bob"),
+        ])
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def test_ranked_snippets_from_own_rooms_only(self):
+        results = self.client.get("/wetalk/messages/search/", {"q": "lunch"}).json()["results"]
+        self.assertEqual({r["id"] for r in results}, {m.id for m in self.hits[:3]})
+        self.assertEqual(results[0]["id"], self.hits[1].id)
+        self.assertIn("[lunch]", results[0]["snippet"])
+        self.assertEqual(results[0]["sender"], "alice")
+
+    def test_cursor_pages_through_results(self):
+        first = self.client.get("/wetalk/messages/search/", {"q": "lunch", "page_size": 2}).json()
+        second = self.client.get("/wetalk/messages/search/", {"q": "lunch", "page_size": 2, "cursor": first["cursor"]}).json()
+        self.assertEqual(len(first["results"]) + len(second["results"]), 3)
+        self.assertIsNone(second["next"])
+        self.assertEqual(
+            self.client.get("/wetalk/messages/search/", {"q": "lunch", "cursor": "bogus"}).status_code,
+            status.HTTP_404_NOT_FOUND,
+        )
+
+    @override_settings(WETALK_SEARCH_WINDOW=2)
+    def test_matches_are_ranked_one_window_at_a_time(self):
+        first = self.client.get("/wetalk/messages/search/", {"q": "lunch"}).json()
+        self.assertEqual([r["id"] for r in first["results"]], [self.hits[1].id, self.hits[2].id])
+        self.assertEqual({r["window"] for r in first["results"]}, {self.hits[2].id})
+        second = self.client.get("/wetalk/messages/search/", {"q": "lunch", "cursor": first["cursor"]}).json()
+        self.assertEqual([r["id"] for r in second["results"]], [self.hits[0].id])
+        self.assertEqual(second["results"][0]["window"], self.hits[0].id)
+        self.assertIsNone(second["next"])
+
+    @override_settings(WETALK_SEARCH_COMMON_WORD=0.5)
+    def test_common_words_are_checked_on_the_text(self):
+        with connection.cursor() as db:
+            self.assertEqual(SQLiteFTSBackend().split_common(db, ["noon", "lunch"]), (["noon"], ["lunch"]))
+        results = self.client.get("/wetalk/messages/search/", {"q": "noon lunch"}).json()["results"]
+        self.assertEqual([r["id"] for r in results], [self.hits[0].id])
+        self.assertEqual(results[0]["snippet"], "[lunch] at [noon?]")
+
+    @override_settings(WETALK_SEARCH_COMMON_WORD=0.5, WETALK_SEARCH_WINDOW=1)
+    def test_windows_without_the_common_word_are_skipped(self):
+        Message.objects.persist([Message(chat_room=self.room, sender=self.bob, text="noon works")])
+        results = self.client.get("/wetalk/messages/search/", {"q": "noon lunch"}).json()["results"]
+        self.assertEqual([r["id"] for r in results], [self.hits[0].id])
+
+    def test_search_within_one_room(self):
+        results = self.client.get("/wetalk/messages/search/", {"q": "lunch", "chat_room": self.other_room.id}).json()
+        self.assertEqual(results["results"], [])
+
+    def test_index_follows_deletes_and_edits(self):
+        self.hits[0].delete()
+        Message.objects.filter(id=self.hits[3].id).update(text="lunch moved")
+        results = self.client.get("/wetalk/messages/search/", {"q": "lunch"}).json()["results"]
+        self.assertEqual({r["id"] for r in results}, {self.hits[1].id, self.hits[2].id, self.hits[3].id})
+
+    def test_query_syntax_is_not_passed_through(self):
+        response = self.client.get("/wetalk/messages/search/", {"q": 'lunch" OR chat_room_id:*'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get("/wetalk/messages/search/").status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get("/wetalk/messages/search/", {"q": "lunch", "chat_room": "\u00b2"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_scan_backend(self):
+        results, cursor = ScanSearchBackend().search(self.alice, "LUNCH", limit=2)
+        self.assertEqual([r["id"] for r in results], [self.hits[2].id, self.hits[1].id])
+        results, cursor = ScanSearchBackend().search(self.alice, "lunch", cursor=cursor, limit=2)
+        self.assertEqual([r["id"] for r in results], [self.hits[0].id])
+        self.assertIsNone(cursor)
+
+
+class ArchiveTests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(
+            WETALK_ARCHIVE_DIR=Path(directory.name), WETALK_ARCHIVE_BLOCK_MESSAGES=3,
+            WETALK_ARCHIVE_SEGMENT_BYTES=50, WETALK_HISTORY_PAGE_SIZE=4,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(segment_maps.clear)
+
+        old = timezone.now() - timedelta(days=400)
+        self.old = Message.objects.persist([
+            Message(chat_room=self.room, sender=self.alice if i % 2 else self.bob, text=f"old {i}",
+                    time_stamp=old + timedelta(minutes=i))
+            for i in range(7)
+        ])
+        self.recent = make_messages(self.room, self.alice, 2)
+
+    @override_settings(WETALK_ARCHIVE_OPEN_SEGMENTS=2)
+    def test_open_segment_maps_are_bounded(self):
+        archive_messages()
+        rows = archive.room(self.room.id).page(limit=10)
+        self.assertEqual([row[0] for row in rows], [m.id for m in reversed(self.old)])
+        self.assertGreater(len(list(archive.room(self.room.id).path.glob("*.seg"))), 2)
+        self.assertEqual(len(segment_maps.maps), 2)
+
+    def test_moves_old_messages_out_of_the_table(self):
+        self.assertEqual(archive_messages(), 7)
+        self.assertEqual(list(Message.objects.order_by("id")), self.recent)
+        room = archive.room(self.room.id)
+        self.assertEqual(len(room.index()), 3)
+        self.assertGreater(len(list(room.path.glob("*.seg"))), 1)
+
+        rows = room.page(limit=10)
+        self.assertEqual([row[0] for row in rows], [m.id for m in reversed(self.old)])
+        self.assertEqual(rows[0][4], "old 6")
+        older = room.page(before=(rows[2][2], rows[2][0]), limit=2)
+        self.assertEqual([row[0] for row in older], [self.old[3].id, self.old[2].id])
+
+    def test_history_reads_through_into_the_archive(self):
+        archive_messages()
+        seen, cursor = [], None
+        while True:
+            rows, cursor = fetch_history(self.room.id, before=cursor)
+            seen = [row["id"] for row in rows] + seen
+            if not cursor:
+                break
+        self.assertEqual(seen, [m.id for m in self.old + self.recent])
+        self.assertEqual(rows[0]["sender__username"], "bob")
+
+    def test_resume_does_not_skip_archived_messages(self):
+        archive_messages()
+        self.assertIsNone(fetch_since(self.room.id, 2))
+        newer = Message.objects.persist([Message(chat_room=self.room, sender=self.bob, text="new")])
+        self.assertIsNone(fetch_since(self.room.id, 2))
+        self.assertEqual([row["seq"] for row in fetch_since(self.room.id, 7)], [newer[0].seq])
+        self.assertEqual(fetch_since(self.room.id, newer[0].seq), [])
+
+    def test_api_pages_read_through_into_the_archive(self):
+        archive_messages()
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        first = client.get("/wetalk/messages/", {"chat_room": self.room.id}).json()
+        self.assertEqual([m["id"] for m in first["results"]], [m.id for m in (self.old[-2:] + self.recent)[::-1]])
+        self.assertEqual(first["results"][3]["sender"]["username"], "alice")
+
+        second = client.get("/wetalk/messages/", {"chat_room": self.room.id, "cursor": first["cursor"]}).json()
+        self.assertEqual([m["id"] for m in second["results"]], [m.id for m in self.old[1:5][::-1]])
+
+        carol = User.objects.create_user(username="carol", email="carol@example.com", password="pass12345")
+        client.force_authenticate(carol)
+        self.assertEqual(client.get("/wetalk/messages/", {"chat_room": self.room.id}).json()["results"], [])
+
+    def test_rerun_after_a_crash_does_not_duplicate(self):
+        # a run that wrote the first block and died before deleting its rows
+        archive.room(self.room.id).append(
+            list(Message.objects.filter(id__in=[m.id for m in self.old[:3]]).order_by("id").values_list(*ARCHIVE_FIELDS))
+        )
+        with open(archive.room(self.room.id).index_path, "ab") as f:
+            f.write(b"torn")
+
+        self.assertEqual(archive_messages(), 4)
+        self.assertEqual([row[0] for row in archive.room(self.room.id).page(limit=10)], [m.id for m in reversed(self.old)])
+
+
+class InboxTests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+
+    def add_rooms(self, count):
+        for i in range(count):
+            peer = User.objects.create_user(username=f"peer{ChatRoom.objects.count()}_{i}", password="pass12345")
+            room = ChatRoom.objects.create(user1=self.alice, user2=peer)
+            Message.objects.persist([Message(chat_room=room, sender=peer, text=f"hello from {peer.username}")])
+
+    def test_persist_maintains_room_summary(self):
+        Message.objects.persist([
+            Message(chat_room=self.room, sender=self.bob, text="one"),
+            Message(chat_room=self.room, sender=self.bob, text="two"),
+            Message(chat_room=self.room, sender=self.alice, text="three"),
+        ])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_text, "three")
+        self.assertEqual(self.room.last_message_sender, self.alice)
+        self.assertEqual(self.room.unread_for(self.alice), 2)
+        self.assertEqual(self.room.unread_for(self.bob), 1)
+
+    def test_older_batch_does_not_move_last_message_back(self):
+        Message.objects.persist([Message(chat_room=self.room, sender=self.bob, text="new")])
+        Message.objects.persist([
+            Message(chat_room=self.room, sender=self.bob, text="old", time_stamp=timezone.now() - timedelta(minutes=5))
+        ])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_text, "new")
+        self.assertEqual(self.room.unread_for(self.alice), 2)
+
+    def test_inbox_is_sorted_by_last_activity(self):
+        self.add_rooms(2)
+        Message.objects.persist([Message(chat_room=self.room, sender=self.bob, text="latest")])
+
+        inbox = self.client.get("/wetalk/chatrooms/inbox/").json()
+        self.assertEqual(inbox[0]["peer"], {"id": self.bob.id, "username": "bob"})
+        self.assertEqual(inbox[0]["last_message"]["text"], "latest")
+        self.assertEqual(inbox[0]["unread_count"], 1)
+        self.assertEqual(len(inbox), 3)
+
+    def test_inbox_query_count_does_not_grow_with_rooms(self):
+        self.add_rooms(5)
+        with self.assertNumQueries(1):
+            self.client.get("/wetalk/chatrooms/inbox/")
+        self.add_rooms(50)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(self.client.get("/wetalk/chatrooms/inbox/").json()), 56)
+
+
+class ShardedChannelLayerTests(ChatTestCase):
+
+    def test_adding_a_shard_moves_only_its_share_of_keys(self):
+        keys = [f"chat_{i}" for i in range(10000)]
+        before = HashRing([f"shard{i}" for i in range(4)])
+        after = HashRing([f"shard{i}" for i in range(5)])
+        moved = [key for key in keys if before.node(key) != after.node(key)]
+        # everything that moves, moves to the new shard, about a fifth of the keys
+        self.assertEqual({after.node(key) for key in moved}, {"shard4"})
+        self.assertAlmostEqual(len(moved) / len(keys), 0.2, delta=0.05)
+        counts = [sum(before.node(key) == f"shard{i}" for key in keys) for i in range(4)]
+        self.assertLess(max(counts) / min(counts), 1.5)
+
+    async def test_group_messages_reach_members_on_every_shard(self):
+        layer = ShardedChannelLayer(in_memory_shards(4))
+        channels = [await layer.new_channel() for _ in range(20)]
+        self.assertGreater(len({layer.shard(channel) for channel in channels}), 1)
+        for channel in channels:
+            await layer.group_add("chat_1", channel)
+        await layer.group_send("chat_1", {"type": "chat.message", "n": 1})
+        for channel in channels:
+            self.assertEqual(await layer.receive(channel), {"type": "chat.message", "n": 1})
+
+        await layer.group_discard("chat_1", channels[0])
+        await layer.group_send("chat_1", {"type": "chat.message", "n": 2})
+        await layer.send(channels[0], {"type": "direct"})
+        self.assertEqual(await layer.receive(channels[0]), {"type": "direct"})
+        self.assertEqual(await layer.receive(channels[1]), {"type": "chat.message", "n": 2})
+
+        # nothing keeps listening for channels that left every group
+        for channel in channels:
+            await layer.group_discard("chat_1", channel)
+        await asyncio.sleep(0)
+        self.assertEqual(dict(layer.pumps), {})
+
+    async def test_join_during_receive_listens_on_the_new_shard(self):
+        layer = ShardedChannelLayer(in_memory_shards(4))
+        channel = await layer.new_channel()
+        group = next(f"chat_{i}" for i in range(100) if layer.shard(f"chat_{i}") != layer.shard(channel))
+        receive = asyncio.ensure_future(layer.receive(channel))
+        await asyncio.sleep(0)
+        await layer.group_add(group, channel)
+        await layer.group_send(group, {"type": "chat.message"})
+        self.assertEqual(await asyncio.wait_for(receive, 1), {"type": "chat.message"})
+
+    async def test_chat_consumers_over_sharded_layer(self):
+        layers = {"default": {"BACKEND": "talk.layers.ShardedChannelLayer", "CONFIG": {"shards": in_memory_shards(4)}}}
+        with override_settings(CHANNEL_LAYERS=layers):
+            app = URLRouter(websocket_urlpatterns)
+            alice = WebsocketCommunicator(as_user(app, self.alice), "/ws/chat/bob/")
+            bob = WebsocketCommunicator(as_user(app, self.bob), "/ws/chat/alice/")
+            for communicator in (alice, bob):
+                await communicator.connect()
+                await communicator.receive_json_from()
+            await alice.send_json_to({"message": "sharded"})
+            for communicator in (alice, bob):
+                self.assertEqual((await communicator.receive_json_from())["message"], "sharded")
+                await communicator.disconnect()
+
+
+IN_MEMORY_REMOTE = {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+
+
+class HybridChannelLayerTests(ChatTestCase):
+
+    async def test_local_members_are_served_without_the_remote_layer(self):
+        layer = HybridChannelLayer(IN_MEMORY_REMOTE)
+        alice, bob = await layer.new_channel(), await layer.new_channel()
+        for channel in (alice, bob):
+            await layer.group_add("chat_1", channel)
+        # the remote group only knows this process
+        self.assertEqual(list(layer.remote.groups["chat_1"]), [layer.node])
+
+        with mock.patch.object(layer.remote, "send", wraps=layer.remote.send) as remote_send:
+            await layer.group_send("chat_1", {"type": "chat.message"})
+            await layer.send(bob, {"type": "direct"})
+            self.assertEqual(await layer.receive(alice), {"type": "chat.message"})
+            self.assertEqual(await layer.receive(bob), {"type": "chat.message"})
+            self.assertEqual(await layer.receive(bob), {"type": "direct"})
+        # one push, to this process's node, whose copy is dropped
+        self.assertEqual([call.args[0] for call in remote_send.call_args_list], [layer.node])
+
+        await layer.group_discard("chat_1", alice)
+        await layer.group_send("chat_1", {"type": "chat.message", "n": 2})
+        self.assertEqual(await layer.receive(bob), {"type": "chat.message", "n": 2})
+        await layer.group_discard("chat_1", bob)
+        self.assertNotIn("chat_1", layer.remote.groups)
+        self.assertEqual(layer.pumps, {})
+
+    async def test_members_in_other_processes_get_each_message_once(self):
+        here, there = HybridChannelLayer(IN_MEMORY_REMOTE), HybridChannelLayer(IN_MEMORY_REMOTE)
+        there.remote = here.remote
+        alice, bob = await here.new_channel(), await there.new_channel()
+        receive = asyncio.ensure_future(there.receive(bob))
+        await asyncio.sleep(0)
+        await here.group_add("chat_1", alice)
+        await there.group_add("chat_1", bob)
+
+        await here.group_send("chat_1", {"type": "chat.message", "n": 1})
+        await there.group_send("chat_1", {"type": "chat.message", "n": 2})
+        self.assertEqual(await asyncio.wait_for(receive, 1), {"type": "chat.message", "n": 1})
+        self.assertEqual(await asyncio.wait_for(there.receive(bob), 1), {"type": "chat.message", "n": 2})
+        self.assertEqual(await asyncio.wait_for(here.receive(alice), 1), {"type": "chat.message", "n": 1})
+        self.assertEqual(await asyncio.wait_for(here.receive(alice), 1), {"type": "chat.message", "n": 2})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(here.receive(alice), 0.05)
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(there.receive(bob), 0.05)
+
+    async def test_chat_consumers_over_hybrid_layer(self):
+        layers = {"default": {"BACKEND": "talk.layers.HybridChannelLayer", "CONFIG": {"remote": IN_MEMORY_REMOTE}}}
+        with override_settings(CHANNEL_LAYERS=layers):
+            app = URLRouter(websocket_urlpatterns)
+            alice = WebsocketCommunicator(as_user(app, self.alice), "/ws/chat/bob/")
+            bob = WebsocketCommunicator(as_user(app, self.bob), "/ws/chat/alice/")
+            for communicator in (alice, bob):
+                await communicator.connect()
+                await communicator.receive_json_from()
+            await alice.send_json_to({"message": "local"})
+            for communicator in (alice, bob):
+                self.assertEqual((await communicator.receive_json_from())["message"], "local")
+                self.assertTrue(await communicator.receive_nothing())
+                await communicator.disconnect()
+
+
+class RoomCacheTests(ChatTestCase):
+
+    async def test_warm_reconnect_skips_the_database(self):
+        app = URLRouter(websocket_urlpatterns)
+        with mock.patch("talk.consumers.resolve_room", wraps=resolve_room) as resolve:
+            for _ in range(2):
+                alice = WebsocketCommunicator(as_user(app, self.alice), "/ws/chat/bob/")
+                await alice.connect()
+                await alice.receive_json_from()
+                await alice.send_json_to({"message": "again"})
+                self.assertEqual((await alice.receive_json_from())["chat_room"], self.room.id)
+                await alice.disconnect()
+        self.assertEqual(resolve.call_count, 1)
+
+    def test_resolves_and_caches_the_room(self):
+        self.assertEqual(async_to_sync(resolve_room)(self.alice, "bob"), self.room)
+        with self.assertNumQueries(0):
+            room = cached_room(self.alice, "bob")
+        self.assertEqual((room.id, room.user1_id, room.user2_id), (self.room.id, self.alice.id, self.bob.id))
+
+        self.assertIsNone(async_to_sync(resolve_room)(self.alice, "nobody"))
+        self.assertIsNone(cached_room(self.alice, "nobody"))
+
+    def test_renames_and_deletes_drop_cached_rooms(self):
+        async_to_sync(resolve_room)(self.alice, "bob")
+        self.bob.username = "robert"
+        self.bob.save()
+        self.assertIsNone(cached_room(self.alice, "bob"))
+
+        async_to_sync(resolve_room)(self.alice, "robert")
+        async_to_sync(resolve_room)(self.bob, "alice")
+        self.room.delete()
+        self.assertIsNone(cached_room(self.alice, "robert"))
+        self.assertIsNone(cached_room(self.bob, "alice"))
+
+        carol = User.objects.create_user(username="carol", email="carol@example.com", password="pass12345")
+        async_to_sync(resolve_room)(self.alice, "carol")
+        carol.delete()
+        self.assertIsNone(cached_room(self.alice, "carol"))
+
+
+@override_settings(WETALK_DB_EXECUTOR_SIZE=2)
+class DatabaseExecutorTests(TransactionTestCase):
+
+    async def test_calls_run_on_a_bounded_pool_of_database_threads(self):
+        # bulk_create skips the welcome-email signal
+        await User.objects.abulk_create([User(username="alice", email="alice@example.com")])
+
+        def lookup(username):
+            return threading.current_thread().name, User.objects.get(username=username).username
+
+        results = await asyncio.gather(*(database_sync_to_async(lookup)("alice") for _ in range(10)))
+        self.assertEqual({username for _, username in results}, {"alice"})
+        self.assertTrue(all(name.startswith("wetalk-db") for name, _ in results))
+        self.assertLessEqual(len({name for name, _ in results}), 2)
+        self.assertEqual(db_executor.stats()["queued"], 0)
+
+        with self.assertRaises(User.DoesNotExist):
+            await database_sync_to_async(lookup)("nobody")
+
+    def test_query_budgets_count_queries_run_on_the_pool(self):
+        alice, = User.objects.bulk_create([User(username="alice", email="alice@example.com")])
+        client = APIClient()
+        client.force_authenticate(alice)
+        # the async inbox runs its one query on a wetalk-db thread
+        self.assertEqual(client.get("/wetalk/chatrooms/inbox/")["X-Query-Count"], "1")
+
+
+class MetricsTests(ChatTestCase):
+
+    async def test_socket_lifecycle_is_counted(self):
+        before = {
+            metric: dict(metric.values)
+            for metric in (metrics.connects, metrics.messages_received, metrics.messages_sent, metrics.active_connections)
+        }
+        group_sends, db_waits = metrics.group_send_seconds.counts[:], sum(metrics.db_wait_seconds.counts)
+
+        def delta(metric):
+            return metric.values.get((), 0) - before[metric].get((), 0)
+
+        app = URLRouter(websocket_urlpatterns)
+        alice = WebsocketCommunicator(as_user(app, self.alice), "/ws/chat/bob/")
+        await alice.connect()
+        await alice.receive_json_from()
+        self.assertEqual(delta(metrics.active_connections), 1)
+
+        await alice.send_json_to({"message": "counted"})
+        await alice.receive_json_from()
+        await alice.disconnect()
+
+        self.assertEqual(delta(metrics.connects), 1)
+        self.assertEqual(delta(metrics.active_connections), 0)
+        self.assertEqual(delta(metrics.messages_received), 1)
+        self.assertEqual(delta(metrics.messages_sent), 2)  # history and the echo
+        self.assertEqual(sum(metrics.group_send_seconds.counts) - sum(group_sends), 1)
+        # get_past_messages and save_message, the room comes from the async ORM
+        self.assertEqual(sum(metrics.db_wait_seconds.counts) - db_waits, 2)
+
+    def test_prometheus_text_endpoint(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        body = response.content.decode()
+        self.assertIn("# TYPE wetalk_ws_active_connections gauge", body)
+        self.assertIn('wetalk_channel_layer_group_send_seconds_bucket{le="+Inf"}', body)
+        self.assertIn("wetalk_outbound_dropped_total", body)
+        self.assertIn("# TYPE wetalk_write_behind_failed_flushes_total counter", body)
+        self.assertIn("wetalk_write_behind_oldest_pending_seconds 0.0", body)
+
+        with mock.patch.object(message_buffer, "pending", [(None, time.monotonic() - 2)]):
+            body = self.client.get("/metrics").content.decode()
+        self.assertIn("wetalk_write_behind_pending 1\n", body)
+        self.assertRegex(body, r"wetalk_write_behind_oldest_pending_seconds 2\.\d+")
+
+        with override_settings(METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get("/metrics").status_code, status.HTTP_403_FORBIDDEN)
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = metrics.Histogram("test_seconds", "test", buckets=(0.1, 1.0))
+        metrics.registry.remove(histogram)
+        for value in (0.05, 0.5, 0.5, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{le="0.1"} 1',
+            'test_seconds_bucket{le="1.0"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            "test_seconds_sum 6.05",
+            "test_seconds_count 4",
+        ])
+
+
+@override_settings(QUERY_BUDGET_ENABLED=True)
+class QueryBudgetTests(QueryBudgetTestMixin, ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        for i in range(5):
+            peer = User.objects.create_user(username=f"peer{i}", email=f"peer{i}@example.com", password="pass12345")
+            Contact.objects.create(user=self.alice, contact=peer)
+            room = ChatRoom.objects.create(user1=self.alice, user2=peer)
+            Message.objects.persist([Message(chat_room=room, sender=peer, text=f"hello {i}")])
+
+    def test_endpoints_stay_within_budget(self):
+        for key, url in (
+            ("contact-list GET", "/wetalk/contacts/"),
+            ("chatroom-list GET", "/wetalk/chatrooms/"),
+            ("chatroom-inbox GET", "/wetalk/chatrooms/inbox/"),
+            ("message-list GET", f"/wetalk/messages/?chat_room={self.room.id}"),
+            ("message-search GET", "/wetalk/messages/search/?q=hello"),
+        ):
+            with self.subTest(key), self.assertQueryBudget(key):
+                self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+    def test_budgets_hold_for_jwt_authenticated_requests(self):
+        # what production sees: the user is loaded from the token, not forced
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(self.alice)}")
+        for key, url in (
+            ("contact-list GET", "/wetalk/contacts/"),
+            ("chatroom-list GET", "/wetalk/chatrooms/"),
+            ("chatroom-inbox GET", "/wetalk/chatrooms/inbox/"),
+            ("message-list GET", f"/wetalk/messages/?chat_room={self.room.id}"),
+            ("message-search GET", "/wetalk/messages/search/?q=hello"),
+        ):
+            with self.subTest(key), self.assertQueryBudget(key):
+                self.assertEqual(client.get(url).status_code, status.HTTP_200_OK)
+
+    def test_over_budget_lists_repeated_statements(self):
+        with self.assertRaisesRegex(AssertionError, r"4 repeated statements > 0[\s\S]*5x SELECT"):
+            with self.assertQueryBudget(similar=0):
+                for contact in Contact.objects.filter(user=self.alice):
+                    contact.contact.username
+
+    def test_middleware_reports_counts_in_headers(self):
+        response = self.client.get("/wetalk/contacts/")
+        self.assertEqual(response["X-Query-Count"], "1")
+        self.assertEqual(response["X-Query-Duplicates"], "0")
+        self.assertIn("X-View-Time-Ms", response)
+
+    async def test_middleware_leaves_async_reads_on_the_event_loop(self):
+        self.assertTrue(iscoroutinefunction(QueryBudgetMiddleware(resolve("/wetalk/chatrooms/inbox/").func)))
+        response = await AsyncClient().get(
+            "/wetalk/chatrooms/inbox/", headers={"Authorization": f"Bearer {AccessToken.for_user(self.alice)}"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        # the user from the token and the inbox
+        self.assertEqual(response["X-Query-Count"], "2")
+
+
+class ContactTests(QueryBudgetTestMixin, ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.alice)
+        self.carol = User.objects.create_user(username="carol", email="carol@example.com", password="pass12345")
+
+    def test_add_looks_the_user_up_once(self):
+        with self.assertQueryBudget("contact-list POST"):
+            response = self.client.post("/wetalk/contacts/", {"contact_username": "bob"})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["contact"]["username"], "bob")
+
+        for username, error in (
+            ("bob", "This contact is already added."),
+            ("alice", "You cannot add yourself as a contact."),
+            ("nobody", "User with this username does not exist."),
+        ):
+            response = self.client.post("/wetalk/contacts/", {"contact_username": username})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+            self.assertIn(error, str(response.data))
+        self.assertEqual(Contact.objects.filter(user=self.alice).count(), 1)
+
+    def test_import_resolves_and_inserts_in_three_queries(self):
+        Contact.objects.create(user=self.alice, contact=self.bob)
+        usernames = ["bob", "carol", "alice", "nobody", "carol"]
+        usernames += [f"friend{i}" for i in range(30)]
+        User.objects.bulk_create(User(username=f"friend{i}", email=f"friend{i}@example.com") for i in range(30))
+
+        with self.assertQueryBudget("contact-import-contacts POST"):
+            response = self.client.post("/wetalk/contacts/import/", {"usernames": usernames}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["added"], ["carol"] + [f"friend{i}" for i in range(30)])
+        self.assertEqual(response.data["already_added"], ["bob"])
+        self.assertEqual(response.data["not_found"], ["nobody"])
+        self.assertEqual(Contact.objects.filter(user=self.alice).count(), 32)
+
+        response = self.client.post("/wetalk/contacts/import/", {"usernames": ["carol"]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["already_added"], ["carol"])
+
+    def test_import_needs_usernames(self):
+        response = self.client.post("/wetalk/contacts/import/", {"usernames": []}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ReadReceiptTests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.received = Message.objects.persist([
+            Message(chat_room=self.room, sender=self.bob, text=f"msg {i}") for i in range(4)
+        ])
+        self.sent = Message.objects.persist([Message(chat_room=self.room, sender=self.alice, text="mine")])
+
+    def test_marks_received_range_in_one_update(self):
+        with self.assertNumQueries(5):  # savepoint, range UPDATE, recount, counter UPDATE, release
+            marked = mark_read_up_to(self.room, self.alice, self.received[2].id)
+        self.assertEqual(marked, 3)
+        self.assertEqual(list(Message.objects.filter(is_read=False).order_by("id").values_list("text", flat=True)), ["msg 3", "mine"])
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.unread_for(self.alice), 1)
+        self.assertEqual(self.room.unread_for(self.bob), 1)
+
+    async def test_bursts_are_coalesced_into_one_seen_event(self):
+        app = as_user(URLRouter(websocket_urlpatterns), self.bob)
+        bob = WebsocketCommunicator(app, "/ws/chat/alice/")
+        await bob.connect()
+        await bob.receive_json_from()
+
+        coalescer = ReadReceiptCoalescer()
+        for message in self.received:
+            coalescer.add(self.room, self.alice, message.id)
+        self.assertEqual(len(coalescer.pending), 1)
+        await coalescer.flush()
+
+        seen = await bob.receive_json_from()
+        self.assertEqual(seen, {"type": "seen", "chat_room": self.room.id, "reader": "alice", "up_to": self.received[-1].id})
+        self.assertTrue(await bob.receive_nothing())
+        self.assertEqual(await Message.objects.filter(is_read=True).acount(), 4)
+        await bob.disconnect()
+
+    def test_rest_mark_read(self):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        with mock.patch("talk.views.dispatch_seen_sync") as dispatch:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.post("/wetalk/messages/mark_read/", {"chat_room": self.room.id, "up_to": self.sent[0].id})
+        self.assertEqual(response.json(), {"marked": 4})
+        dispatch.assert_called_once_with(self.room.id, "alice", self.sent[0].id)
+
+    def test_rest_mark_read_rejects_outsiders(self):
+        carol = User.objects.create_user(username="carol", password="pass12345")
+        client = APIClient()
+        client.force_authenticate(carol)
+        response = client.post("/wetalk/messages/mark_read/", {"chat_room": self.room.id, "up_to": 1})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(WETALK_HISTORY_PAGE_SIZE=3, WETALK_RESUME_MAX_MESSAGES=4)
+class ResumeTests(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sent = Message.objects.persist([
+            Message(chat_room=self.room, sender=self.alice, text=f"msg {i}") for i in range(6)
+        ])
+
+    def connect(self, path):
+        return WebsocketCommunicator(as_user(URLRouter(websocket_urlpatterns), self.bob), path)
+
+    def test_persist_numbers_messages_per_room(self):
+        carol = User.objects.create_user(username="carol", password="pass12345")
+        other_room = ChatRoom.objects.create(user1=self.alice, user2=carol)
+        created = Message.objects.persist([
+            Message(chat_room=self.room, sender=self.bob, text="a"),
+            Message(chat_room=other_room, sender=carol, text="b"),
+            Message(chat_room=self.room, sender=self.bob, text="c"),
+        ])
+        self.assertEqual([m.seq for m in self.sent + created], [1, 2, 3, 4, 5, 6, 7, 1, 8])
+        self.assertEqual(
+            list(Message.objects.filter(chat_room=self.room).order_by("seq").values_list("seq", flat=True)),
+            list(range(1, 9)),
+        )
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, 8)
+
+    async def test_resume_sends_only_missed_messages(self):
+        communicator = self.connect("/ws/chat/alice/?resume_from=4")
+        await communicator.connect()
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "missed")
+        self.assertEqual(frame["after_seq"], 4)
+        self.assertEqual([(m["seq"], m["message"]) for m in frame["messages"]], [(5, "msg 4"), (6, "msg 5")])
+
+        # live frames carry the seq, a skipped one is fetched with "sync"
+        await communicator.send_json_to({"message": "hi"})
+        live = await communicator.receive_json_from()
+        self.assertEqual((live["type"], live["seq"]), ("message", 7))
+        await communicator.send_json_to({"command": "sync", "after": 5})
+        missed = await communicator.receive_json_from()
+        self.assertEqual([m["seq"] for m in missed["messages"]], [6, 7])
+        await communicator.disconnect()
+
+    async def test_up_to_date_client_gets_an_empty_delta(self):
+        communicator = self.connect("/ws/chat/alice/?resume_from=6")
+        await communicator.connect()
+        self.assertEqual((await communicator.receive_json_from())["messages"], [])
+        await communicator.disconnect()
+
+    async def test_bad_seqs_are_not_resumed_from(self):
+        communicator = self.connect("/ws/chat/alice/?resume_from=%C2%B2")
+        await communicator.connect()
+        self.assertEqual((await communicator.receive_json_from())["type"], "history")
+        await communicator.send_json_to({"command": "sync", "after": "\u00b2"})
+        self.assertIn("'after'", (await communicator.receive_json_from())["error"])
+        await communicator.disconnect()
+
+    async def test_too_far_behind_gets_the_latest_page(self):
+        communicator = self.connect("/ws/chat/alice/?resume_from=1")
+        await communicator.connect()
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame["type"], "history")
+        self.assertEqual([m["seq"] for m in frame["messages"]], [4, 5, 6])
+        await communicator.disconnect()
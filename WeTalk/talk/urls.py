@@ -1,6 +1,9 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import UserViewSet, ContactViewSet, ChatRoomViewSet, MessageViewSet
+from .views import (
+    UserViewSet, ContactViewSet, ChatRoomViewSet, MessageViewSet,
+    async_reads, read_chatroom_inbox, read_chatroom_list, read_message_list,
+)
 
 router = DefaultRouter()
 router.register("users", UserViewSet, basename="user")
@@ -8,6 +11,12 @@ router.register("contacts", ContactViewSet, basename="contact")
 router.register("chatrooms", ChatRoomViewSet, basename="chatroom")
 router.register("messages", MessageViewSet, basename="message")
 
+viewset_views = {url.name: url.callback for url in router.urls}
+
 urlpatterns = [
+    # GETs served from the event loop, other methods still go to the viewsets
+    path("chatrooms/", async_reads(read_chatroom_list, viewset_views["chatroom-list"]), name="chatroom-list"),
+    path("chatrooms/inbox/", async_reads(read_chatroom_inbox, viewset_views["chatroom-inbox"]), name="chatroom-inbox"),
+    path("messages/", async_reads(read_message_list, viewset_views["message-list"]), name="message-list"),
     path("", include(router.urls)),
 ]
@@ -1,18 +1,42 @@
-from rest_framework import viewsets, generics, permissions
+from asgiref.sync import sync_to_async
+from rest_framework import viewsets, generics, permissions, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F, Q
+from django.views.decorators.csrf import csrf_exempt
 
+from .archive import archived_messages
+from .events import dispatch_message_sync, dispatch_seen_sync
+from .metrics import database_sync_to_async
 from .models import Contact, ChatRoom, Message
+from .pagination import MessageCursorPagination
+from .receipts import mark_read_up_to
+from .search import get_search_backend
 from .serializers import (
     UserSerializer,
     ContactSerializer,
+    ContactImportSerializer,
     ChatRoomSerializer,
-    MessageSerializer
+    MessageSerializer,
+    InboxSerializer,
+    MarkReadSerializer,
 )
 
 User = get_user_model()
 
 
+def room_id_param(request):
+    """The chat_room query param as an int, None when it is missing or not a plain id."""
+    chat_room = request.query_params.get("chat_room", "")
+    # str.isdigit() also takes "²", which int() then refuses
+    return int(chat_room) if chat_room.isascii() and chat_room.isdecimal() else None
+
+
 
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
@@ -30,10 +54,18 @@ class ContactViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Contact.objects.filter(user=self.request.user)
+        return Contact.objects.filter(user=self.request.user).select_related("contact")
     def perform_create(self, serializer):
         serializer.save(user=self.request.user) 
 
+    @action(detail=False, methods=["post"], url_path="import")
+    def import_contacts(self, request):
+        # a whole address book in one call, the same three queries for any size
+        serializer = ContactImportSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        result = Contact.objects.add_usernames(request.user, serializer.validated_data["usernames"])
+        return Response(result, status=status.HTTP_201_CREATED if result["added"] else status.HTTP_200_OK)
+
 
 
 class ChatRoomViewSet(viewsets.ModelViewSet):
@@ -41,19 +73,147 @@ class ChatRoomViewSet(viewsets.ModelViewSet):
     permission_classes = [permissions.IsAuthenticated]
     def get_queryset(self):
         user = self.request.user
-        return ChatRoom.objects.filter(user1=user) | ChatRoom.objects.filter(user2=user)
+        return ChatRoom.objects.for_user(user).select_related("user1", "user2")
+
+    def get_inbox_queryset(self):
+        # everything shown comes from the room row and its joins, one query for any number of rooms
+        return (
+            self.get_queryset()
+            .select_related("last_message_sender")
+            .order_by(F("last_message_at").desc(nulls_last=True), "-id")
+        )
+
+    @action(detail=False, methods=["get"])
+    def inbox(self, request):
+        serializer = InboxSerializer(self.get_inbox_queryset(), many=True, context=self.get_serializer_context())
+        return Response(serializer.data)
 
 
 class MessageViewSet(viewsets.ModelViewSet):
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageCursorPagination
+
     def get_queryset(self):
         user = self.request.user
-        return Message.objects.filter(
-            chat_room__user1=user
-        ) | Message.objects.filter(
-            chat_room__user2=user
-        )
+        queryset = Message.objects.filter(
+            Q(chat_room__user1=user) | Q(chat_room__user2=user)
+        ).select_related("sender")
+
+        # history is always read per room so the (chat_room, time_stamp, id) index is used
+        if self.action == "list":
+            chat_room = room_id_param(self.request)
+            if chat_room is None:
+                raise ValidationError({"chat_room": "A chat room id is required."})
+            queryset = queryset.filter(chat_room_id=chat_room)
+        return queryset
+
+    def archived_page(self, before, limit):
+        # the hot table ran out for this room, older messages come from its archive
+        room_id = room_id_param(self.request)
+        if not ChatRoom.objects.for_user(self.request.user).filter(id=room_id).exists():
+            return []
+        return archived_messages(room_id, before, limit)
+
+    async def aarchived_page(self, before, limit):
+        return await database_sync_to_async(self.archived_page)(before, limit)
 
     def perform_create(self, serializer):
-        serializer.save(sender=self.request.user)
+        message = serializer.save(sender=self.request.user)
+        # same fan-out as messages sent over the socket
+        transaction.on_commit(lambda: dispatch_message_sync(message))
+
+    @action(detail=False, methods=["post"])
+    def mark_read(self, request):
+        serializer = MarkReadSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        room, up_to = serializer.validated_data["chat_room"], serializer.validated_data["up_to"]
+
+        marked = mark_read_up_to(room, request.user, up_to)
+        if marked:
+            transaction.on_commit(lambda: dispatch_seen_sync(room.id, request.user.username, up_to))
+        return Response({"marked": marked})
+
+    @action(detail=False, methods=["get"])
+    def search(self, request):
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            raise ValidationError({"q": "A search query is required."})
+
+        chat_room = room_id_param(request)
+        if chat_room is None and request.query_params.get("chat_room"):
+            raise ValidationError({"chat_room": "A chat room id is expected."})
+
+        # the backend only searches rooms the caller is in
+        try:
+            results, next_cursor = get_search_backend().search(
+                request.user, query,
+                room_id=chat_room,
+                cursor=request.query_params.get("cursor"),
+                limit=self.paginator.get_page_size(request),
+            )
+        except ValueError:
+            raise NotFound("Invalid cursor.")
+        return Response({
+            "next": replace_query_param(request.build_absolute_uri(), "cursor", next_cursor) if next_cursor else None,
+            "cursor": next_cursor,
+            "results": results,
+        })
+
+
+# DRF views are sync, and under ASGI Django gives each request a thread of
+# its own until the view returns. The busiest reads below run on the event
+# loop and borrow a database executor thread only for their queries, so any
+# number of concurrent readers share WETALK_DB_EXECUTOR_SIZE threads. They
+# go through the viewsets' own authentication, permissions, throttles,
+# querysets, serializers, pagination and exception handling to answer
+# exactly like them, and hand every other method to the viewset.
+
+
+def async_reads(read, fallback):
+    """
+    A view answering JSON GETs with `await read(view)`, `view` being the
+    viewset instance `fallback` (a router view) would dispatch to, and
+    everything else with `fallback`.
+    """
+    sync_fallback = sync_to_async(fallback)
+
+    async def dispatch(request, *args, **kwargs):
+        if request.method != "GET":
+            return await sync_fallback(request, *args, **kwargs)
+
+        # what ViewSetMixin.as_view and APIView.dispatch do, with the read awaited
+        view = fallback.cls(**fallback.initkwargs)
+        view.action_map = fallback.actions
+        view.args, view.kwargs = args, kwargs
+        request = view.request = view.initialize_request(request, *args, **kwargs)
+        view.headers = view.default_response_headers
+        try:
+            view.format_kwarg = view.get_format_suffix(**kwargs)
+            renderer, _ = view.perform_content_negotiation(request)
+            if not isinstance(renderer, JSONRenderer):
+                # the browsable API renders forms and the like, leave it to the viewset
+                return await sync_fallback(request._request, *args, **kwargs)
+            await database_sync_to_async(view.initial)(request, *args, **kwargs)
+            response = Response(await read(view))
+        except Exception as exc:
+            response = view.handle_exception(exc)
+        view.response = view.finalize_response(request, response, *args, **kwargs)
+        return view.response.render()
+
+    return csrf_exempt(dispatch)
+
+
+async def read_chatroom_list(view):
+    rooms = await database_sync_to_async(list)(view.get_queryset())
+    return view.get_serializer(rooms, many=True).data
+
+
+async def read_chatroom_inbox(view):
+    rooms = await database_sync_to_async(list)(view.get_inbox_queryset())
+    return InboxSerializer(rooms, many=True, context=view.get_serializer_context()).data
+
+
+async def read_message_list(view):
+    page = await view.paginator.apaginate_queryset(view.get_queryset(), view.request, view=view)
+    return view.paginator.get_paginated_response(view.get_serializer(page, many=True).data).data
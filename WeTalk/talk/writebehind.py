@@ -0,0 +1,133 @@
+import atexit
+import logging
+import time
+
+from django.conf import settings
+from django.db import OperationalError
+from django.utils import timezone
+
+from .background import PeriodicFlusher
+from .metrics import database_sync_to_async
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+
+def write_behind_enabled():
+    return getattr(settings, "WETALK_WRITE_BEHIND", False)
+
+
+class MessageBuffer(PeriodicFlusher):
+    """
+    Per-process buffer for chat messages that have already been broadcast but
+    not written yet. Pending messages are inserted with one bulk_create every
+    WETALK_WRITE_BEHIND_FLUSH_MS, or as soon as WETALK_WRITE_BEHIND_BATCH_SIZE
+    of them are waiting, and whatever is left is written when the process exits.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pending = []
+        self.stats = {
+            "buffered": 0,
+            "written": 0,
+            "failed_flushes": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "last_flush_lag_ms": 0.0,
+            "max_flush_lag_ms": 0.0,
+        }
+
+    @property
+    def flush_interval(self):
+        return getattr(settings, "WETALK_WRITE_BEHIND_FLUSH_MS", 50) / 1000
+
+    @property
+    def batch_size(self):
+        return getattr(settings, "WETALK_WRITE_BEHIND_BATCH_SIZE", 200)
+
+    def add(self, sender, room_id, text):
+        # time_stamp is set now so the broadcast and the stored row agree
+        message = Message(sender=sender, chat_room_id=room_id, text=text, time_stamp=timezone.now())
+        self.pending.append((message, time.monotonic()))
+        self.stats["buffered"] += 1
+
+        self.start_flusher()
+        if len(self.pending) >= self.batch_size:
+            self.wake_flusher()
+        return message
+
+    def pending_for_room(self, room_id):
+        return [message for message, _ in self.pending if message.chat_room_id == room_id]
+
+    def snapshot(self):
+        oldest = self.pending[0][1] if self.pending else None
+        return dict(
+            self.stats,
+            pending=len(self.pending),
+            oldest_pending_ms=(time.monotonic() - oldest) * 1000 if oldest is not None else 0.0,
+        )
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if batch:
+            retry = await database_sync_to_async(self._write_or_split)(batch)
+            self.pending = retry + self.pending
+
+    def flush_sync(self):
+        batch, self.pending = self.pending, []
+        if batch:
+            retry = self._write_or_split(batch)
+            if retry:
+                self.stats["dropped"] += len(retry)
+                logger.error("Dropped %d buffered messages on shutdown", len(retry))
+
+    def _write_or_split(self, batch):
+        """
+        Write `batch`, returns what to try again next round. Only a database
+        that is down or locked keeps the whole batch; any other failure, such
+        as a room or sender deleted since, writes the batch row by row so one
+        bad message can't hold back the rest, and drops the rows that fail.
+        """
+        try:
+            self._write(batch)
+            return []
+        except OperationalError:
+            self.stats["failed_flushes"] += 1
+            logger.exception("Write-behind flush of %d messages failed, keeping them for the next round", len(batch))
+            return batch
+        except Exception:
+            self.stats["failed_flushes"] += 1
+            logger.exception("Write-behind flush of %d messages failed, writing them one by one", len(batch))
+
+        retry = []
+        for entry in batch:
+            try:
+                self._write([entry])
+            except OperationalError:
+                retry.append(entry)
+            except Exception:
+                message = entry[0]
+                self.stats["dropped"] += 1
+                logger.exception(
+                    "Dropped buffered message from user %s to room %s: %r",
+                    message.sender_id, message.chat_room_id, message.text,
+                )
+        return retry
+
+    def _write(self, batch):
+        messages = [message for message, _ in batch]
+        for message in messages:
+            # left over from an attempt that was rolled back
+            message.id = message.seq = None
+        Message.objects.persist(messages)
+
+        lag = (time.monotonic() - batch[0][1]) * 1000
+        self.stats["written"] += len(batch)
+        self.stats["flushes"] += 1
+        self.stats["last_flush_lag_ms"] = lag
+        self.stats["max_flush_lag_ms"] = max(self.stats["max_flush_lag_ms"], lag)
+
+
+message_buffer = MessageBuffer()
+atexit.register(message_buffer.flush_sync)
@@ -1,12 +1,20 @@
 from urllib.parse import parse_qs
-from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
 import jwt
 from django.conf import settings
 
+from .cache import TTLCache
+
 User = get_user_model()
 
+# token -> user, so reconnect storms with the same cookie skip the signature check and the DB
+token_cache = TTLCache(
+    maxsize=getattr(settings, "WETALK_JWT_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "WETALK_JWT_CACHE_TTL", 300),
+)
+
+
 class JWTAuthMiddleware:
     def __init__(self, app):
         self.app = app
@@ -17,16 +25,23 @@ class JWTAuthMiddleware:
 
         # extract cookie header
         cookie_header = dict(scope['headers']).get(b'cookie', b'').decode()
-        cookies = dict(kv.strip().split('=') for kv in cookie_header.split(';') if '=' in kv)
+        cookies = dict(kv.strip().split('=', 1) for kv in cookie_header.split(';') if '=' in kv)
         token = cookies.get('access')
 
         if token:
-            try:
-                payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
-                user = await database_sync_to_async(User.objects.get)(id=payload["user_id"])
+            user = token_cache.get(token)
+            if user is None:
+                try:
+                    payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+                    user = await User.objects.aget(id=payload["user_id"])
+                except Exception:
+                    user = None
+                else:
+                    # never outlive the token itself
+                    token_cache.set(token, user, expires_at=payload.get("exp"))
+
+            if user is not None and user.is_active:
                 scope['user'] = user
-            except Exception:
-                scope['user'] = AnonymousUser()
 
         return await self.app(scope, receive, send)
 
@@ -1,7 +1,8 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.signals import user_logged_in
 from talk.models import User
+from .middleware import token_cache
 from .tasks import send_welcome_email, send_login_email
 
 
@@ -14,3 +15,16 @@ def user_created_signal(sender, instance, created, **kwargs):
 @receiver(user_logged_in)
 def user_login_signal(sender, request, user, **kwargs):
     send_login_email.delay(user.email, user.username)
+
+
+@receiver(post_save, sender=User)
+def user_saved_drop_cached_tokens(sender, instance, update_fields=None, **kwargs):
+    # logins only touch last_login, which doesn't affect a cached socket user
+    if update_fields and set(update_fields) <= {"last_login"}:
+        return
+    token_cache.discard_where(lambda user: user.pk == instance.pk)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted_drop_cached_tokens(sender, instance, **kwargs):
+    token_cache.discard_where(lambda user: user.pk == instance.pk)
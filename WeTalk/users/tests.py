@@ -1,3 +1,61 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from talk.models import User
+from .middleware import JWTAuthMiddleware, token_cache
+
+
+async def echo_user(scope, receive, send):
+    return scope["user"]
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class JWTAuthMiddlewareTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch("users.signals.send_welcome_email")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(token_cache.clear)
+
+        self.user = User.objects.create_user(username="alice", email="alice@example.com", password="pass12345")
+        self.token = str(AccessToken.for_user(self.user))
+        self.middleware = JWTAuthMiddleware(echo_user)
+
+    def scope(self, token):
+        return {"type": "websocket", "headers": [(b"cookie", f"theme=dark; access={token}".encode())]}
+
+    async def test_repeat_token_is_served_from_cache(self):
+        token_cache.clear()
+        user = await self.middleware(self.scope(self.token), None, None)
+        self.assertEqual(user.pk, self.user.pk)
+
+        hits = token_cache.hits
+        with mock.patch.object(User.objects, "aget") as db:
+            user = await self.middleware(self.scope(self.token), None, None)
+        db.assert_not_called()
+        self.assertEqual(user.pk, self.user.pk)
+        self.assertEqual(token_cache.hits, hits + 1)
+
+    async def test_bad_token_is_anonymous(self):
+        user = await self.middleware(self.scope("not.a.token"), None, None)
+        self.assertTrue(user.is_anonymous)
+
+    async def test_deactivation_invalidates_cached_user(self):
+        await self.middleware(self.scope(self.token), None, None)
+        self.user.is_active = False
+        await self.user.asave()
+
+        user = await self.middleware(self.scope(self.token), None, None)
+        self.assertTrue(user.is_anonymous)
+
+    def test_login_does_not_invalidate(self):
+        token_cache.set(self.token, self.user)
+        self.user.save(update_fields=["last_login"])
+        self.assertIsNotNone(token_cache.get(self.token))
+
+    def test_entry_never_outlives_token_exp(self):
+        token_cache.set(self.token, self.user, expires_at=0)
+        self.assertIsNone(token_cache.get(self.token))
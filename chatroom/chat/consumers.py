@@ -2,8 +2,10 @@ import json
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from .metrics import MetricsConsumerMixin, group_send
 
-class ChatConsumer(AsyncWebsocketConsumer):
+
+class ChatConsumer(MetricsConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = f"chat_{self.room_name}"
@@ -23,8 +25,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
         message = text_data_json["message"]
 
         # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name, {"type": "chat.message", "message": message}
+        await group_send(
+            self.channel_layer, self.room_group_name, {"type": "chat.message", "message": message}
         )
 
     # Receive message from room group
@@ -0,0 +1,180 @@
+import functools
+import time
+from bisect import bisect_left
+
+from channels.db import database_sync_to_async as channels_database_sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+# Metrics are per process, Prometheus scrapes each worker on its own. They
+# are updated from event loop threads with plain ints and no lock: keeping
+# the hot path cheap is worth an increment lost to a rare race.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = []
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        registry.append(self)
+
+    def samples(self):
+        for values, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.labels, values), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Callback(Metric):
+    """A value read from `callback()` at scrape time, for state other modules already keep."""
+
+    def __init__(self, name, help, callback, kind="gauge"):
+        super().__init__(name, help)
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, "", self.callback()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield f"{self.name}_bucket", f'{{le="{bound}"}}', total
+        yield f"{self.name}_sum", "", self.sum
+        yield f"{self.name}_count", "", total
+
+
+def render():
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+connects = Counter("chat_ws_connects_total", "WebSocket connection attempts.")
+accepted = Counter("chat_ws_accepted_total", "WebSocket connections accepted.")
+disconnects = Counter("chat_ws_disconnects_total", "WebSocket disconnects by close code.", labels=("code",))
+active_connections = Gauge("chat_ws_active_connections", "Open WebSocket connections in this process.")
+messages_received = Counter("chat_ws_messages_received_total", "Frames received from clients.")
+messages_sent = Counter("chat_ws_messages_sent_total", "Frames sent to clients.")
+group_send_seconds = Histogram("chat_channel_layer_group_send_seconds", "Time spent in channel_layer.group_send.")
+db_wait_seconds = Histogram(
+    "chat_database_sync_to_async_wait_seconds", "Time database_sync_to_async calls wait for a worker thread.",
+)
+db_run_seconds = Histogram("chat_database_sync_to_async_run_seconds", "Time database_sync_to_async calls run.")
+
+
+class MetricsConsumerMixin:
+    """Counts a consumer's connections and frames. Goes before the Channels consumer class."""
+
+    async def websocket_connect(self, message):
+        connects.inc()
+        await super().websocket_connect(message)
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        accepted.inc()
+        active_connections.inc()
+        self.metrics_open = True
+
+    async def websocket_receive(self, message):
+        messages_received.inc()
+        await super().websocket_receive(message)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        if text_data is not None or bytes_data is not None:
+            messages_sent.inc()
+        await super().send(text_data, bytes_data, close)
+
+    async def websocket_disconnect(self, message):
+        if getattr(self, "metrics_open", False):
+            self.metrics_open = False
+            active_connections.dec()
+        disconnects.inc(str(message.get("code", "")))
+        await super().websocket_disconnect(message)
+
+
+async def group_send(channel_layer, group, message):
+    """channel_layer.group_send, timed."""
+    started = time.perf_counter()
+    try:
+        await channel_layer.group_send(group, message)
+    finally:
+        group_send_seconds.observe(time.perf_counter() - started)
+
+
+def database_sync_to_async(func):
+    """
+    channels.db.database_sync_to_async that also records how long each call
+    queued for the thread and how long it ran there.
+    """
+    def run(started, *args, **kwargs):
+        started.append(time.perf_counter())
+        return func(*args, **kwargs)
+
+    threaded = channels_database_sync_to_async(run)
+
+    @functools.wraps(func)
+    async def call(*args, **kwargs):
+        submitted = time.perf_counter()
+        started = []
+        try:
+            return await threaded(started, *args, **kwargs)
+        finally:
+            if started:
+                db_wait_seconds.observe(started[0] - submitted)
+                db_run_seconds.observe(time.perf_counter() - started[0])
+    return call
+
+
+def metrics_view(request):
+    """Prometheus text format. Needs `Authorization: Bearer <METRICS_TOKEN>` when that is set."""
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return HttpResponseForbidden()
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
@@ -0,0 +1,35 @@
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, override_settings
+
+from . import metrics
+from .routing import websocket_urlpatterns
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class MetricsTests(SimpleTestCase):
+
+    async def test_socket_lifecycle_is_counted(self):
+        counters = (metrics.connects, metrics.accepted, metrics.messages_received, metrics.messages_sent)
+        before = {counter: counter.values.get((), 0) for counter in counters}
+        group_sends = sum(metrics.group_send_seconds.counts)
+
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/chat/lobby/")
+        await communicator.connect()
+        self.assertEqual(metrics.active_connections.values.get((), 0), 1)
+        await communicator.send_json_to({"message": "hi"})
+        self.assertEqual(await communicator.receive_json_from(), {"message": "hi"})
+        await communicator.disconnect()
+
+        self.assertEqual([counter.values.get((), 0) - before[counter] for counter in counters], [1, 1, 1, 1])
+        self.assertEqual(metrics.active_connections.values.get((), 0), 0)
+        self.assertEqual(sum(metrics.group_send_seconds.counts) - group_sends, 1)
+
+    def test_prometheus_text_endpoint(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE chat_ws_active_connections gauge", response.content.decode())
+
+        with override_settings(METRICS_TOKEN="secret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret").status_code, 200)
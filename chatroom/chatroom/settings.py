@@ -131,4 +131,7 @@ CHANNEL_LAYERS = {
             "hosts": [("127.0.0.1", 6379)],
         },
     },
-}
\ No newline at end of file
+}
+
+# Metrics
+METRICS_TOKEN = None  # bearer token required by /metrics, None leaves it open
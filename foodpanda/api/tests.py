@@ -1,9 +1,11 @@
 # tests.py
 
+from django.test import override_settings
 from rest_framework.test import APITestCase
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
 from .models import Restaurant, MenuItem, Order, OrderItem
+from foodpanda.querybudget import QueryBudgetTestMixin
 
 from django.contrib.auth import get_user_model
 
@@ -115,4 +117,36 @@ class FoodPandaAPITests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
         self.assertIn("Not enough stock", str(response.data))
 
-    
+
+@override_settings(QUERY_BUDGET_ENABLED=True)
+class QueryBudgetTests(QueryBudgetTestMixin, APITestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(
+            username="owner", email="owner@example.com", password="pass123", role="owner"
+        )
+        self.customer = User.objects.create_user(
+            username="customer", email="customer@example.com", password="pass123", role="customer"
+        )
+        self.restaurant = Restaurant.objects.create(name="Burger Hub", owner=self.owner)
+        items = [
+            MenuItem.objects.create(restaurant=self.restaurant, name=f"Burger {i}", price=250, stock=10)
+            for i in range(3)
+        ]
+        for item in items:
+            order = Order.objects.create(customer=self.customer, restaurant=self.restaurant)
+            OrderItem.objects.create(order=order, menu_item=item, quantity=2)
+
+    def test_order_list_total_cost_does_not_query_per_order(self):
+        for user in (self.customer, self.owner):
+            self.client.force_authenticate(user)
+            with self.subTest(user.role), self.assertQueryBudget("orders-list GET"):
+                response = self.client.get("/order/")
+            self.assertEqual([order["total_cost"] for order in response.data], [500, 500, 500])
+
+    def test_menu_items_within_budget(self):
+        self.client.force_authenticate(self.owner)
+        with self.assertQueryBudget("restaurants-restaurant-items GET"):
+            response = self.client.get(f"/restaurants/{self.restaurant.id}/menu-items/")
+        self.assertEqual(len(response.data), 3)
+        self.assertEqual(response["X-Query-Count"], "2")
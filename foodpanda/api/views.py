@@ -77,7 +77,7 @@ class OrderViewSet(viewsets.ModelViewSet):
         if user.role == "customer":
             return Order.objects.filter(customer=user).select_related('restaurant').prefetch_related('order_items__menu_item')
         elif user.role == "owner":
-            return Order.objects.filter(restaurant__owner=user).select_related('customer').prefetch_related('order_items__menu_item')
+            return Order.objects.filter(restaurant__owner=user).select_related('customer', 'restaurant').prefetch_related('order_items__menu_item')
         return Order.objects.none()
 
     def perform_create(self, serializer):
@@ -0,0 +1,99 @@
+import logging
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+class QueryRecorder:
+    """
+    Collects the SQL run on the default connection while installed through
+    connection.execute_wrapper. A statement run again with other parameters
+    is "similar", the usual shape of an N+1.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries.append(sql)
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def record(self):
+        with connection.execute_wrapper(self):
+            yield self
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def similar(self):
+        return sum(n - 1 for n in Counter(self.queries).values())
+
+    def repeated(self):
+        """The statements run more than once, most repeated first."""
+        return [(sql, n) for sql, n in Counter(self.queries).most_common() if n > 1]
+
+
+def over_budget(key, recorder):
+    """The QUERY_BUDGETS[key] limits `recorder` went past, as readable strings."""
+    budget = getattr(settings, "QUERY_BUDGETS", {}).get(key)
+    if budget is None:
+        return []
+    if not isinstance(budget, dict):
+        budget = {"queries": budget}
+    failures = []
+    if budget.get("queries") is not None and recorder.count > budget["queries"]:
+        failures.append(f"{recorder.count} queries > {budget['queries']}")
+    if budget.get("similar") is not None and recorder.similar > budget["similar"]:
+        failures.append(f"{recorder.similar} repeated statements > {budget['similar']}")
+    return failures
+
+
+class QueryBudgetMiddleware:
+    """
+    Counts the queries of each request into an X-Query-Count header, and
+    logs a warning when a view action ("<url name> <METHOD>") goes over its
+    QUERY_BUDGETS entry. Off unless QUERY_BUDGET_ENABLED.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, "QUERY_BUDGET_ENABLED", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        with recorder.record():
+            response = self.get_response(request)
+
+        match = getattr(request, "resolver_match", None)
+        key = f"{match.view_name if match else request.path} {request.method}"
+        failures = over_budget(key, recorder)
+        if failures:
+            logger.warning("%s over budget: %s", key, ", ".join(failures))
+        response["X-Query-Count"] = str(recorder.count)
+        return response
+
+
+class QueryBudgetTestMixin:
+    """
+    TestCase mixin. `with self.assertQueryBudget("orders-list GET"):` fails
+    the test when the block goes over that action's QUERY_BUDGETS entry,
+    listing the repeated statements.
+    """
+
+    @contextmanager
+    def assertQueryBudget(self, key):
+        with QueryRecorder().record() as recorder:
+            yield recorder
+        failures = over_budget(key, recorder)
+        if failures:
+            repeated = "\n".join(f"  {n}x {sql}" for sql, n in recorder.repeated())
+            self.fail(f"{key} over budget: {', '.join(failures)}\n{repeated}")
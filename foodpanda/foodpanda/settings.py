@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'foodpanda.querybudget.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -184,4 +185,13 @@ CELERY_TASK_DEFAULT_QUEUE = "default"
 
 EMAIL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
 EMAIL_HOST = "localhost"
-EMAIL_PORT = 1025
\ No newline at end of file
+EMAIL_PORT = 1025
+
+
+# --- Query budgets ---
+QUERY_BUDGET_ENABLED = DEBUG               # count queries per request, see foodpanda.querybudget
+QUERY_BUDGETS = {                          # "<url name> <METHOD>": max queries, or a dict of queries/similar
+    "orders-list GET": {"queries": 3, "similar": 0},
+    "restaurants-list GET": {"queries": 1, "similar": 0},
+    "restaurants-restaurant-items GET": {"queries": 2, "similar": 0},
+}